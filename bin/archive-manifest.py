@@ -12,6 +12,19 @@ Options:
      --headers=LIST      Comma separated list of dicom header names to print.
      --oneseries         Only show one series (useful for just exam info)
      --showheaders       Just list all of the headers for each archive
+     --jobs N            Number of archives to read in parallel. With more
+                         than one job rows are written as each archive
+                         finishes, so archives may be out of order
+                         [default: 1]
+     --output FILE       Write the manifest to FILE instead of printing it
+     --format FMT        Format of the manifest written to --output. One of
+                         csv, parquet or feather [default: csv]
+     --batch-size N      Number of rows to buffer before each write
+                         [default: 1000]
+
+Parquet and feather output need pyarrow to be installed. Csv and parquet
+manifests are written in batches as archives are read, feather manifests are
+written once all archives have been read.
 """
 
 import datman
@@ -22,6 +35,10 @@ import zipfile
 import io
 import os.path
 import StringIO
+import csv
+import sys
+from functools import partial
+from multiprocessing import Pool
 import pandas as pd
 
 default_headers=[
@@ -33,7 +50,6 @@ default_headers=[
 
 def main():
     from datman.docopt import docopt
-    import sys
     arguments = docopt(__doc__)
 
     if arguments['--showheaders']:
@@ -49,19 +65,129 @@ def main():
                 default_headers[:]
     headers.insert(0,"Path")
 
+    output_format = arguments['--format']
+    if output_format not in ['csv', 'parquet', 'feather']:
+        print >> sys.stderr, "Unknown format: {}".format(output_format)
+        sys.exit(1)
+    if output_format != 'csv' and not arguments['--output']:
+        print >> sys.stderr, "--output is needed for {} manifests".format(
+                output_format)
+        sys.exit(1)
+
+    # columns are sorted to match the manifests made by earlier versions
+    columns = sorted(headers)
+    writer = get_writer(output_format, arguments['--output'], columns)
+
+    batch_size = int(arguments['--batch-size'])
+    batch = []
+    for rows in read_manifests(arguments['<archive>'], headers,
+                               arguments['--oneseries'],
+                               int(arguments['--jobs'])):
+        batch.extend(rows)
+        if len(batch) >= batch_size:
+            writer.write(batch)
+            batch = []
+    if batch:
+        writer.write(batch)
+    writer.close()
+
+def get_manifest_rows(archive, headers, oneseries=False):
+    """
+    Returns a list of rows (dictionaries of header -> value) for the series
+    in an archive.
+
+    Values are converted to strings so rows can be passed between processes
+    and written to columnar formats.
+    """
+    manifest = datman.utils.get_archive_headers(archive)
+    sortedseries = sorted(manifest.iteritems(),
+                          key = lambda x: x[1].get('SeriesNumber'))
     rows = []
-    for archive in arguments['<archive>']:
-        manifest = datman.utils.get_archive_headers(archive)
-        sortedseries = sorted(manifest.iteritems(),
-                              key = lambda x: x[1].get('SeriesNumber'))
-        for path, dataset in sortedseries:
-            row = dict([(header,dataset.get(header,"")) for header in headers])
-            row['Path'] = path
-            rows.append(row)
-            if arguments['--oneseries']: break
-
-    data = pd.DataFrame(rows)
-    print data.to_csv(index=False)
+    for path, dataset in sortedseries:
+        row = dict([(header,str(dataset.get(header,""))) for header in headers])
+        row['Path'] = path
+        rows.append(row)
+        if oneseries: break
+    return rows
+
+def read_manifests(archives, headers, oneseries=False, jobs=1):
+    """
+    Yields the rows of each archive's manifest. With more than one job the
+    archives are read in a pool of worker processes and yielded as they
+    finish.
+    """
+    read_rows = partial(get_manifest_rows, headers=headers,
+                        oneseries=oneseries)
+    if jobs < 2:
+        for archive in archives:
+            yield read_rows(archive)
+        return
+
+    pool = Pool(jobs)
+    try:
+        for rows in pool.imap_unordered(read_rows, archives):
+            yield rows
+    finally:
+        pool.close()
+        pool.join()
+
+def get_writer(output_format, output, columns):
+    if output_format == 'parquet':
+        return ParquetWriter(output, columns)
+    if output_format == 'feather':
+        return FeatherWriter(output, columns)
+    return CSVWriter(output, columns)
+
+class CSVWriter(object):
+    def __init__(self, output, columns):
+        self.columns = columns
+        self.stream = open(output, 'wb') if output else sys.stdout
+        # pandas wrote the manifest with plain newlines, keep it that way
+        self.writer = csv.DictWriter(self.stream, columns, lineterminator='\n')
+        self.writer.writeheader()
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+        self.stream.flush()
+
+    def close(self):
+        if self.stream is not sys.stdout:
+            self.stream.close()
+
+class ParquetWriter(object):
+    """Writes each batch of rows as a row group of one parquet file"""
+    def __init__(self, output, columns):
+        import pyarrow
+        import pyarrow.parquet
+        self.pyarrow = pyarrow
+        self.columns = columns
+        schema = pyarrow.schema([(column, pyarrow.string())
+                                 for column in columns])
+        self.writer = pyarrow.parquet.ParquetWriter(output, schema)
+
+    def write(self, rows):
+        data = pd.DataFrame(rows, columns=self.columns)
+        table = self.pyarrow.Table.from_pandas(data, preserve_index=False)
+        self.writer.write_table(table)
+
+    def close(self):
+        self.writer.close()
+
+class FeatherWriter(object):
+    """Feather files can't be appended to, so rows are kept until close"""
+    def __init__(self, output, columns):
+        import pyarrow.feather
+        self.feather = pyarrow.feather
+        self.output = output
+        self.columns = columns
+        self.rows = []
+
+    def write(self, rows):
+        self.rows.extend(rows)
+
+    def close(self):
+        data = pd.DataFrame(self.rows, columns=self.columns)
+        self.feather.write_feather(data, self.output)
 
 if __name__ == '__main__':
     main()
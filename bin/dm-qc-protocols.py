@@ -26,17 +26,25 @@ DETAILS
 import os
 import pandas as pd
 import datman as dm
+import datman.scanid
+import datman.utils
 from docopt import docopt
 
 def check_protocol_length(data, expected):
     if len(data) != expected:
         raise ValueError
 
-def find_niftis_with_tag(datadir, tag):
-    files = dm.utils.get_files_with_tag(datadir, tag)
-    files = filter(lambda x: '.nii.gz' in x, files)
-
-    return files
+def count_niftis_by_tag(subjdir):
+    counts = {}
+    for f in os.listdir(subjdir):
+        if '.nii.gz' not in f:
+            continue
+        try:
+            _, tag, _, _ = dm.scanid.parse_filename(f)
+        except dm.scanid.ParseException:
+            continue
+        counts[tag] = counts.get(tag, 0) + 1
+    return counts
 
 def main():
 
@@ -72,10 +80,11 @@ def main():
     # loop through subjects, reporting 
     for sub in subjects:
         subjdir = os.path.join(datadir, sub)
+        # list the subject's folder once, rather than once per tag
+        counts = count_niftis_by_tag(subjdir)
 
         for tag in tags_expected:
-            files = find_niftis_with_tag(subjdir, tag)
-            tags_found[tag] = len(files)
+            tags_found[tag] = counts.get(tag, 0)
 
         # compare the protocols
         successful = None
@@ -10,6 +10,10 @@ Options:
     --root PATH      Path to parent folder to all study folders.
                      [default: /archive/data-2.0]
     --study=<study>  Process a singe study
+    --jobs N         Number of studies to search at once [default: 1]
+    --json           Print the results as json (a list with the missing,
+                     stale and unsigned reports of each study) instead of
+                     as text
 
 Expects to be run in the parent folder to all study folders. Looks for the file
 checklist.csv in subfolders, and prints out any QC pdf from those that haven't
@@ -17,72 +21,27 @@ been signed off on.
 """
 
 import docopt
-import glob
-import os
-import os.path
-import re
-import datman.config as config
-
-def read_checklist(checklist_file):
-    checklist_dict = {}
-
-    with open(checklist_file) as checklist:
-        lines = checklist.readlines()
-
-    for line in lines:
-        entry = line.strip().split()
-        try:
-            key = os.path.splitext(entry[0])[0]
-        except:
-            # Empty line, skip it
-            continue
-        try:
-            rest = entry[1:]
-        except:
-            entry = ''
-        checklist_dict[key] = rest
-    return checklist_dict
-
-def get_project_dirs(root, maxdepth=2):
-    """
-    Search for datman project directories below root.
-
-    A project directory is defined as a directory having a
-    metadata/checklist.csv file.
-
-    Returns a list of absolute paths to project folders.
-    """
-    paths = []
-    for dirpath, dirs, files in os.walk(root):
-        checklist = os.path.join(dirpath, 'metadata', 'checklist.csv')
-        if os.path.exists(checklist):
-            del dirs[:]  # don't descend
-            paths.append(dirpath)
-        depth = dirpath.count(os.path.sep) - root.count(os.path.sep)
-        if depth >= maxdepth:
-            del dirs[:]
-    return paths
-
-def get_mtime(path):
-    """
-    Returns the value of os.path.getmtime. If a broken link is found 0 is
-    returned and a message is given.
+import json
+import logging
 
-    This is needed because when the target of a link is blacklisted and removed
-    the links are not cleaned up and this was causing crashes. The broken links
-    cannot just be removed from here because this script may be run by many
-    users with insufficient privileges.
-    """
-
-    try:
-        return os.path.getmtime(path)
-    except OSError:
-        if os.path.islink(path):
-            print("Found broken link: {}".format(path))
-            return 0
-        else:
-            # Something went very wrong, reraise the OSError! :(
-            raise
+import datman.config as config
+import datman.qc_status
+
+logging.basicConfig(level=logging.WARN, format="%(message)s")
+
+def print_status(status, show_newer=False):
+    for timepointdir in status['unlisted']:
+        print('No checklist entry for {}'.format(timepointdir))
+    for timepointdir in status['missing']:
+        print('No QC doc generated for {}'.format(timepointdir))
+    if show_newer:
+        for stale in status['stale']:
+            print('{}: QC doc is older than data in folder {} {} {}'.format(
+                    stale['report'], stale['session'], stale['data_mtime'],
+                    stale['report_mtime']))
+            print('\t' + '\n\t'.join(stale['newer']))
+    for qcdoc in status['unsigned']:
+        print('{}: QC doc not signed off on'.format(qcdoc))
 
 def main():
     arguments = docopt.docopt(__doc__)
@@ -91,39 +50,16 @@ def main():
         cfg = config.config()
         rootdir = cfg.get_study_base(arguments['--study'])
 
-    for projectdir in get_project_dirs(rootdir):
-        checklist = os.path.join(projectdir, 'metadata', 'checklist.csv')
-
-        checklistdict = read_checklist(checklist)
-
-        for timepointdir in sorted(glob.glob(projectdir + '/data/nii/*')):
-            if '_PHA_' in timepointdir:
-                continue
-
-            timepoint = os.path.basename(timepointdir)
-            qcdocname = 'qc_' + timepoint
-            qcdoc = os.path.join(projectdir, 'qc', timepoint, (qcdocname + '.html'))
-
-            data_mtime = max(map(get_mtime, glob.glob(timepointdir + '/*.nii.gz')+[timepointdir]))
-
-            # notify about missing QC reports or those with no checklist entry
-            if qcdocname not in checklistdict:
-                print('No checklist entry for {}'.format(timepointdir))
-                continue
-            elif not os.path.exists(qcdoc):
-                print('No QC doc generated for {}'.format(timepointdir))
-                continue
+    projects = datman.qc_status.find_projects(rootdir)
+    statuses = datman.qc_status.scan_projects(projects,
+            int(arguments['--jobs']))
 
-            # find QC documents that are older than the most recent data export
-            if arguments['--show-newer'] and data_mtime > os.path.getmtime(qcdoc):
-                newer = filter(lambda x: os.path.getmtime(x) > os.path.getmtime(qcdoc), glob.glob(timepointdir + '/*'))
-                if newer != []:
-                    print('{}: QC doc is older than data in folder {} {} {}'.format(qcdoc, timepointdir, data_mtime, os.path.getmtime(qcdoc)))
-                    print('\t' + '\n\t'.join(newer))
+    if arguments['--json']:
+        print(json.dumps(statuses, indent=2))
+        return
 
-            # notify about unchecked QC reports
-            if not checklistdict[qcdocname]:
-                print '{}: QC doc not signed off on'.format(qcdoc)
+    for status in statuses:
+        print_status(status, arguments['--show-newer'])
 
 if __name__ == '__main__':
     main()
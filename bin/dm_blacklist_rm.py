@@ -22,19 +22,31 @@ Options:
                         given.
     --ignore-path KEY   A value from the configuration file 'path' field to
                         not search through. [default: qc meta]
+    --jobs N            The number of paths to search at once. Mostly helps
+                        on network file systems. [default: 1]
     -v --verbose
     -d --debug
     -q --quiet
-    -n --dry-run
+    -n --dry-run        Report the files that would be removed, and how
+                        much space that would free, without removing them.
 
+Each search path is walked once, and every file name is checked against all
+blacklist entries at the same time. A file matches a blacklist entry if its
+name starts with that entry.
 """
 import os
 import re
 import sys
 import logging
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
 
 import datman.config
-import datman.utils
 from datman.docopt import docopt
 
 logging.basicConfig(level=logging.WARN,
@@ -50,6 +62,7 @@ def main():
     series = arguments['<series>']
     blacklist = arguments['--blacklist']
     ignored_paths = arguments['--ignore-path']
+    jobs = int(arguments['--jobs'])
     verbose = arguments['--verbose']
     debug = arguments['--debug']
     quiet = arguments['--quiet']
@@ -67,7 +80,7 @@ def main():
     blacklist = get_blacklist(arguments['--blacklist'], series, config)
     logger.debug("Found blacklist data: {}".format(blacklist))
 
-    remove_blacklisted_items(blacklist, config, ignored_paths)
+    remove_blacklisted_items(blacklist, config, ignored_paths, jobs)
 
 def get_blacklist(blacklist_file, series, config):
     if series:
@@ -99,25 +112,45 @@ def get_series(line):
         return ''
     return fields[0]
 
-def remove_blacklisted_items(blacklist, config, ignored_paths):
-    found_items = collect_blacklisted_items(blacklist, config, ignored_paths)
+def remove_blacklisted_items(blacklist, config, ignored_paths, jobs=1):
+    found_items = collect_blacklisted_items(blacklist, config, ignored_paths,
+            jobs)
+
+    if DRYRUN:
+        report_space(found_items)
 
     for item in found_items:
         remove_item(item)
         remove_parent_dir_if_empty(item)
 
-def collect_blacklisted_items(blacklist, config, ignored_paths):
-    search_paths = get_search_paths(config, ignored_paths)
-
-    file_list = []
-    for path in search_paths:
+def collect_blacklisted_items(blacklist, config, ignored_paths, jobs=1):
+    search_paths = []
+    for path in get_search_paths(config, ignored_paths):
         full_path = config.get_path(path)
-        if not os.path.exists(full_path):
-            continue
-        for item in blacklist:
-            found_files = find_files(full_path, item)
-            if found_files:
-                file_list.extend(found_files)
+        if os.path.exists(full_path):
+            search_paths.append(full_path)
+
+    matcher = BlacklistMatcher(blacklist)
+    if jobs < 2 or len(search_paths) < 2:
+        results = [find_files(path, matcher) for path in search_paths]
+    else:
+        pool = ThreadPool(min(jobs, len(search_paths)))
+        try:
+            results = pool.map(partial(find_files, matcher=matcher),
+                    search_paths)
+        finally:
+            pool.close()
+            pool.join()
+
+    # Paths may be nested in each other, only report each file once
+    file_list = []
+    seen = set()
+    for found_files in results:
+        for item in found_files:
+            if item in seen:
+                continue
+            seen.add(item)
+            file_list.append(item)
     return file_list
 
 def get_search_paths(config, ignored_paths):
@@ -130,15 +163,67 @@ def get_search_paths(config, ignored_paths):
     search_paths = [path for path in path_keys if path not in ignored_paths]
     return search_paths
 
-def find_files(search_path, item):
-    command = 'find {} -name \"{}*\"'.format(search_path, item)
-    return_code, out = datman.utils.run(command)
-
-    if not out:
-        return []
-    found_files = out.strip().split('\n')
+class BlacklistMatcher(object):
+    """
+    Checks whether a file name starts with any entry of the blacklist.
+
+    The entries are kept in a set, and a name is checked by looking up its
+    prefixes of each entry length, so the cost per file depends on the
+    number of distinct entry lengths rather than the size of the blacklist.
+    """
+    def __init__(self, blacklist):
+        self.entries = set(blacklist)
+        self.lengths = sorted(set(len(entry) for entry in self.entries))
+
+    def matches(self, name):
+        for length in self.lengths:
+            if length > len(name):
+                break
+            if name[:length] in self.entries:
+                return True
+        return False
+
+def find_files(search_path, matcher):
+    """
+    Walks search_path once and returns every file (or link) whose name
+    matches the blacklist. Links to folders are not followed.
+    """
+    found_files = []
+    folders = [search_path]
+    while folders:
+        folder = folders.pop()
+        try:
+            entries = list(scandir(folder))
+        except OSError as e:
+            logger.error("Cannot search {}, reason: {}".format(folder,
+                    e.strerror))
+            continue
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                is_dir = False
+            if is_dir:
+                folders.append(entry.path)
+            elif matcher.matches(entry.name):
+                found_files.append(entry.path)
+    logger.debug("Found {} blacklisted files in {}".format(len(found_files),
+            search_path))
     return found_files
 
+def report_space(items):
+    total = 0
+    for item in items:
+        try:
+            total += os.lstat(item).st_size
+        except OSError:
+            continue
+    # This is what a dry run is for, so it's shown at the default level
+    # (and hidden by --quiet)
+    logger.warning("{} blacklisted files found, removing them would free {} "
+            "bytes ({:.1f} MiB)".format(len(items), total, total / 1048576.0))
+    return total
+
 def remove_item(item):
     logger.info('Removing blacklisted item {}'.format(item))
     try:
@@ -38,7 +38,6 @@ import sys
 import glob
 import time
 import logging
-import logging.handlers
 
 from datman.docopt import docopt
 import datman.utils as utils
@@ -46,6 +45,7 @@ import datman.config
 import datman.scan
 import datman.scanid as scanid
 import datman.fs_log_scraper as log_scraper
+import datman.log_client
 
 logging.basicConfig(level=logging.WARN,
         format="[%(name)s] %(levelname)s: %(message)s")
@@ -65,7 +65,7 @@ def main():
     config = datman.config.config(study=study)
 
     if use_server:
-        add_server_handler(config)
+        datman.log_client.add_server_handler(logger, config)
     if debug:
         logging.getLogger().setLevel(logging.DEBUG)
 
@@ -77,12 +77,6 @@ def main():
 
     run_all_subjects(config, arguments)
 
-def add_server_handler(config):
-    server_ip = config.get_key('LOGSERVER')
-    server_handler = logging.handlers.SocketHandler(server_ip,
-            logging.handlers.DEFAULT_TCP_LOGGING_PORT)
-    logger.addHandler(server_handler)
-
 def check_environment():
     try:
         utils.check_dependency_configured('FSL', shell_cmd='fsl',
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Compares the dicom headers of every session in a study (or only the sessions
+given) against the study's gold standards and writes each session's
+header-diff.log in its QC folder. Sessions whose log is already up to date
+with their dicoms and standards are skipped.
+
+This is the same check dm_qc_report.py runs for each session, but the
+standards are only read once for the whole study.
+
+Usage:
+    dm_header_checks.py [options] <study> [<session>...]
+
+Arguments:
+    <study>             Name of the study to check e.g. SPINS
+    <session>           Datman name of a session to check. If none are given
+                        every session in the study's dicom folder is checked
+
+Options:
+    --jobs N            Number of sessions to check at once [default: 1]
+    --rewrite           Remake logs even if they are up to date
+    -q --quiet          Only report errors
+    -v --verbose        Be chatty
+    -d --debug          Be extra chatty
+"""
+import os
+import sys
+import logging
+
+import datman.config
+import datman.header_checks
+from datman.docopt import docopt
+
+logging.basicConfig(level=logging.WARN,
+        format="[%(name)s] %(levelname)s: %(message)s")
+logger = logging.getLogger(os.path.basename(__file__))
+
+def main():
+    arguments = docopt(__doc__)
+    study = arguments['<study>']
+    sessions = arguments['<session>']
+    jobs = int(arguments['--jobs'])
+    rewrite = arguments['--rewrite']
+    quiet = arguments['--quiet']
+    verbose = arguments['--verbose']
+    debug = arguments['--debug']
+
+    level = logging.WARN
+    if quiet:
+        level = logging.ERROR
+    if verbose:
+        level = logging.INFO
+    if debug:
+        level = logging.DEBUG
+    logger.setLevel(level)
+    logging.getLogger('datman.header_checks').setLevel(level)
+
+    try:
+        config = datman.config.config(study=study)
+    except:
+        logger.error("Cannot find configuration info for study {}".format(study))
+        sys.exit(1)
+
+    failed = datman.header_checks.check_study(config, sessions or None, jobs,
+            rewrite)
+
+    if failed:
+        logger.error("Header checks failed for {} sessions: {}".format(
+                len(failed), ", ".join(failed)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
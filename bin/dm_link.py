@@ -18,6 +18,8 @@ Options:
                                 overrides metadata/scans.csv
     --scanid-field STR       Dicom field to match target_name with
                              [default: PatientName]
+    --threads N              Number of archives to read dicom headers from
+                             in parallel [default: 4]
     -v --verbose             Verbose logging
     -d --debug                  Debug logging
     -q --quiet             Less debuggering
@@ -79,10 +81,12 @@ import datman.config
 import datman.utils
 import datman.scanid
 import logging
+from multiprocessing.pool import ThreadPool
 
 logger = logging.getLogger(os.path.basename(__file__))
 already_linked = {}
 lookup = None
+headers = {}
 DRYRUN = None
 
 
@@ -90,6 +94,7 @@ def main():
     # make the already_linked dict global as we are going to use it a lot
     global already_linked
     global lookup
+    global headers
     global DRYRUN
 
     arguments = docopt(__doc__)
@@ -101,6 +106,7 @@ def main():
     lookup_path = arguments['--lookup']
     scanid_field = arguments['--scanid-field']
     zipfile = arguments['<zipfile>']
+    threads = int(arguments['--threads'])
 
     # setup logging
     ch = logging.StreamHandler(sys.stdout)
@@ -144,7 +150,7 @@ def main():
         return
 
     try:
-        lookup = pd.read_table(lookup_path, sep='\s+', dtype=str)
+        lookup = read_lookup_table(lookup_path)
     except IOError:
         logger.error('Lookup file:{} not found'.format(lookup_path))
         return
@@ -166,10 +172,73 @@ def main():
                     if os.path.splitext(archive)[1] == '.zip']
 
     logger.info('Found {} archives'.format(len(archives)))
+
+    # read the headers of every archive that still needs linking up front, so
+    # each archive is opened at most once and slow disks are read in parallel
+    headers = read_archive_headers(get_unlinked_archives(archives), threads)
+
     for archive in archives:
         link_archive(archive, dicom_path, scanid_field, cfg)
 
 
+def read_lookup_table(lookup_path):
+    """
+    Reads the lookup table and indexes it by source_name.
+
+    Returns a dictionary mapping each source_name to its row (as a dictionary
+    of column name -> value). If a source_name appears more than once the
+    first row is used.
+    """
+    table = pd.read_table(lookup_path, sep='\s+', dtype=str)
+    index = {}
+    for row in table.to_dict('records'):
+        index.setdefault(row['source_name'], row)
+    return index
+
+
+def get_unlinked_archives(archives):
+    """
+    Returns the archives whose dicom headers will be needed to link them.
+
+    Archives that don't exist, are already linked, or are marked as
+    '<ignore>' in the lookup table never have their headers read.
+    """
+    unlinked = []
+    for archive in archives:
+        if not os.path.isfile(archive):
+            continue
+        if os.path.realpath(archive) in already_linked:
+            continue
+        scanid = get_scanid_from_lookup_table(archive)
+        if scanid and scanid[0] == '<ignore>':
+            continue
+        unlinked.append(archive)
+    return unlinked
+
+
+def read_archive_headers(archives, threads=1):
+    """
+    Reads the dicom headers of each archive using a pool of threads.
+
+    Returns a dictionary mapping archive path -> header (None if the archive
+    contains no dicoms).
+    """
+    if not archives:
+        return {}
+
+    logger.info('Reading headers from {} archives'.format(len(archives)))
+    if threads < 2:
+        return {archive: read_headers(archive) for archive in archives}
+
+    pool = ThreadPool(min(threads, len(archives)))
+    try:
+        results = pool.map(read_headers, archives, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(archives, results))
+
+
 def link_archive(archive_path, dicom_path, scanid_field, config):
     if not os.path.isfile(archive_path):
         logger.error('Archive:{} not found'.format(archive_path))
@@ -240,18 +309,19 @@ def get_scanid_from_lookup_table(archive_path):
     global lookup
     basename = os.path.basename(os.path.normpath(archive_path))
     source_name = basename[:-len(datman.utils.get_extension(basename))]
-    lookupinfo = lookup[lookup['source_name'] == source_name]
 
-    if len(lookupinfo) == 0:
+    try:
+        lookupinfo = lookup[source_name]
+    except KeyError:
         logger.debug("{} not found in source_name column."
                      .format(source_name))
         return
-    else:
-        scanid = lookupinfo['target_name'].tolist()[0]
-        return (scanid, lookupinfo)
 
+    scanid = lookupinfo['target_name']
+    return (scanid, lookupinfo)
 
-def get_archive_headers(archive_path):
+
+def read_headers(archive_path):
     # get some DICOM headers from the archive
     header = None
     try:
@@ -260,9 +330,26 @@ def get_archive_headers(archive_path):
         header = header.values()[0]
     except:
         logger.warn("Archive:{} contains no DICOMs".format(archive_path))
+        return header
+    # headers are held for the whole run, don't keep the image data around
+    if 'PixelData' in header:
+        del header.PixelData
     return header
 
 
+def get_archive_headers(archive_path):
+    """
+    Returns the headers read for this archive during this run, reading them
+    now if they haven't been read yet.
+    """
+    try:
+        return headers[archive_path]
+    except KeyError:
+        header = read_headers(archive_path)
+        headers[archive_path] = header
+        return header
+
+
 def get_scanid_from_header(archive_path, scanid_field):
     """
     Gets the scanid from the dicom header object.
@@ -299,8 +386,7 @@ def validate_headers(archive_path, lookupinfo, scanid_field):
     if not header:
         return False
 
-    columns = lookupinfo.columns.values.tolist()
-    dicom_cols = [c for c in columns if c.startswith('dicom_')]
+    dicom_cols = [c for c in lookupinfo if c.startswith('dicom_')]
 
     for c in dicom_cols:
         f = c.split("_")[1]
@@ -311,7 +397,7 @@ def validate_headers(archive_path, lookupinfo, scanid_field):
             return False
 
         actual = str(header.get(f))
-        expected = str(lookupinfo[c].tolist()[0])
+        expected = str(lookupinfo[c])
 
         if actual != expected:
             logger.error("{}: dicom field '{}' = '{}', expected '{}'"
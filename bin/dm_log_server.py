@@ -7,99 +7,275 @@ Usage:
     dm_log_server.py [options]
 
 Options:
-    --log-dir PATH  The directory to store all logs. Default is the value
-                    stored as SERVER_LOG_DIR in the site config file
-    --host STR      The ip address to bind the server to. Default is the value
-                    stored as LOGSERVER in the site config file
-    --port STR      The port to listen to. Default is the default logging TCP
-                    port.
+    --log-dir PATH          The directory to store all logs. Default is the
+                            value stored as SERVER_LOG_DIR in the site config
+                            file
+    --host STR              The ip address to bind the server to. Default is
+                            the value stored as LOGSERVER in the site config
+                            file
+    --port STR              The port to listen to. Default is the default
+                            logging TCP port.
+    --json                  Write each record as a line of json instead of
+                            as plain text
+    --buffer-size BYTES     How much output to hold for each log before
+                            writing it out [default: 65536]
+    --flush-interval SECS   The longest output is held before it's written
+                            [default: 1]
+
+All connections are served from one thread. Records are read as they arrive
+(framed the way logging.handlers.SocketHandler sends them), so a client never
+waits on another client or on the disk. Output is buffered for each log file
+and written when the buffer fills or every --flush-interval seconds, whichever
+comes first.
+
+Logs are named for the date and the name of the logger that sent the record
+(e.g. 2018-01-31-dm_qc_report.log, or 2018-01-31-all.log for '__main__'), so
+a new set of files is started each day. With --json each line holds the
+time, logger name, level, host, process and message of one record.
 """
 import os
+import sys
+import json
+import time
 import pickle
+import signal
+import socket
+import struct
+import asyncore
 import logging
 import logging.handlers
-import SocketServer
-import struct
-import select
 import datetime
 
 from docopt import docopt
 
 import datman.config
 
+logging.basicConfig(level=logging.WARN,
+        format="[%(name)s] %(levelname)s: %(message)s")
+logger = logging.getLogger(os.path.basename(__file__))
+
 FORMAT = logging.Formatter("[%(name)s] %(levelname)s: %(message)s")
-LOG_DIR = None
+HEADER = struct.Struct('>L')
+
+def today():
+    return str(datetime.date.today())
+
+def get_log_name(name, date):
+    if name == '__main__':
+        return "{}-all.log".format(date)
+    name = name.replace(".py", "")
+    return "{}-{}.log".format(date, name)
+
+def format_text(record):
+    return FORMAT.format(record) + '\n'
+
+def format_json(record):
+    entry = {'time': record.created,
+             'name': record.name,
+             'level': record.levelname,
+             'host': getattr(record, 'host', None),
+             'process': record.process,
+             'message': record.getMessage()}
+    if record.exc_text:
+        entry['exception'] = record.exc_text
+    return json.dumps(entry) + '\n'
+
+class LogWriter(object):
+    """
+    Holds the output for one log file until flush() is called.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self._buffer = []
+        self._stream = None
+
+    def write(self, text):
+        self._buffer.append(text)
+        self.size += len(text)
+
+    def flush(self):
+        if not self._buffer:
+            return
+        try:
+            if self._stream is None:
+                self._stream = open(self.path, 'a')
+            self._stream.write(''.join(self._buffer))
+            self._stream.flush()
+        except IOError as e:
+            logger.error("Failed writing {} records to {}. Reason: {}".format(
+                    len(self._buffer), self.path, e))
+        self._buffer = []
+        self.size = 0
+
+    def close(self):
+        self.flush()
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+class LogFiles(object):
+    """
+    Sorts records into the day's log files.
+
+        log_dir:        The folder to write logs to.
+        json_lines:     Write records as lines of json instead of text.
+        buffer_size:    Write a log's output once this many bytes are held.
+    """
+    def __init__(self, log_dir, json_lines=False, buffer_size=65536):
+        self.log_dir = log_dir
+        self.buffer_size = buffer_size
+        self.format = format_json if json_lines else format_text
+        self._date = None
+        self._writers = {}
 
-class LogRecordStreamHandler(SocketServer.StreamRequestHandler):
-    def handle(self):
-        while True:
-            chunk = self.connection.recv(4)
-            if len(chunk) < 4:
+    def write(self, record):
+        date = today()
+        if date != self._date:
+            self.rotate(date)
+        log_name = get_log_name(record.name, date)
+        try:
+            writer = self._writers[log_name]
+        except KeyError:
+            writer = LogWriter(os.path.join(self.log_dir, log_name))
+            self._writers[log_name] = writer
+        writer.write(self.format(record))
+        if writer.size >= self.buffer_size:
+            writer.flush()
+
+    def rotate(self, date):
+        """
+        Closes the current day's files, the next records go to the
+        files for date.
+        """
+        self.close()
+        self._date = date
+
+    def flush(self):
+        for writer in self._writers.values():
+            writer.flush()
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+class LogRecordChannel(asyncore.dispatcher):
+    """
+    Reads the records sent on one client connection.
+    """
+    def __init__(self, sock, log_files, map=None):
+        asyncore.dispatcher.__init__(self, sock, map=map)
+        self.log_files = log_files
+        self._data = ''
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if data:
+            self.handle_data(data)
+
+    def handle_data(self, data):
+        """
+        Handles every complete record in data (and what's left from the
+        last read), the rest is kept for the next read.
+        """
+        data = self._data + data
+        start = 0
+        while len(data) - start >= HEADER.size:
+            length = HEADER.unpack_from(data, start)[0]
+            end = start + HEADER.size + length
+            if len(data) < end:
                 break
-            slen = struct.unpack('>L', chunk)[0]
-            chunk = self.connection.recv(slen)
-            while len(chunk) < slen:
-                chunk = chunk + self.connection.recv(slen - len(chunk))
-            obj = self.unPickle(chunk)
-            record = logging.makeLogRecord(obj)
-            self.handleLogRecord(record)
-
-    def unPickle(self, data):
-        return pickle.loads(data)
-
-    def handleLogRecord(self, record):
-        logger = self.__set_handler(record)
-        logger.handle(record)
-
-    def __set_handler(self, record):
-        log_name = self.__get_log_name(record)
-        log_path = os.path.join(LOG_DIR, log_name)
-        logger = logging.getLogger(log_name)
-        if not logger.handlers:
-            file_handler = logging.FileHandler(log_path)
-            file_handler.setFormatter(FORMAT)
-            logger.addHandler(file_handler)
-        return logger
-
-    def __get_log_name(self, record):
-        name = record.name
-        date = str(datetime.date.today())
-        if name == '__main__':
-            log_name = "{}-all.log".format(date)
-        else:
-            name = name.replace(".py", "")
-            log_name = "{}-{}.log".format(date, name)
-        return log_name
-
-class LogRecordSocketReceiver(SocketServer.ThreadingTCPServer):
-    allow_reuse_address = 1
-
-    def __init__(self, host, port, handler=LogRecordStreamHandler):
-        SocketServer.ThreadingTCPServer.__init__(self, (host, port), handler)
-        self.abort = 0
-        self.timeout = 1
-
-    def serve_until_stopped(self):
-        abort = 0
-        while not abort:
-            rd, wr, ex = select.select([self.socket.fileno()],
-                                       [], [],
-                                       self.timeout)
-            if rd:
-                self.handle_request()
-            abort = self.abort
+            self.handle_record(data[start + HEADER.size:end])
+            start = end
+        self._data = data[start:]
+
+    def handle_record(self, data):
+        try:
+            record = logging.makeLogRecord(pickle.loads(data))
+        except Exception as e:
+            logger.error("Can't read record from {}, ignoring it. "
+                    "Reason: {}".format(self.addr, e))
+            return
+        if self.addr:
+            record.host = self.addr[0]
+        try:
+            self.log_files.write(record)
+        except Exception as e:
+            # e.g. a message that doesn't match its arguments, or bytes that
+            # aren't utf-8 with --json
+            logger.error("Can't write record from {} ({}), ignoring it. "
+                    "Reason: {}".format(self.addr, record.name, e))
+
+    def handle_error(self):
+        # Anything not caught above shouldn't cost the client its connection
+        # (and the rest of what it sent), which asyncore's default does.
+        # Only a broken socket closes it.
+        logger.exception("Unexpected error reading from {}".format(
+                self.addr))
+        if isinstance(sys.exc_info()[1], socket.error):
+            self.close()
+
+    def handle_close(self):
+        self.close()
+
+class LogRecordReceiver(asyncore.dispatcher):
+    """
+    Accepts logging connections on host and port.
+    """
+    def __init__(self, host, port, log_files, map=None):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.log_files = log_files
+        # the number of connections accepted so far
+        self.connections = 0
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(socket.SOMAXCONN)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, addr = pair
+        self.connections += 1
+        LogRecordChannel(sock, self.log_files, map=self._map)
+
+def serve(log_files, flush_interval=1.0, map=None, stop=None):
+    """
+    Serves the connections in map (or asyncore's default map) until stop()
+    returns True, writing held output at least every flush_interval
+    seconds. Everything held is written before returning.
+    """
+    last_flush = time.time()
+    try:
+        while stop is None or not stop():
+            asyncore.loop(timeout=flush_interval, count=1, map=map)
+            if time.time() - last_flush >= flush_interval:
+                log_files.flush()
+                last_flush = time.time()
+    finally:
+        log_files.close()
+
+def stop_server(signum, frame):
+    sys.exit(0)
 
 def main():
-    global LOG_DIR
     arguments = docopt(__doc__)
-    LOG_DIR = arguments['--log-dir']
+    log_dir = arguments['--log-dir']
     host = arguments['--host']
     port = arguments['--port']
+    json_lines = arguments['--json']
+    buffer_size = int(arguments['--buffer-size'])
+    flush_interval = float(arguments['--flush-interval'])
 
     config = datman.config.config()
 
-    if LOG_DIR is None:
-        LOG_DIR = config.get_key('SERVER_LOG_DIR')
+    if log_dir is None:
+        log_dir = config.get_key('SERVER_LOG_DIR')
 
     if host is None:
         host = config.get_key('LOGSERVER')
@@ -108,8 +284,11 @@ def main():
         port = logging.handlers.DEFAULT_TCP_LOGGING_PORT
 
     # Start server
-    tcpserver = LogRecordSocketReceiver(host, port)
-    tcpserver.serve_until_stopped()
+    log_files = LogFiles(log_dir, json_lines, buffer_size)
+    LogRecordReceiver(host, int(port), log_files)
+    # make sure held output is written when the server is stopped
+    signal.signal(signal.SIGTERM, stop_server)
+    serve(log_files, flush_interval)
 
 if __name__ == '__main__':
     main()
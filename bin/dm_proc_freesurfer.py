@@ -24,7 +24,6 @@ import os, sys
 import glob
 import time
 import logging
-import logging.handlers
 
 from datman.docopt import docopt
 import datman.scanid as sid
@@ -32,6 +31,7 @@ import datman.utils as utils
 import datman.config as cfg
 import datman.scan as dm_scan
 import datman.fs_log_scraper as fs_scraper
+import datman.log_client
 
 logging.basicConfig(level=logging.WARN, format="[%(name)s] %(levelname)s: %(message)s")
 logger = logging.getLogger(os.path.basename(__file__))
@@ -362,12 +362,6 @@ def make_error_log_dir(freesurfer_path):
         pass
     return log_dir
 
-def add_server_handler(config):
-    server_ip = config.get_key('LOGSERVER')
-    server_handler = logging.handlers.SocketHandler(server_ip,
-            logging.handlers.DEFAULT_TCP_LOGGING_PORT)
-    logger.addHandler(server_handler)
-
 def load_config(study):
     try:
         config = cfg.config(study=study)
@@ -394,7 +388,7 @@ def main():
     config = load_config(study)
 
     if use_server:
-        add_server_handler(config)
+        datman.log_client.add_server_handler(logger, config)
     if debug:
         logger.setLevel(logging.DEBUG)
 
@@ -38,6 +38,7 @@ import nibabel as nib
 
 from datman.docopt import docopt
 import datman.config
+import datman.index
 import datman.scanid
 import datman.utils
 
@@ -88,8 +89,10 @@ def main():
         files = os.listdir(base_dir)
         add_session_PDT2s(files, images, base_dir)
     else:
-        for root, dirs, files in os.walk(nii_dir):
-            add_session_PDT2s(files, images, root)
+        index = datman.index.get_index(cfg)
+        index.update()
+        for entry in index.find(tag='PDT2', format='nii'):
+            add_PDT2(entry.path, images)
 
     logger.info('Found {} splittable nifti files with tag "PDT2"'.format(
             len(images)))
@@ -103,17 +106,21 @@ def add_session_PDT2s(files, images, base_dir):
         except datman.scanid.ParseException:
             logger.info('Invalid scanid:{}'.format(f))
             continue
-        ext = datman.utils.get_extension(f)
-        if tag == 'PDT2' and 'nii' in ext:
-            file_path = os.path.join(base_dir, f)
-            f_shape = nib.load(file_path).shape
-            # this will fail if we load a 3D image, though some 3D images also
-            # report the 4th dimension as 1, so we need to check the value
-            try:
-                if f_shape[3] >= 2:
-                    images.append(file_path)
-            except:
-                link_T2(file_path)
+        if tag == 'PDT2':
+            add_PDT2(os.path.join(base_dir, f), images)
+
+def add_PDT2(file_path, images):
+    ext = datman.utils.get_extension(file_path)
+    if 'nii' not in ext:
+        return
+    f_shape = nib.load(file_path).shape
+    # this will fail if we load a 3D image, though some 3D images also
+    # report the 4th dimension as 1, so we need to check the value
+    try:
+        if f_shape[3] >= 2:
+            images.append(file_path)
+    except:
+        link_T2(file_path)
 
 def split(image):
 
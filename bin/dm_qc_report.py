@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 """
 Generates quality control reports on defined MRI data types. If no subject is
-given, all subjects are submitted individually to the queue.
+given, all subjects that need QC (no report, a report older than their data
+or a new repeat session) are submitted to the queue or run locally.
 
 usage:
     dm-qc-report.py [options] <study>
@@ -12,7 +13,18 @@ Arguments:
     <session>         Datman name of session to process e.g. DTI_CMH_H001_01_01
 
 Options:
-    --rewrite          Rewrite the html of an existing qc page
+    --rewrite          Rebuild existing qc pages from scratch, remaking
+                       every section and QC output even if it's up to date
+    --update           Rebuild an existing qc page, only remaking the
+                       sections and QC outputs that are out of date
+    --executor TYPE    How to run QC for each session when no session is
+                       given. 'sge' submits a job per session to the queue,
+                       'local' runs them in a pool of local processes
+                       [default: sge]
+    --jobs N           Number of sessions to QC at once with the local
+                       executor [default: 1]
+    --chunk-size N     Number of sessions to QC in each job submitted to the
+                       queue [default: 1]
     --log-to-server    If set, all log messages will also be sent to the configured logging server. This is useful when the script is run with the Sun Grid Engine, since it swallows logging messages.
     -q --quiet         Only report errors
     -v --verbose       Be chatty
@@ -46,6 +58,15 @@ Details:
      There should be a .dcm file for each .nii.gz. One subfolder for each
      subject will be created under the <QCDir> folder.
 
+     **reports**
+
+     Each report is built from sections (the scan table and one per series)
+     that are cached in .qc_report.json beside it. When a report is updated
+     only the sections for new or changed series are made again (sessions
+     with new data are updated this way automatically), --rewrite ignores the
+     cache and remakes everything. An index of all reports is written to
+     <QCDir>/index.html.
+
      **gold standards**
 
      To check for changes to the MRI machine's settings over time, this compares
@@ -86,19 +107,27 @@ import re
 import glob
 import time
 import logging
-import logging.handlers
 import copy
 import random
+import functools
 import string
+from multiprocessing import Pool, Semaphore
 
 import numpy as np
-import pandas as pd
 import nibabel as nib
 
 import datman.config
+import datman.log_client
 import datman.utils
 import datman.scanid
 import datman.scan
+import datman.montage
+import datman.expected_files
+import datman.header_checks
+import datman.qc_cache
+import datman.qc_checklist
+import datman.qc_metrics
+import datman.qc_report
 
 from datman.docopt import docopt
 
@@ -107,24 +136,44 @@ logging.basicConfig(level=logging.WARN,
 logger = logging.getLogger(os.path.basename(__file__))
 
 REWRITE = False
+# Set by --rewrite, remakes every output and section instead of only the
+# out of date ones
+FORCE = False
+# Limits phantom QC to one session at a time with the local executor
+PHANTOM_LOCK = None
 
 SLICER_GAP = 2
 SLICER_RES = 1600
 SLICER_FMRI_RES = 600
 
+# Tool names recorded in the QC cache, the loaded environment module version
+# of each is recorded with it when available.
+QCMON = 'qcmon'
+MONTAGE = 'datman-montage'
+HEADERS = datman.header_checks.TOOL
+METRICS = 'datman-qc-metrics'
+
 def random_str(n):
     """generates a random string of length n"""
     return(''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(n)))
 
 def slicer(fpath, pic, slicergap, picwidth):
     """
-    Uses FSL's slicer function to generate a montage png from a nifti file
+    Generates a montage png from a nifti file, in the style of FSL's slicer
         fpath       -- submitted image file name
         slicergap   -- int of "gap" between slices in Montage
         picwidth    -- width (in pixels) of output image
         pic         -- fullpath to for output image
+
+    Returns True if the montage was made.
     """
-    datman.utils.run("slicer {} -S {} {} {}".format(fpath,slicergap,picwidth,pic))
+    try:
+        datman.montage.render(fpath, pic, slicergap, picwidth)
+    except Exception as e:
+        logger.error("Failed to generate montage {} from {}. Reason: {}".format(
+                pic, fpath, e))
+        return False
+    return True
 
 def add_image(qc_html, image, title=None):
     """
@@ -140,6 +189,27 @@ def add_image(qc_html, image, title=None):
 
     return qc_html
 
+def needs_update(output, inputs, tool):
+    """
+    Returns True if output doesn't exist, or if it was made from different
+    versions of its inputs or tool than the ones present now. Always True
+    with --rewrite.
+    """
+    if FORCE:
+        return True
+    cache = datman.qc_cache.get_cache(os.path.dirname(output))
+    return not cache.is_current(output, inputs,
+            datman.qc_cache.tool_version(tool))
+
+def record_update(output, inputs, tool):
+    """
+    Records the versions of the inputs and tool that output was just made from.
+    Only call this once output has been made successfully, otherwise an old
+    output left on disk would be taken as current.
+    """
+    cache = datman.qc_cache.get_cache(os.path.dirname(output))
+    cache.update(output, inputs, datman.qc_cache.tool_version(tool))
+
 # PIPELINES
 def ignore(filename, qc_dir, report):
     pass
@@ -147,78 +217,91 @@ def ignore(filename, qc_dir, report):
 def phantom_fmri_qc(filename, outputDir):
     """
     Runs the fbirn fMRI pipeline on input phantom data if the outputs don't
-    already exist.
+    already exist or are out of date.
     """
     basename = datman.utils.nifti_basename(filename)
     output_file = os.path.join(outputDir, '{}_stats.csv'.format(basename))
     output_prefix = os.path.join(outputDir, basename)
-    if not os.path.isfile(output_file):
-        datman.utils.run('qc-fbirn-fmri {} {}'.format(filename, output_prefix))
+    if needs_update(output_file, [filename], QCMON):
+        returncode, _ = datman.utils.run('qc-fbirn-fmri {} {}'.format(filename,
+                output_prefix))
+        if not returncode:
+            record_update(output_file, [filename], QCMON)
 
 def phantom_dti_qc(filename, outputDir):
     """
     Runs the fbirn DTI pipeline on input phantom data if the outputs don't
-    already exist.
+    already exist or are out of date.
     """
     dirname = os.path.dirname(filename)
     basename = datman.utils.nifti_basename(filename)
 
     output_file = os.path.join(outputDir, '{}_stats.csv'.format(basename))
     output_prefix = os.path.join(outputDir, basename)
+    bvec = os.path.join(dirname, basename + '.bvec')
+    bval = os.path.join(dirname, basename + '.bval')
+    inputs = [filename, bvec, bval]
 
-    if not os.path.isfile(output_file):
-        bvec = os.path.join(dirname, basename + '.bvec')
-        bval = os.path.join(dirname, basename + '.bval')
-        datman.utils.run('qc-fbirn-dti {} {} {} {} n'.format(filename, bvec, bval,
-                output_prefix))
+    if needs_update(output_file, inputs, QCMON):
+        returncode, _ = datman.utils.run('qc-fbirn-dti {} {} {} {} n'.format(
+                filename, bvec, bval, output_prefix))
+        if not returncode:
+            record_update(output_file, inputs, QCMON)
 
 def phantom_anat_qc(filename, outputDir):
     """
     Runs the ADNI pipeline on input phantom data if the outputs don't already
-    exist.
+    exist or are out of date.
     """
     basename = datman.utils.nifti_basename(filename)
     output_file = os.path.join(outputDir, '{}_adni-contrasts.csv'.format(basename))
-    if not os.path.isfile(output_file):
-        datman.utils.run('qc-adni {} {}'.format(filename, output_file))
+    if needs_update(output_file, [filename], QCMON):
+        returncode, _ = datman.utils.run('qc-adni {} {}'.format(filename,
+                output_file))
+        if not returncode:
+            record_update(output_file, [filename], QCMON)
 
 def fmri_qc(file_name, qc_dir, report):
     base_name = datman.utils.nifti_basename(file_name)
     output_name = os.path.join(qc_dir, base_name)
 
-    # check scan length
-    script_output = output_name + '_scanlengths.csv'
-    if not os.path.isfile(script_output):
-        datman.utils.run('qc-scanlength {} {}'.format(file_name, script_output))
-
-    # check fmri signal
-    script_output = output_name + '_stats.csv'
-    if not os.path.isfile(script_output):
-        datman.utils.run('qc-fmri {} {}'.format(file_name, output_name))
+    # scan length, signal statistics and the sfnr / correlation maps are all
+    # made from one read of the image (plus 3dvolreg for the motion stats)
+    outputs = [output_name + '_scanlengths.csv',
+               output_name + '_stats.csv',
+               output_name + '_sfnr.nii.gz',
+               output_name + '_corr.nii.gz']
+    if any(needs_update(output, [file_name], METRICS) for output in outputs):
+        datman.qc_metrics.fmri_qc(file_name, output_name)
+        for output in outputs:
+            record_update(output, [file_name], METRICS)
 
     image_raw = output_name + '_raw.png'
     image_sfnr = output_name + '_sfnr.png'
     image_corr = output_name + '_corr.png'
 
-    if not os.path.isfile(image_raw):
-        slicer(file_name, image_raw, SLICER_GAP, SLICER_FMRI_RES)
-    add_image(report, image_raw, title='BOLD montage')
+    # render all missing or out of date montages for this scan at once
+    montages = [(file_name, image_raw),
+                (os.path.join(qc_dir, base_name + '_sfnr.nii.gz'), image_sfnr),
+                (os.path.join(qc_dir, base_name + '_corr.nii.gz'), image_corr)]
+    montages = [(nifti, image) for nifti, image in montages
+            if needs_update(image, [nifti], MONTAGE)]
+    failed = datman.montage.render_batch([(nifti, image, SLICER_GAP,
+            SLICER_FMRI_RES) for nifti, image in montages])
+    for nifti, image in montages:
+        if image not in failed:
+            record_update(image, [nifti], MONTAGE)
 
-    if not os.path.isfile(image_sfnr):
-        slicer(os.path.join(qc_dir, base_name + '_sfnr.nii.gz'), image_sfnr,
-                SLICER_GAP, SLICER_FMRI_RES)
+    add_image(report, image_raw, title='BOLD montage')
     add_image(report, image_sfnr, title='SFNR map')
-
-    if not os.path.isfile(image_corr):
-        slicer(os.path.join(qc_dir, base_name + '_corr.nii.gz'), image_corr,
-                SLICER_GAP, SLICER_FMRI_RES)
     add_image(report, image_corr, title='correlation map')
 
 def anat_qc(filename, qc_dir, report):
 
     image = os.path.join(qc_dir, datman.utils.nifti_basename(filename) + '.png')
-    if not os.path.isfile(image):
-        slicer(filename, image, 5, SLICER_RES)
+    if needs_update(image, [filename], MONTAGE):
+        if slicer(filename, image, 5, SLICER_RES):
+            record_update(image, [filename], MONTAGE)
     add_image(report, image)
 
 def dti_qc(filename, qc_dir, report):
@@ -228,20 +311,25 @@ def dti_qc(filename, qc_dir, report):
     bvec = os.path.join(dirname, basename + '.bvec')
     bval = os.path.join(dirname, basename + '.bval')
 
+    inputs = [filename, bvec, bval]
+
     output_prefix = os.path.join(qc_dir, basename)
     output_file = output_prefix + '_stats.csv'
-    if not os.path.isfile(output_file):
-       datman.utils.run('qc-dti {} {} {} {}'.format(filename, bvec, bval,
-                output_prefix))
+    if needs_update(output_file, inputs, QCMON):
+        returncode, _ = datman.utils.run('qc-dti {} {} {} {}'.format(filename,
+                bvec, bval, output_prefix))
+        if not returncode:
+            record_update(output_file, inputs, QCMON)
 
     output_file = os.path.join(qc_dir, basename + '_spikecount.csv')
-    if not os.path.isfile(output_file):
-        datman.utils.run('qc-spikecount {} {} {}'.format(filename,
-                os.path.join(qc_dir, basename + '_spikecount.csv'), bval))
+    if needs_update(output_file, [filename, bval], METRICS):
+        datman.qc_metrics.spikecount(filename, output_file, bval)
+        record_update(output_file, [filename, bval], METRICS)
 
     image = os.path.join(qc_dir, basename + '_b0.png')
-    if not os.path.isfile(image):
-        slicer(filename, image, SLICER_GAP, SLICER_RES)
+    if needs_update(image, [filename], MONTAGE):
+        if slicer(filename, image, SLICER_GAP, SLICER_RES):
+            record_update(image, [filename], MONTAGE)
     add_image(report, image, title='b0 montage')
     add_image(report, os.path.join(qc_dir, basename + '_directions.png'),
             title='bvec directions')
@@ -281,7 +369,7 @@ def make_job_file(job_name, cmd):
         fid.write(cmd)
     return job_file
 
-def make_qc_command(subject_id, study):
+def make_qc_command(subject_id, study, rewrite=False):
     arguments = docopt(__doc__)
     use_server = arguments['--log-to-server']
     verbose = arguments['--verbose']
@@ -297,26 +385,142 @@ def make_qc_command(subject_id, study):
     if use_server:
         command = " ".join([command, '--log-to-server'])
 
-    if REWRITE:
+    if FORCE:
         command = command + ' --rewrite'
+    elif REWRITE or rewrite:
+        command = command + ' --update'
 
     return command
 
-def qc_all_scans(config):
+def get_newest_mtime(path):
     """
-    Creates a dm-qc-report.py command for each scan and submits all jobs to the
-    queue. Phantom jobs are submitted in chained mode, which means they will run
-    one at a time. This is currently needed because some of the phantom pipelines
-    use expensive and limited software liscenses (i.e., MATLAB).
+    Returns the newest modification time of the files in path, or 0 if path
+    is empty or doesn't exist.
     """
-    human_commands = []
-    phantom_commands = []
+    newest = 0
+    try:
+        file_names = os.listdir(path)
+    except OSError:
+        return newest
+    for file_name in file_names:
+        try:
+            newest = max(newest, os.path.getmtime(os.path.join(path,
+                    file_name)))
+        except OSError:
+            continue
+    return newest
+
+def get_unqced_repeats(study, subjects):
+    """
+    Returns the set of subjects that have a repeat session in the dashboard
+    that their QC page hasn't been updated for yet.
+
+    WARNING: If the dashboard can't be accessed an empty set is returned
+    """
+    try:
+        import datman.dashboard
+        db = datman.dashboard.dashboard(study)
+    except Exception as e:
+        logger.error("Cannot access dashboard database, QC pages may become "
+                "out of date if repeat sessions exist. Reason: {}".format(e))
+        return set()
+
+    repeats = set()
+    for subject in subjects:
+        try:
+            db_session = db.get_add_session(subject)
+        except Exception:
+            continue
+        if not db_session:
+            continue
+        if db_session.last_repeat_qc_generated < db_session.repeat_count:
+            repeats.add(subject)
+    return repeats
+
+def find_subjects_to_qc(config, subjects):
+    """
+    Works out which of the given subjects (nii folder names) actually need
+    QC, so that jobs aren't started just to find their report already exists.
+
+    Returns a list of (subject, rewrite) tuples. A subject needs QC if:
+        - It has no QC report (or for phantoms, no QC outputs at all)
+        - A nifti has been modified since the report (or the newest phantom
+          QC output) was written. 'rewrite' is True for these subjects.
+        - It has a new repeat session in the dashboard
+    """
+    if REWRITE:
+        return [(subject, False) for subject in subjects]
 
     nii_dir = config.get_path('nii')
+    qc_dir = config.get_path('qc')
 
-    for path in os.listdir(nii_dir):
-        subject = os.path.basename(path)
-        command = make_qc_command(subject, config.study_name)
+    to_qc = []
+    humans = []
+    for subject in subjects:
+        qc_path = os.path.join(qc_dir, subject)
+        if '_PHA_' in subject:
+            qc_time = get_newest_mtime(qc_path)
+        else:
+            report = os.path.join(qc_path, 'qc_{}.html'.format(subject))
+            try:
+                qc_time = os.path.getmtime(report)
+            except OSError:
+                qc_time = 0
+            humans.append(subject)
+
+        if not qc_time:
+            to_qc.append((subject, False))
+        elif get_newest_mtime(os.path.join(nii_dir, subject)) > qc_time:
+            logger.debug("QC for {} is out of date".format(subject))
+            to_qc.append((subject, True))
+
+    needs_qc = set(subject for subject, _ in to_qc)
+    repeats = get_unqced_repeats(config.study_name,
+            [subject for subject in humans if subject not in needs_qc])
+    to_qc.extend((subject, False) for subject in sorted(repeats))
+
+    logger.info("{} of {} sessions need QC".format(len(to_qc), len(subjects)))
+    return to_qc
+
+def make_chunks(commands, chunk_size):
+    """
+    Joins commands into groups of chunk_size, so that each group can be run
+    one after the other in a single job.
+    """
+    chunk_size = max(chunk_size, 1)
+    return ["\n".join(commands[i:i + chunk_size])
+            for i in range(0, len(commands), chunk_size)]
+
+def qc_all_scans(config, executor='sge', jobs=1, chunk_size=1):
+    """
+    Runs QC for every session in the nii folder that needs it, either by
+    submitting dm-qc-report.py jobs to the queue (executor='sge'), each
+    handling chunk_size sessions, or by running them in a pool of 'jobs'
+    local processes (executor='local').
+
+    Phantoms are only ever QC'd one at a time. On the queue this is done by
+    submitting them in chained mode, locally they share a semaphore. This is
+    currently needed because some of the phantom pipelines use expensive and
+    limited software liscenses (i.e., MATLAB).
+    """
+    nii_dir = config.get_path('nii')
+    subjects = [os.path.basename(path) for path in os.listdir(nii_dir)]
+    to_qc = find_subjects_to_qc(config, subjects)
+
+    # Pick up reports added by the jobs from the last run
+    compact_checklist(config)
+
+    if executor == 'local':
+        run_local_qc_jobs(to_qc, config.study_name, jobs)
+        compact_checklist(config)
+        write_index(config)
+        return
+
+    human_commands = []
+    phantom_commands = []
+
+    for subject, rewrite in to_qc:
+        command = make_qc_command(subject, config.study_name, rewrite)
 
         if '_PHA_' in subject:
             phantom_commands.append(command)
@@ -325,58 +529,104 @@ def qc_all_scans(config):
 
     if human_commands:
         logger.debug('submitting human qc jobs\n{}'.format(human_commands))
-        submit_qc_jobs(human_commands)
+        submit_qc_jobs(make_chunks(human_commands, chunk_size))
 
     if phantom_commands:
         logger.debug('running phantom qc jobs\n{}'.format(phantom_commands))
-        submit_qc_jobs(phantom_commands, chained=True)
+        submit_qc_jobs(make_chunks(phantom_commands, chunk_size), chained=True)
+
+    # Reports from the submitted jobs are added on the next run
+    write_index(config)
 
-def find_existing_reports(checklist_path):
-    found_reports = []
-    with open(checklist_path, 'r') as checklist:
-        for checklist_entry in checklist:
-            checklist_entry = checklist_entry.split(' ')[0].strip()
-            checklist_entry, checklist_ext = os.path.splitext(checklist_entry)
-            found_reports.append(checklist_entry)
-    return found_reports
+def init_local_worker(phantom_lock, rewrite, force):
+    global PHANTOM_LOCK, REWRITE, FORCE
+    PHANTOM_LOCK = phantom_lock
+    REWRITE = rewrite
+    FORCE = force
 
-def add_report_to_checklist(qc_report, checklist_path, retry=3):
+def run_local_qc(subject_id, study, rewrite=False):
     """
-    Add the given report's name to the QC checklist if it is not already
-    present.
+    QCs a single session inside a local worker process. Returns the subject_id
+    and whether QC completed without error.
+    """
+    global REWRITE
+    # REWRITE is only changed for this session
+    original_rewrite = REWRITE
+    REWRITE = REWRITE or rewrite
+    try:
+        config = get_config(study)
+        subject = prepare_scan(subject_id, config)
+        if subject.is_phantom and PHANTOM_LOCK:
+            with PHANTOM_LOCK:
+                qc_single_scan(subject, config)
+        else:
+            qc_single_scan(subject, config)
+    except (Exception, SystemExit):
+        # SystemExit must be caught too or the pool would lose the worker
+        logger.error("QC failed for {}".format(subject_id), exc_info=True)
+        return subject_id, False
+    finally:
+        REWRITE = original_rewrite
+    return subject_id, True
+
+def run_local_qc_jobs(subjects, study, jobs=1):
+    """
+    Runs QC for each (subject, rewrite) in subjects in a pool of local
+    processes. Phantoms share a semaphore so only one runs at a time.
     """
-    if not qc_report or retry == 0:
+    if not subjects:
         return
 
-    # remove extension from report name, so we don't double-count .pdfs vs .html
-    report_file_name = os.path.basename(qc_report)
-    report_name, report_ext = os.path.splitext(report_file_name)
-
+    pool = Pool(max(jobs, 1), initializer=init_local_worker,
+            initargs=(Semaphore(1), REWRITE, FORCE))
     try:
-        found_reports = find_existing_reports(checklist_path)
-    except IOError:
-        logger.info("{} does not exist. "\
-                "Attempting to create it".format(checklist_path))
-        found_reports = []
+        results = [pool.apply_async(run_local_qc, (subject, study, rewrite))
+                for subject, rewrite in subjects]
+        failed = [subject for subject, success in
+                (result.get() for result in results) if not success]
+    finally:
+        pool.close()
+        pool.join()
+
+    if failed:
+        logger.error("QC failed for {} of {} sessions: {}".format(len(failed),
+                len(subjects), ", ".join(failed)))
+
+def add_report_to_checklist(qc_report, checklist_path):
+    """
+    Add the given report's name to the QC checklist if it is not already
+    present.
 
-    if report_name in found_reports:
+    The name is added to the checklist's journal, which is merged into
+    checklist.csv by compact_checklist().
+    """
+    if not qc_report:
         return
 
+    store = datman.qc_checklist.get_store(checklist_path)
+    if store.add(qc_report):
+        logger.debug("Added {} to {}".format(os.path.basename(qc_report),
+                checklist_path))
+
+def compact_checklist(config, blocking=True):
+    """
+    Merges reports added by QC jobs into the study's checklist.csv. If
+    blocking is False this is skipped when another job is updating the
+    checklist.
+    """
+    checklist_path = os.path.join(config.get_path('meta'), 'checklist.csv')
     try:
-        with open(checklist_path, 'a') as checklist:
-            checklist.write(report_file_name + '\n')
-    except:
-        logger.error("Failed to write {} to checklist. Tries remaining: "
-                "{}".format(report_file_name, retry))
-        # Sleep for a short time to shuffle processes that are attempting
-        # concurrent writes.
-        wait_time = random.uniform(0, 10)
-        time.sleep(wait_time)
-        add_report_to_checklist(qc_report, checklist_path, retry=retry-1)
+        added = datman.qc_checklist.get_store(checklist_path).compact(blocking)
+    except (IOError, OSError) as e:
+        logger.error("Failed to update {}. Reason: {}".format(checklist_path,
+                e))
+        return
+    if added:
+        logger.info("Added {} reports to {}".format(added, checklist_path))
 
-def add_header_qc(nifti, qc_html, log_path):
+def get_header_diffs(nifti, log_path):
     """
-    Adds header-diff.log information to the report.
+    Returns the lines of header-diff.log that pertain to the given series.
     """
     # get the filename of the nifti in question
     filestem = nifti.file_name.replace(nifti.ext, '')
@@ -390,17 +640,43 @@ def add_header_qc(nifti, qc_html, log_path):
         f = []
 
     # find lines in said log that pertain to the nifti
-    lines = [re.sub('^.*?: *','',line) for line in f if filestem in line]
+    return [re.sub('^.*?: *','',line) for line in f if filestem in line]
+
+def add_header_qc(nifti, qc_html, log_path):
+    """
+    Adds header-diff.log information to the report.
+    """
+    lines = get_header_diffs(nifti, log_path)
 
     if not lines:
         return
 
+    filestem = nifti.file_name.replace(nifti.ext, '')
     qc_html.write('<h3> {} header differences </h3>\n<table>'.format(filestem))
     for l in lines:
         qc_html.write('<tr><td>{}</td></tr>'.format(l))
     qc_html.write('</table>\n')
 
 def write_report_body(report, expected_files, subject, header_diffs, tag_settings):
+    """
+    Adds a section to the report for each series found. Sections are only
+    rendered (and their QC run) if something they're made from has changed
+    since the report was last written.
+    """
+    for row in expected_files.itertuples(index=False):
+        series = row.File
+        if not series:
+            continue
+
+        signature = get_series_signature(series, subject, header_diffs,
+                tag_settings)
+        report.add_section(series.file_name, signature,
+                functools.partial(write_series_section, series=series,
+                        bookmark=row.bookmark, subject=subject,
+                        header_diffs=header_diffs, tag_settings=tag_settings))
+
+def write_series_section(report, series, bookmark, subject, header_diffs,
+        tag_settings):
     handlers = {
     # List of qc functions available mapped to 'qc_type' from user settings
         "anat"      : anat_qc,
@@ -408,39 +684,59 @@ def write_report_body(report, expected_files, subject, header_diffs, tag_setting
         "dti"       : dti_qc,
         "ignore"    : ignore
     }
-    for idx in range(0,len(expected_files)):
-        series = expected_files.loc[idx,'File']
-        if not series:
-            continue
 
-        logger.info("QC scan {}".format(series.path))
-        report.write('<h2 id="{}">{}</h2>\n'.format(expected_files.loc[idx,'bookmark'],
-                series.file_name))
+    logger.info("QC scan {}".format(series.path))
+    report.write('<h2 id="{}">{}</h2>\n'.format(bookmark, series.file_name))
 
-        if series.tag not in tag_settings:
-            logger.error("Tag not defined in config files: {}".format(series.tag))
-            continue
+    if series.tag not in tag_settings:
+        logger.error("Tag not defined in config files: {}".format(series.tag))
+        return
+
+    try:
+        qc_type = tag_settings.get(series.tag, "qc_type")
+    except KeyError:
+        logger.info("qc_type not defined for tag {}. Skipping.".format(
+                series.tag))
+        return
+
+    add_header_qc(series, report, header_diffs)
+
+    # This is to deal with the fact that PDT2s are split and both images
+    # need to be displayed
+    new_series = get_series_to_add(series, subject)
 
+    for series in new_series:
         try:
-            qc_type = tag_settings.get(series.tag, "qc_type")
+            handlers[qc_type](series.path, subject.qc_path, report)
         except KeyError:
-            logger.info("qc_type not defined for tag {}. Skipping.".format(
-                    series.tag))
-            continue
+            raise KeyError('series tag {} not defined in handlers:\n{}'.format(
+                    series.tag, handlers))
+        report.write('<br>')
+
+def get_series_signature(series, subject, header_diffs, tag_settings):
+    """
+    Describes everything a series' section of the report is made from: its
+    qc_type, the files for the series (and its bvec / bval etc.), its header
+    differences and the versions of the QC tools.
+    """
+    try:
+        qc_type = tag_settings.get(series.tag, "qc_type")
+    except KeyError:
+        qc_type = None
 
-        add_header_qc(series, report, header_diffs)
+    paths = set([series.path] + [item.path for item in
+            get_series_to_add(series, subject)])
+    files = []
+    for path in sorted(paths):
+        stem = os.path.join(os.path.dirname(path),
+                datman.utils.nifti_basename(path))
+        files.extend(sorted(glob.glob(stem + '.*')))
 
-        # This is to deal with the fact that PDT2s are split and both images
-        # need to be displayed
-        new_series = get_series_to_add(series, subject)
+    tools = [datman.qc_cache.tool_version(tool) for tool in
+             [QCMON, MONTAGE, METRICS]]
 
-        for series in new_series:
-            try:
-                handlers[qc_type](series.path, subject.qc_path, report)
-            except KeyError:
-                raise KeyError('series tag {} not defined in handlers:\n{}'.format(
-                        series.tag, handlers))
-            report.write('<br>')
+    return [qc_type, datman.qc_report.file_signature(*files),
+            get_header_diffs(series, header_diffs), tools]
 
 def get_series_to_add(series, subject):
     """
@@ -576,9 +872,9 @@ def write_table(report, exportinfo, subject):
                  '<th>Scanlength</th>'
                  '<th>Notes</th></tr>')
 
-    for row in range(0,len(exportinfo)):
+    for row in exportinfo.itertuples(index=False):
         #Fetch Scanlength from .nii File
-        scan_nii_path = os.path.join(subject.nii_path, str(exportinfo.loc[row, 'File']))
+        scan_nii_path = os.path.join(subject.nii_path, str(row.File))
         try:
             data = nib.load(scan_nii_path)
             try:
@@ -590,131 +886,77 @@ def write_table(report, exportinfo, subject):
         except:
             logging.debug("{} does not exist; cannot read scanlength.".format(scan_nii_path))
             scanlength = "No file"
-        report.write('<tr><td>{}</td>'.format(exportinfo.loc[row,'tag'])) ## table new row
-        report.write('<td><a href="#{}">{}</a></td>'.format(exportinfo.loc[row,
-                'bookmark'], exportinfo.loc[row,'File']))
+        report.write('<tr><td>{}</td>'.format(row.tag)) ## table new row
+        report.write('<td><a href="#{}">{}</a></td>'.format(row.bookmark,
+                row.File))
         report.write('<td>{}</td>'.format(scanlength))
         report.write('<td><font color="#FF0000">{}</font></td>'\
-                '</tr>'.format(exportinfo.loc[row,'Note'])) ## table new row
+                '</tr>'.format(row.Note)) ## table new row
     report.write('</table>\n')
 
-def write_report_header(report, subject_id):
-    report.write('<HTML><TITLE>{} qc</TITLE>\n'.format(subject_id))
-    report.write('<head>\n<style>\n'
-                'body { font-family: futura,sans-serif;'
-                '        text-align: center;}\n'
-                'img {width:90%; \n'
-                '   display: block\n;'
-                '   margin-left: auto;\n'
-                '   margin-right: auto }\n'
-                'table { margin: 25px auto; \n'
-                '        border-collapse: collapse;\n'
-                '        text-align: left;\n'
-                '        width: 90%; \n'
-                '        border: 1px solid grey;\n'
-                '        border-bottom: 2px solid black;} \n'
-                'th {background: black;\n'
-                '    color: white;\n'
-                '    text-transform: uppercase;\n'
-                '    padding: 10px;}\n'
-                'td {border-top: thin solid;\n'
-                '    border-bottom: thin solid;\n'
-                '    padding: 10px;}\n'
-                '</style></head>\n')
-
-    report.write('<h1> QC report for {} <h1/>'.format(subject_id))
+def get_table_signature(exportinfo, subject):
+    """
+    Describes what the scan table is made from: each row and the files it
+    reads scan lengths from.
+    """
+    rows = [[str(row.tag), str(row.File), str(row.bookmark), str(row.Note)]
+            for row in exportinfo.itertuples(index=False)]
+    files = [os.path.join(subject.nii_path, row[1]) for row in rows if row[1]]
+    return [rows, datman.qc_report.file_signature(*files)]
+
+def get_report_summary(report_name, expected_files, header_diffs):
+    """
+    The details of a report shown on the study's QC index page.
+    """
+    notes = [str(note) for note in expected_files['Note']]
+    try:
+        with open(header_diffs, 'r') as log:
+            n_diffs = len(log.readlines())
+    except IOError:
+        n_diffs = 0
+    return {'report': os.path.basename(report_name),
+            'series': len([item for item in expected_files['File'] if item]),
+            'missing': len([note for note in notes if note.startswith(
+                    'missing')]),
+            'header_diffs': n_diffs}
 
 def generate_qc_report(report_name, subject, expected_files, header_diffs, config):
     tag_settings = config.get_tags()
+    report = datman.qc_report.Report(report_name, subject.full_id,
+            use_cache=not FORCE)
+    report.add_section('table', get_table_signature(expected_files, subject),
+            functools.partial(write_table, exportinfo=expected_files,
+                    subject=subject))
+    # tech notes may be added at any time, so are always looked for
+    report.add_section('tech_notes', None,
+            functools.partial(write_tech_notes_link, site=subject.site,
+                    study_name=config.study_name,
+                    resource_path=subject.resource_path))
+    write_report_body(report, expected_files, subject, header_diffs,
+            tag_settings)
+    report.write(summary=get_report_summary(report_name, expected_files,
+            header_diffs))
+
+def write_index(config):
+    """
+    Rebuilds the study's QC index page from the summaries saved with each
+    report.
+    """
     try:
-        with open(report_name, 'wb') as report:
-            write_report_header(report, subject.full_id)
-            write_table(report, expected_files, subject)
-            write_tech_notes_link(report, subject.site, config.study_name,
-                    subject.resource_path)
-            write_report_body(report, expected_files, subject, header_diffs,
-                    tag_settings)
-    except:
-        raise
-
-def get_position(position_info):
-    if isinstance(position_info, list):
-        try:
-            position = position_info.pop(0)
-        except IndexError:
-            ## More of this scan type than expected in config entry, assign
-            ## last possible position
-            position = 999
-    else:
-        position = position_info
-
-    return position
-
-def initialize_counts(export_info):
-    # build a tag count dict
-    tag_counts = {}
-    expected_position = {}
-
-    for tag in export_info.tags:
-        tag_counts[tag] = 0
-        # If ordering has been imposed on the scans get it for later sorting.
-        try:
-            ordering = export_info.get(tag, 'Order')
-        except KeyError:
-            ordering = [0]
-        expected_position[tag] = min(ordering)
-
-    return tag_counts, expected_position
+        index = datman.qc_report.write_index(config.get_path('qc'),
+                config.study_name)
+    except (IOError, OSError) as e:
+        logger.error("Failed to update QC index page. Reason: {}".format(e))
+        return
+    logger.info("Updated {}".format(index))
 
 def find_expected_files(subject, config):
     """
     Reads the export_info from the config for this site and compares it to the
     contents of the nii folder. Data written to a pandas dataframe.
     """
-    export_info = config.get_tags(subject.site)
-    sorted_niftis = sorted(subject.niftis, key=lambda item: item.series_num)
-
-    tag_counts, expected_positions = initialize_counts(export_info)
-
-    # init output pandas data frame, counter
-    idx = 0
-    expected_files = pd.DataFrame(columns=['tag', 'File', 'bookmark', 'Note',
-            'Sequence'])
-
-    # tabulate found data in the order they were acquired
-    for nifti in sorted_niftis:
-        tag = nifti.tag
-
-        # only check data that is defined in the config file
-        if tag in export_info:
-            expected_count = export_info.get(tag, 'Count')
-        else:
-            continue
-
-        tag_counts[tag] += 1
-        bookmark = tag + str(tag_counts[tag])
-        if tag_counts[tag] > expected_count:
-            notes = 'Repeated Scan'
-        else:
-            notes = ''
-
-        position = get_position(expected_positions[tag])
-
-        expected_files.loc[idx] = [tag, nifti, bookmark, notes,
-                position]
-        idx += 1
-
-    # note any missing data
-    for tag in export_info:
-        expected_count = export_info.get(tag, 'Count')
-        if tag_counts[tag] < expected_count:
-            n_missing = expected_count - tag_counts[tag]
-            notes = 'missing({})'.format(n_missing)
-            expected_files.loc[idx] = [tag, '', '', notes,
-                    expected_positions[tag]]
-            idx += 1
-    expected_files = expected_files.sort_values('Sequence')
-    return(expected_files)
+    return datman.expected_files.find_expected_files(subject.niftis,
+            config.get_tags(subject.site))
 
 def get_standards(standard_dir, site):
     """
@@ -724,49 +966,40 @@ def get_standards(standard_dir, site):
     If a standards file name raises ParseException it will be logged and
     omitted from the standards dictionary.
     """
-    glob_path = os.path.join(standard_dir, "*")
-
-    standards = {}
-    misnamed_files = []
-    for item in glob.glob(glob_path):
-        try:
-            standard = datman.scan.Series(item)
-        except datman.scanid.ParseException:
-            misnamed_files.append(item)
-            continue
-        if standard.site == site:
-            standards[standard.tag] = standard
-
-    if misnamed_files:
-        logging.error("Standards files misnamed, ignoring: \n" \
-                "{}".format("\n".join(misnamed_files)))
-
-    return standards
+    return datman.header_checks.get_standards(standard_dir, site)
 
 def run_header_qc(subject, standard_dir, log_file):
     """
     For each .dcm file found in 'dicoms', find the matching site / tag file in
-    'standards', and run qc-headers (from qcmon) on these files. Any
-    are written to log_file.
+    'standards', and compare their headers. Any differences are written to
+    log_file.
+
+    The log is only regenerated if a dicom or standard has changed since it
+    was written.
     """
 
     if not subject.dicoms:
         logger.debug("No dicoms found in {}".format(subject.dcm_path))
         return
 
-    standards_dict = get_standards(standard_dir, subject.site)
+    comparisons = datman.header_checks.get_comparisons(subject, standard_dir)
 
-    for dicom in subject.dicoms:
-        try:
-            standard = standards_dict[dicom.tag]
-        except KeyError:
-            logger.debug('No standard with tag {} found in {}'.format(dicom.tag,
-                    standard_dir))
-            continue
-        else:
-            # run header check for dicom
-            datman.utils.run('qc-headers {} {} {}'.format(dicom.path, standard.path,
-                    log_file))
+    inputs = sorted(set(path for pair in comparisons for path in pair))
+    if not needs_update(log_file, inputs, HEADERS):
+        logger.debug("{} is up to date, skipping.".format(log_file))
+        return
+
+    if os.path.exists(log_file):
+        os.remove(log_file)
+
+    try:
+        datman.header_checks.check_headers(comparisons, log_file)
+    except datman.header_checks.HeaderCheckError as e:
+        # Not recorded, so the comparisons are tried again next time
+        logger.error("Header checks incomplete for {}. Reason: {}".format(
+                subject.full_id, e))
+    else:
+        record_update(log_file, inputs, HEADERS)
 
     if not os.path.exists(log_file):
         logger.error("header-diff.log not generated for {}. Check that gold " \
@@ -781,16 +1014,15 @@ def qc_subject(subject, config):
     """
     report_name = os.path.join(subject.qc_path, 'qc_{}.html'.format(subject.full_id))
 
-    if os.path.isfile(report_name):
-        if not REWRITE:
-            logger.debug("{} exists, skipping.".format(report_name))
-            return
-        os.remove(report_name)
+    # With REWRITE an existing report is rebuilt, only re-rendering the
+    # sections for series that have changed (or all of them with FORCE)
+    if os.path.isfile(report_name) and not REWRITE:
+        logger.debug("{} exists, skipping.".format(report_name))
+        return
 
     # header diff
     header_diffs = os.path.join(subject.qc_path, 'header-diff.log')
-    if not os.path.isfile(header_diffs):
-        run_header_qc(subject, config.get_path('std'), header_diffs)
+    run_header_qc(subject, config.get_path('std'), header_diffs)
 
     expected_files = find_expected_files(subject, config)
 
@@ -901,6 +1133,8 @@ def prepare_scan(subject_id, config):
     """
     try:
         subject = datman.scan.Scan(subject_id, config)
+        # misnamed files are only found when the folders are first read
+        subject.niftis
     except datman.scanid.ParseException as e:
         logger.error(e, exc_info=True)
         sys.exit(1)
@@ -940,14 +1174,8 @@ def get_config(study):
 
     return config
 
-def add_server_handler(config):
-    server_ip = config.get_key('LOGSERVER')
-    server_handler = logging.handlers.SocketHandler(server_ip,
-            logging.handlers.DEFAULT_TCP_LOGGING_PORT)
-    logger.addHandler(server_handler)
-
 def main():
-    global REWRITE
+    global REWRITE, FORCE
 
     arguments = docopt(__doc__)
     use_server = arguments['--log-to-server']
@@ -956,12 +1184,16 @@ def main():
     quiet = arguments['--quiet']
     study = arguments['<study>']
     session = arguments['<session>']
-    REWRITE = arguments['--rewrite']
+    FORCE = arguments['--rewrite']
+    REWRITE = FORCE or arguments['--update']
+    executor = arguments['--executor']
+    jobs = int(arguments['--jobs'])
+    chunk_size = int(arguments['--chunk-size'])
 
     config = get_config(study)
 
     if use_server:
-        add_server_handler(config)
+        datman.log_client.add_server_handler(logger, config)
 
     if quiet:
         logger.setLevel(logging.ERROR)
@@ -973,9 +1205,15 @@ def main():
     if session:
         subject = prepare_scan(session, config)
         qc_single_scan(subject, config)
+        compact_checklist(config, blocking=False)
         return
 
-    qc_all_scans(config)
+    if executor not in ['sge', 'local']:
+        logger.error("Unknown executor {}, expected 'sge' or 'local'".format(
+                executor))
+        sys.exit(1)
+
+    qc_all_scans(config, executor, jobs, chunk_size)
 
 if __name__ == "__main__":
     main()
@@ -12,8 +12,23 @@ Options:
     -q --quiet                  Suppress output.
     -v --verbose                Show more output.
     -d --debug                  Show lots of output.
+    --connections N             Number of parallel sftp connections to use
+                                for each MRUSER when copying files
+                                [default: 4]
+    --verify                    Check the integrity of each copied zip file
+                                before moving it into the zips folder
     --dry-run
 
+Files are downloaded to <name>.partial in the zips folder and renamed into
+place once their size matches the remote file (and, with --verify, the zip
+file tests as intact). The remote file's size and modification time are kept
+next to it in <name>.partial.remote. An interrupted download is resumed from
+the end of its .partial file on the next run, but only if the remote file's
+size and modification time haven't changed since. Otherwise the download
+starts over.
+
+The server port can be set with the optional FTPPORT config key (default 22).
+
 """
 from datman.docopt import docopt
 import datman.config
@@ -22,6 +37,13 @@ import logging
 import sys
 import os
 import fnmatch
+import posixpath
+import shutil
+import zipfile
+import stat
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
 import paramiko
 
 logger = logging.getLogger(os.path.basename(__file__))
@@ -34,6 +56,8 @@ def main():
     dryrun = arguments['--dry-run']
     quiet = arguments['--quiet']
     study = arguments['<study>']
+    connections = int(arguments['--connections'])
+    verify = arguments['--verify']
 
     # setup logging
     ch = logging.StreamHandler(sys.stdout)
@@ -62,6 +86,10 @@ def main():
     mrusers = cfg.get_key(['MRUSER'])
     mrfolders = cfg.get_key(['MRFOLDER'])
     mrserver = cfg.get_key(['FTPSERVER'])
+    try:
+        mrport = int(cfg.get_key(['FTPPORT']))
+    except KeyError:
+        mrport = 22
 
     zips_path = cfg.get_path('zips')
     meta_path = cfg.get_path('meta')
@@ -98,22 +126,92 @@ def main():
     assert len(passwords) == len(mrusers), \
         'Each mruser in config should have and entry in the password file'
 
-    for iloc in range(len(mrusers)):
-        mruser = mrusers[iloc]
-        password = passwords[iloc]
-        with pysftp.Connection(mrserver,
-                               username=mruser,
-                               password=password) as sftp:
+    if not mrusers:
+        logger.error('No MRUSER set in the config, nothing to copy')
+        return
+
+    # files found by more than one MRUSER are only copied by the first
+    claimed = ClaimedTargets()
+
+    def pull(credentials):
+        mruser, password = credentials
+        connect_args = {'host': mrserver,
+                        'port': mrport,
+                        'username': mruser,
+                        'password': password}
+        try:
+            pull_files(connect_args, mrfolders, zips_path, connections,
+                       dryrun, verify, claimed)
+        except Exception as e:
+            logger.error('Failed copying files for user:{}. Error:{}'
+                         .format(mruser, str(e)))
+
+    # each MRUSER gets its own connections, so they can all run at once
+    credentials = zip(mrusers, passwords)
+    pool = ThreadPool(len(credentials))
+    try:
+        pool.map(pull, credentials)
+    finally:
+        pool.close()
+        pool.join()
 
-            valid_dirs = get_valid_remote_dirs(sftp, mrfolders)
-            if len(valid_dirs) < 1:
-                logger.error('Source folders:{} not found'.format(mrfolders))
 
-            for valid_dir in valid_dirs:
-                #  process each folder in turn
-                logger.debug('Copying from:{}  to:{}'
-                             .format(valid_dir, zips_path))
-                process_dir(sftp, valid_dir, zips_path)
+class ClaimedTargets(object):
+    """The local paths that files have been queued to be copied to, so that
+    a file name found in more than one remote folder (or by more than one
+    MRUSER) is only copied once rather than by two workers at the same time
+    """
+    def __init__(self):
+        self._targets = set()
+        self._lock = threading.Lock()
+
+    def claim(self, target):
+        """Returns True if target wasn't already claimed"""
+        with self._lock:
+            if target in self._targets:
+                return False
+            self._targets.add(target)
+            return True
+
+
+def pull_files(connect_args, mrfolders, zips_path, connections=1,
+               dryrun=False, verify=False, claimed=None):
+    """Find new files in all of a user's folders that match mrfolders and
+    copy them to zips_path using up to 'connections' parallel connections
+
+    connect_args is a dictionary of keyword arguments for pysftp.Connection
+    claimed is the ClaimedTargets shared with the other users being copied
+    from at the same time, if any
+    """
+    if claimed is None:
+        claimed = ClaimedTargets()
+
+    with pysftp.Connection(**connect_args) as sftp:
+
+        valid_dirs = get_valid_remote_dirs(sftp, mrfolders)
+        if len(valid_dirs) < 1:
+            logger.error('Source folders:{} not found'.format(mrfolders))
+
+        new_files = []
+        for valid_dir in valid_dirs:
+            logger.debug('Copying from:{}  to:{}'
+                         .format(valid_dir, zips_path))
+            for remote_file, target, attributes in process_dir(
+                    sftp, valid_dir, zips_path):
+                if not claimed.claim(target):
+                    logger.warning('Skipping {}, another file is already '
+                                   'being copied to {}'
+                                   .format(remote_file, target))
+                    continue
+                new_files.append((remote_file, target, attributes))
+
+    if dryrun:
+        for remote_file, _, _ in new_files:
+            logger.info('DRYRUN: Skipping copy of new remote file:{}'
+                        .format(remote_file))
+        return
+
+    copy_files(connect_args, new_files, connections, verify)
 
 
 def get_valid_remote_dirs(connection, mrfolders):
@@ -132,38 +230,182 @@ def get_valid_remote_dirs(connection, mrfolders):
 
 def process_dir(connection, directory, zips_path):
     """Process a directory on the ftp server,
-    copy new files to zips_path
+    return a list of (remote_path, local_path, attributes) for files that are
+    new or have been updated since they were last copied to zips_path
+    """
+    try:
+        # one round trip for the names, sizes and mtimes of everything
+        remote_files = connection.listdir_attr(directory)
+    except IOError:
+        # can get this if user doesn't have permission to enter the folder
+        logger.debug('Cant access remote folder:{}, skipping.'
+                     .format(directory))
+        return []
+
+    new_files = []
+    for attributes in remote_files:
+        if not stat.S_ISREG(attributes.st_mode):
+            continue
+        file_name = attributes.filename
+        target = os.path.join(zips_path, file_name)
+        if check_exists_isnewer(attributes, target):
+            new_files.append((posixpath.join(directory, file_name), target,
+                              attributes))
+        else:
+            logger.debug("File:{} already exists, skipping"
+                         .format(file_name))
+    return new_files
+
+
+def copy_files(connect_args, files, connections=1, verify=False):
+    """Copy each (remote_path, local_path, attributes) in files, spreading the
+    work over a number of parallel sftp connections
+    """
+    if not files:
+        return
+
+    queue = Queue.Queue()
+    for item in files:
+        queue.put(item)
+
+    workers = [threading.Thread(target=copy_worker,
+                                args=(connect_args, queue, verify))
+               for _ in range(min(connections, len(files)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def copy_worker(connect_args, queue, verify=False):
+    """Open a connection and copy files from the queue until it is empty"""
+    try:
+        sftp = pysftp.Connection(**connect_args)
+    except Exception as e:
+        logger.error('Failed to connect to server:{} as user:{}. Error:{}'
+                     .format(connect_args.get('host'),
+                             connect_args.get('username'), str(e)))
+        return
+
+    with sftp:
+        while True:
+            try:
+                remote_file, target, attributes = queue.get_nowait()
+            except Queue.Empty:
+                return
+            logger.info('Copying new remote file:{}'.format(remote_file))
+            try:
+                download(sftp, remote_file, target, attributes, verify)
+            except (IOError, OSError) as e:
+                logger.error('Failed to copy remote file:{}. Error:{}'
+                             .format(remote_file, str(e)))
+
+
+def download(sftp, remote_file, target, attributes, verify=False):
+    """Copy remote_file to target through a .partial file.
+
+    If a .partial file is left over from an interrupted copy of the same
+    remote file (same size and modification time, as recorded in the
+    .partial.remote file) the download resumes from its end, otherwise it
+    starts over. The file is only renamed to target once its size matches
+    the remote size (and, if verify is set, a zip file passes its integrity
+    check). Raises IOError if the copy is incomplete or corrupt.
     """
-    with connection.cd(directory):
+    partial = target + '.partial'
+    remote_info = partial + '.remote'
+    remote_version = '{} {}'.format(attributes.st_mtime, attributes.st_size)
+    offset = 0
+    if os.path.isfile(partial):
+        if read_remote_version(remote_info) != remote_version:
+            logger.debug('Remote file:{} changed since the last copy '
+                         'started, starting over'.format(remote_file))
+        elif os.path.getsize(partial) > attributes.st_size:
+            logger.debug('Copy of remote file:{} is too large, starting '
+                         'over'.format(remote_file))
+        else:
+            offset = os.path.getsize(partial)
+            logger.debug('Resuming copy of remote file:{} at byte {}'
+                         .format(remote_file, offset))
+
+    if not offset:
+        with open(remote_info, 'w') as info:
+            info.write(remote_version)
+
+    if offset < attributes.st_size or not os.path.isfile(partial):
+        mode = 'ab' if offset else 'wb'
+        with sftp.open(remote_file, 'rb') as remote, \
+                open(partial, mode) as local:
+            remote.seek(offset)
+            remote.prefetch(attributes.st_size)
+            shutil.copyfileobj(remote, local, 32768)
+
+    size = os.path.getsize(partial)
+    if size != attributes.st_size:
+        if size > attributes.st_size:
+            remove_partial(partial)
+        raise IOError('Copied {} bytes of remote file:{}, expected {}'
+                      .format(size, remote_file, attributes.st_size))
+
+    if verify and target.endswith('.zip'):
         try:
-            files = connection.listdir()
+            check_zip(partial)
         except IOError:
-            # can get this if user doesn't have permission to enter the folder
-            logger.debug('Cant access remote folder:{}, skipping.'
-                         .format(directory))
-            return
-        for file_name in files:
-            target = os.path.join(zips_path, file_name)
-            if check_exists_isnewer(connection, file_name, target):
-                logger.info('Copying new remote file:{}'
-                            .format(file_name))
-                connection.get(file_name, target, preserve_mtime=True)
-            else:
-                logger.debug("File:{} already exists, skipping"
-                             .format(file_name))
-
-def check_exists_isnewer(sftp, filename, target):
+            remove_partial(partial)
+            raise
+
+    os.utime(partial, (attributes.st_atime, attributes.st_mtime))
+    os.rename(partial, target)
+    os.remove(remote_info)
+
+
+def read_remote_version(path):
+    """Returns the remote size and mtime recorded for a .partial file, or
+    None if there isn't a record"""
+    try:
+        with open(path) as info:
+            return info.read().strip()
+    except IOError:
+        return None
+
+
+def remove_partial(partial):
+    """Removes a .partial file and its record of the remote file"""
+    for path in [partial, partial + '.remote']:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def check_zip(path):
+    """Raises IOError (and removes the file) if path isn't an intact zip"""
+    try:
+        with zipfile.ZipFile(path) as archive:
+            bad_member = archive.testzip()
+    except (zipfile.BadZipfile, zipfile.LargeZipFile) as e:
+        bad_member = str(e)
+    if bad_member is not None:
+        os.remove(path)
+        raise IOError('Zip file:{} failed integrity check at {}'
+                      .format(path, bad_member))
+
+
+def check_exists_isnewer(attributes, target):
     """Check if a local copy of the file exists,
     If no local copy exists return True
     If local copy exists and is older than remote return True
-    otherwise return false"""
+    If local copy exists and isnt the same size as remote return True
+    otherwise return false
+
+    attributes is the remote file's SFTPAttributes (from listdir_attr)"""
     if not os.path.isfile(target):
         return True
 
     # check the file modification times
     local_mtime = os.path.getmtime(target)
-    remote_mtime = sftp.stat(filename).st_mtime
-    if local_mtime < remote_mtime:
+    if local_mtime < attributes.st_mtime:
+        return True
+
+    # a truncated copy from before transfers were verified
+    if os.path.getsize(target) != attributes.st_size:
         return True
 
     return False
@@ -20,6 +20,12 @@ Options:
     -c --credfile FILE       File containing XNAT username and password. The username should be on the first line, and password on the next. Overrides the credfile in the project metadata
     -u --username USER       XNAT username. If specified then the credentials file is ignored and you are prompted for password.
     --dont-update-dashboard  Dont update the dashboard database
+    --write-behind           Update the dashboard from a background thread,
+                             so a slow database doesn't hold up downloads.
+                             Any failed updates are listed at the end.
+    --dashboard-stats FILE   Time the dashboard's database queries, and log
+                             the totals for each dashboard method at the end
+                             (also written to FILE as json)
 
 OUTPUT FOLDERS
     Each dicom series will be converted and placed into a subfolder of the
@@ -70,6 +76,8 @@ import datman.utils
 import datman.scanid
 import datman.dashboard
 import datman.exceptions
+import datman.query_stats
+import datman.write_behind
 import getpass
 import os
 import glob
@@ -86,6 +94,7 @@ logger = logging.getLogger(os.path.basename(__file__))
 xnat = None
 cfg = None
 dashboard = None
+db_updates = None   # the queue of dashboard updates, in write-behind mode
 excluded_studies = ['testing']
 DRYRUN = False
 db_ignore = False   # if true dont update the dashboard db
@@ -96,6 +105,7 @@ def main():
     global excluded_studies
     global DRYRUN
     global dashboard
+    global db_updates
 
     arguments = docopt(__doc__)
     verbose = arguments['--verbose']
@@ -107,6 +117,8 @@ def main():
     username = arguments['--username']
     session = arguments['<session>']
     db_ignore = arguments['--dont-update-dashboard']
+    write_behind = arguments['--write-behind']
+    stats_file = arguments['--dashboard-stats']
 
     if arguments['--dry-run']:
         DRYRUN = True
@@ -167,7 +179,18 @@ def main():
     xnat = datman.xnat.xnat(server, username, password)
 
     # setup the dashboard object
-    if not db_ignore:
+    if not db_ignore and stats_file:
+        stats_logger = logging.getLogger('datman.query_stats')
+        stats_logger.setLevel(logging.INFO)
+        stats_logger.addHandler(ch)
+        datman.query_stats.enable(datman.dashboard.db.engine, stats_file)
+
+    if not db_ignore and write_behind:
+        # the dashboard is made in the worker thread, which owns its database
+        # session
+        db_updates = datman.write_behind.WriteBehindQueue(
+                lambda: datman.dashboard.dashboard(study))
+    elif not db_ignore:
         try:
             dashboard = datman.dashboard.dashboard(study)
         except datman.dashboard.DashboardException as e:
@@ -197,8 +220,30 @@ def main():
     logger.info('Found {} sessions for study: {}'
                 .format(len(sessions), study))
 
-    for session in sessions:
-        process_session(session)
+    try:
+        for session in sessions:
+            process_session(session)
+    finally:
+        if db_updates:
+            logger.info('Waiting for dashboard updates to finish')
+            # the worker logs each failed update as it happens
+            db_updates.close()
+
+def update_dashboard(description, task, *args):
+    """
+    Runs task(dashboard, *args), or queues it to run in the background in
+    write-behind mode. Does nothing if the dashboard isn't being updated.
+    """
+    if db_updates:
+        db_updates.put(description, task, *args)
+        return
+    if not dashboard:
+        return
+    try:
+        task(dashboard, *args)
+    except Exception as e:
+        logger.error('Failed dashboard update of {}. Reason: {}'
+                     .format(description, e))
 
 def collect_sessions(xnat_projects, config):
     sessions = []
@@ -283,20 +328,9 @@ def process_session(session):
                        .format(session_label))
         return
 
-    if dashboard:
-        logger.debug('Adding session:{} to db'.format(session_label))
-        try:
-            db_session_name = ident.get_full_subjectid_with_timepoint()
-            db_session = dashboard.get_add_session(db_session_name,
-                                                   date=experiment['data_fields']['date'],
-                                                   create=True)
-            if ident.session and int(ident.session) > 1:
-                db_session.is_repeated = True
-                db_session.repeat_count = int(ident.session)
-
-        except datman.dashboard.DashboardException as e:
-                logger.error('Failed adding session:{} to dashboard'
-                             .format(session_label))
+    update_dashboard('session:{}'.format(session_label),
+                     add_dashboard_session, session_label,
+                     experiment['data_fields']['date'])
 
 
     for data in experiment['children']:
@@ -553,9 +587,9 @@ def process_scans(xnat_project, session_label, experiment_label, scans):
                      .format(cfg.study_name, ident.site))
         return
 
-    # need to keep a list of scans added to dashboard
+    # need to keep a list of scans to add to the dashboard
     # so we can delete any scans that no longer exist
-    scans_added = []
+    scans_found = []
 
     for scan in scans['items']:
         series_id = scan['data_fields']['ID']
@@ -581,14 +615,7 @@ def process_scans(xnat_project, session_label, experiment_label, scans):
                         .format(series_id, session_label))
             continue
 
-        if dashboard:
-            logger.info('Adding scan:{} to dashboard'.format(file_stem))
-            try:
-                dashboard.get_add_scan(file_stem, create=True)
-                scans_added.append(file_stem)
-            except datman.dashboard.DashboardException as e:
-                logger.error('Failed adding scan:{} to dashboard with error:{}'
-                             .format(file_stem, str(e)))
+        scans_found.append(file_stem)
 
         # check the blacklist
         logger.debug('Checking blacklist for file:{}'.format(file_stem))
@@ -652,13 +679,43 @@ def process_scans(xnat_project, session_label, experiment_label, scans):
 
         logger.debug('Completed exports')
 
+    update_dashboard('scans of session:{}'.format(session_label),
+                     update_dashboard_scans, session_label, scans_found)
+
+def add_dashboard_session(dashboard, session_label, date):
+    ident = datman.scanid.parse(session_label)
+    logger.debug('Adding session:{} to db'.format(session_label))
+    db_session_name = ident.get_full_subjectid_with_timepoint()
+    db_session = dashboard.get_add_session(db_session_name, date=date,
+                                           create=True)
+    if db_session is None:
+        raise datman.dashboard.DashboardException('Failed adding session:{}'
+                                                  .format(session_label))
+    if ident.session and int(ident.session) > 1:
+        db_session.is_repeated = True
+        db_session.repeat_count = int(ident.session)
+
+def update_dashboard_scans(dashboard, session_label, scans_found):
+    """
+    Adds all of a session's scans to the dashboard at once, then deletes any
+    extra scans it has for the session.
+    """
+    ident = datman.scanid.parse(session_label)
+    logger.info('Adding {} scans for session:{} to dashboard'.format(
+            len(scans_found), session_label))
+    added = dashboard.get_add_scans(ident.get_full_subjectid_with_timepoint(),
+                                    scans_found, create=True)
+
+    scans_added = []
+    for file_stem in scans_found:
+        if file_stem in added:
+            scans_added.append(file_stem)
+        else:
+            logger.error('Failed adding scan:{} to dashboard'.format(
+                    file_stem))
+
     # finally delete any extra scans that exist in the dashboard
-    if dashboard:
-        try:
-            dashboard.delete_extra_scans(session_label, scans_added)
-        except Exception as e:
-            logger.error('Failed deleting extra scans from session:{} with excuse:{}'
-                         .format(session_label, e))
+    dashboard.delete_extra_scans(session_label, scans_added)
 
 
 def get_dicom_archive_from_xnat(xnat_project, session_label, experiment_label,
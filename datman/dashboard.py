@@ -1,14 +1,18 @@
 """Functions for interacting with the dashboard database"""
 from __future__ import absolute_import
+import os
 import logging
 import dashboard
 #from dashboard.models import Study, Session, Scan, ScanType
 import datman.scanid
 import datman.utils
 import datman.config
+import datman.query_stats
+from datman.query_stats import instrumented
 from datetime import datetime
 from datman.exceptions import DashboardException
 from sqlalchemy import exc
+from sqlalchemy.orm import joinedload
 
 logger = logging.getLogger(__name__)
 db = dashboard.db
@@ -22,22 +26,41 @@ Session_Scan = dashboard.models.Session_Scan
 class dashboard(object):
     study = None
     def __init__(self, study):
+        # scantypes by name, loaded the first time one is needed
+        self._scantypes = None
+        # used to report query stats by study, see datman.query_stats
+        self.study_name = study
+        report_path = os.environ.get(datman.query_stats.STATS_ENV)
+        if report_path and not datman.query_stats.get_stats():
+            datman.query_stats.enable(db.engine, report_path)
         self.set_study(study)
 
+    @instrumented
     def set_study(self, study):
         """Sets the object study"""
         cfg = datman.config.config()
         study_name = cfg.map_xnat_archive_to_project(study)
-        qry = Study.query.filter(Study.nickname == study_name)
-        if qry.count() < 1:
-            logger.error('Study:{} not found in dashboard')
+        # load the study's sites and scantypes with it, they're needed for
+        # every session and scan
+        study = Study.query.options(joinedload(Study.sites),
+                                    joinedload(Study.scantypes)) \
+                           .filter(Study.nickname == study_name) \
+                           .first()
+        if study is None:
+            logger.error('Study:{} not found in dashboard'.format(study_name))
             raise DashboardException("Study not found")
-        self.study = qry.first()
-
-    def get_add_session(self, session_name, date=None, create=False):
+        self.study = study
+        self.study_name = study_name
+        self._sites = dict((site.name, site) for site in study.sites)
+        self._study_scantypes = set(study.scantypes)
+
+    @instrumented
+    def get_add_session(self, session_name, date=None, create=False,
+                        commit=True):
         """Returns a session object, creates one if doesnt exist and create
         is True
-        N.B. a session name is ID without timepoint"""
+        N.B. a session name is ID without timepoint
+        If commit is False the changes are left for the caller to commit"""
         if not self.study:
             logger.error('Study not set')
             return DashboardException('Study not set')
@@ -49,10 +72,8 @@ class dashboard(object):
             raise DashboardException('Invalid session name:{}'
                                       .format(session_name))
 
-        dashboard_site = [site for site
-                          in self.study.sites
-                          if site.name == ident.site]
-        if not dashboard_site:
+        dashboard_site = self._sites.get(ident.site)
+        if dashboard_site is None:
             logger.error('Invalid site:{} in session:{}'
                          .format(ident.site, session_name))
             raise DashboardException('Invalid site')
@@ -65,11 +86,13 @@ class dashboard(object):
                              .format(date, session_name))
                 raise DashboardException('Invalid date')
 
-        qry = Session.query.filter(Session.study == self.study).filter(Session.name == session_name)
+        dashboard_session = Session.query \
+                                   .filter(Session.study == self.study) \
+                                   .filter(Session.name == session_name) \
+                                   .first()
 
-        if qry.count() == 1:
+        if dashboard_session is not None:
             logger.info('Found session:{}'.format(session_name))
-            dashboard_session = qry.first()
             if date:
                 db_session_date = ''
                 xnat_session_date = ''
@@ -92,12 +115,12 @@ class dashboard(object):
                     dashboard_session.date = date
                     db.session.add(dashboard_session)
 
-        elif qry.count() < 1:
+        else:
             logger.info("Session:{} doesnt exist".format(session_name))
             if create:
                 logger.debug('Creating session:{}'.format(session_name))
                 dashboard_session = Session()
-                dashboard_session.site = dashboard_site[0]
+                dashboard_session.site = dashboard_site
                 dashboard_session.name = session_name
                 dashboard_session.study = self.study
                 dashboard_session.date = date
@@ -122,6 +145,8 @@ class dashboard(object):
                 logger.error('Failed updating db comment for session:{}'
                              .format(session_name))
 
+        if not commit:
+            return dashboard_session
         try:
             db.session.commit()
         except Exception as e:
@@ -131,6 +156,7 @@ class dashboard(object):
             return None
         return dashboard_session
 
+    @instrumented
     def get_add_scan(self, scan_name, create=False):
         """Returns a scan object, creates one if doesnt exist and create
         is True"""
@@ -156,11 +182,13 @@ class dashboard(object):
         if ident.session:
             qry = qry.filter(Scan.repeat_number == int(ident.session))
 
-        if qry.count() == 1:
+        # two rows are enough to tell if the scan is unique
+        matches = qry.limit(2).all()
+        if len(matches) == 1:
             logger.debug('Found scan:{} in database'.format(scan_name))
-            dashboard_scan = qry.first()
+            dashboard_scan = matches[0]
 
-        elif qry.count() > 1:
+        elif len(matches) > 1:
             logger.error('Scan:{} was not uniquely identified in the database'
                          .format(scan_name))
             raise DashboardException('Scan not unique')
@@ -181,7 +209,7 @@ class dashboard(object):
             except DashboardException as e:
                 raise(e)
 
-            if not dashboard_scantype in self.study.scantypes:
+            if not dashboard_scantype in self._study_scantypes:
                 logger.error('Scantype:{} not valid for study:{}'
                              .format(dashboard_scantype.name,
                                      self.study.nickname))
@@ -238,6 +266,147 @@ class dashboard(object):
             raise DashboardException
         return(dashboard_scan)
 
+    @instrumented
+    def get_add_scans(self, session_name, scan_names, date=None,
+                      create=False):
+        """Bulk version of get_add_scan for the scans of one session.
+
+        Finds the session (creating it if create is True) and all of the
+        existing scans in one query each, adds any missing scans with a single
+        flush, reads the blacklist once and commits once.
+
+        Returns a dictionary of scan name: scan object for each scan found
+        or created. Scans that can't be added (bad names, unknown scantypes,
+        scans from another session, or scans not uniquely identified) are
+        logged and left out.
+        N.B. a session name is ID without timepoint"""
+        if not self.study:
+            logger.error('Study not set')
+            raise DashboardException('Study not set')
+
+        scans = {}
+        for scan_name in scan_names:
+            try:
+                ident, tag, series, desc = datman.scanid.parse_filename(
+                        scan_name)
+            except datman.scanid.ParseException:
+                logger.error('Invalid scan name:{}'.format(scan_name))
+                continue
+            if ident.get_full_subjectid_with_timepoint() != session_name:
+                logger.error('Scan:{} does not belong to session:{}'
+                             .format(scan_name, session_name))
+                continue
+            repeat = int(ident.session) if ident.session else None
+            scans[scan_name] = ('{}_{}_{}'.format(str(ident), tag, series),
+                                repeat, tag, series, desc)
+        if not scans:
+            return {}
+
+        # everything up to the commit is one transaction, if any of it
+        # fails (e.g. the flush of the new scans) it's rolled back so the
+        # session can still be used
+        try:
+            dashboard_session = self.get_add_session(
+                    session_name, date=date, create=create, commit=False)
+            if dashboard_session is None:
+                return {}
+
+            existing = {}
+            if dashboard_session.id is not None:
+                scan_ids = set(scan[0] for scan in scans.values())
+                qry = db.session.query(Scan) \
+                                .join(Session_Scan) \
+                                .filter(Session_Scan.session_id ==
+                                        dashboard_session.id) \
+                                .filter(Scan.name.in_(scan_ids))
+                for db_scan in qry:
+                    key = (db_scan.name, db_scan.repeat_number)
+                    existing.setdefault(key, []).append(db_scan)
+
+            found = {}
+            missing = []
+            for scan_name, (scan_id, repeat, tag, series, desc) in \
+                    sorted(scans.items()):
+                if repeat is None:
+                    matches = [db_scan for key in existing if key[0] == scan_id
+                               for db_scan in existing[key]]
+                else:
+                    matches = existing.get((scan_id, repeat), [])
+                if len(matches) == 1:
+                    logger.debug('Found scan:{} in database'.format(scan_name))
+                    found[scan_name] = matches[0]
+                elif len(matches) > 1:
+                    logger.error('Scan:{} was not uniquely identified in the '
+                                 'database'.format(scan_name))
+                elif not create:
+                    logger.info('Scan:{} not found but create is false, '
+                                'skipping'.format(scan_name))
+                else:
+                    missing.append(scan_name)
+
+            if missing:
+                new_scans = []
+                for scan_name in missing:
+                    scan_id, repeat, tag, series, desc = scans[scan_name]
+                    try:
+                        dashboard_scantype = self.get_scantype(tag)
+                    except DashboardException:
+                        continue
+                    if dashboard_scantype not in self._study_scantypes:
+                        logger.error('Scantype:{} not valid for study:{}'
+                                     .format(tag, self.study.nickname))
+                        continue
+                    dashboard_scan = Scan()
+                    dashboard_scan.name = scan_id
+                    dashboard_scan.series_number = series
+                    dashboard_scan.scantype = dashboard_scantype
+                    dashboard_scan.description = desc
+                    dashboard_scan.repeat_number = repeat
+                    new_scans.append((scan_name, dashboard_scan))
+
+                db.session.add_all([scan for _, scan in new_scans])
+                # one flush gets the primary keys of the session and every new
+                # scan, so the links can be made
+                db.session.flush()
+
+                for scan_name, dashboard_scan in new_scans:
+                    link = Session_Scan()
+                    link.scan_id = dashboard_scan.id
+                    link.session_id = dashboard_session.id
+                    # Anything entered this way is a primary scan, linked scans
+                    # should come from dm-link-project-scans.py
+                    link.is_primary = True
+                    link.scan_name = dashboard_scan.name
+                    db.session.add(link)
+                    found[scan_name] = dashboard_scan
+
+            bl_comments = datman.utils.get_blacklist_comments(found.keys(),
+                    study=self.study.nickname)
+            for scan_name, dashboard_scan in found.items():
+                bl_comment = bl_comments.get(scan_name)
+                if not bl_comment and dashboard_scan.bl_comment:
+                    # this shouldn't happen but is possible
+                    logger.error('Scan:{} has a blacklist comment in '
+                                 'dashboard db which is not present in '
+                                 'metadata/blacklist.csv. Comment:{}'.format(
+                                 dashboard_scan.name,
+                                 dashboard_scan.bl_comment))
+                elif bl_comment and \
+                        not bl_comment == dashboard_scan.bl_comment:
+                    dashboard_scan.bl_comment = bl_comment
+
+            db.session.commit()
+        except DashboardException:
+            db.session.rollback()
+            raise
+        except Exception as e:
+            db.session.rollback()
+            logger.error('An error occured adding scans for session:{} to the'
+                         ' db. Error:{}'.format(session_name, str(e)))
+            raise DashboardException('Failed adding scans')
+        return found
+
+    @instrumented
     def delete_extra_scans(self, session_label, scanlist):
         """Checks scans associated with session,
         deletes scans not in scanlist.
@@ -262,40 +431,59 @@ class dashboard(object):
             repeat = int(ident.session)
 
         session_label = ident.get_full_subjectid_with_timepoint()
-        db_session = self.get_add_session(session_label)
-        scan_names = []
+        # committed with the deletions, so it isn't re-read after a commit
+        db_session = self.get_add_session(session_label, commit=False)
+        if db_session is None:
+            logger.error('Session:{} not found in dashboard'
+                         .format(session_label))
+            raise DashboardException('Session not found')
+
         # need to convert full scan names to scanid's in the db
+        scan_names = set()
         for scan_name in scanlist:
             try:
-                db_scan = self.get_add_scan(scan_name)
-                scan_names.append(db_scan.name)
-            except:
+                scan_ident, tag, series, _ = datman.scanid.parse_filename(
+                        scan_name)
+            except datman.scanid.ParseException:
                 continue
+            scan_names.add('{}_{}_{}'.format(str(scan_ident), tag, series))
+
+        # get all of the session's scans (and their scantypes) at once
+        links = Session_Scan.query \
+                            .options(joinedload(Session_Scan.scan)
+                                     .joinedload(Scan.scantype)) \
+                            .filter(Session_Scan.session_id == db_session.id) \
+                            .all()
 
         # Need to filter out linked scans and spirals (which are also links,
         # but are considered 'primary' in the database).
-        source_scans = list(filter(lambda x: not is_linked(x), db_session.scans))
-        # need to get the scan objects from the session_scan links
-        session_scans = [link.scan for link in source_scans]
-        db_scans = [scan.name for scan in session_scans if scan.repeat_number == repeat]
-        extra_scans = set(db_scans) - set(scan_names)
-
-        for scan in extra_scans:
-            db_scan = Scan.query.filter(Scan.name == scan).first()
-            db_session_scan_link = Session_Scan.query.filter(Session_Scan.scan_id == db_scan.id,
-                                                             Session_Scan.session_id == db_session.id)
-            db.session.delete(db_session_scan_link.first())
-            db.session.delete(db_scan)
+        extra_links = [link for link in links
+                       if not is_linked(link)
+                       and link.scan.repeat_number == repeat
+                       and link.scan.name not in scan_names]
+
+        # deleted together in one flush when committed
+        for link in extra_links:
+            logger.info('Deleting scan:{} from session:{}'
+                        .format(link.scan.name, session_label))
+            db.session.delete(link)
+            db.session.delete(link.scan)
         db.session.commit()
 
+    @instrumented
     def get_scantype(self, scantype):
-        qry = ScanType.query.filter(ScanType.name == scantype)
-        if qry.count() < 1:
+        if self._scantypes is None:
+            # there are few scantypes, so all are read the first time one is
+            # needed
+            self._scantypes = dict((db_scantype.name, db_scantype)
+                                   for db_scantype in ScanType.query.all())
+        try:
+            return self._scantypes[scantype]
+        except KeyError:
             logger.error('Scantype:{} not found in database'.format(scantype))
             raise DashboardException('Invalid scantype')
-        else:
-            return qry.first()
 
+    @instrumented
     def delete_session(self, session_name):
         session = self.get_add_session(session_name, create=False)
         try:
@@ -321,15 +509,15 @@ def is_linked(scan):
         return True
     return False
 
+@instrumented
 def get_add_session_scan_link(target_session, scan, new_name=None, is_primary=False):
     """
     Creates an entry in the Session_Scans table, linking a scan to session
     """
-    qry = Session_Scan.query.filter(Session_Scan.session == target_session,
-                                    Session_Scan.scan == scan)
-
-    if qry.count() == 1:
-        return qry.first()
+    link = Session_Scan.query.filter(Session_Scan.session == target_session,
+                                     Session_Scan.scan == scan).first()
+    if link is not None:
+        return link
 
     link = Session_Scan()
     link.scan = scan
@@ -0,0 +1,129 @@
+"""
+Compares the series found for a session with the ones expected by the
+study's ExportInfo.
+
+    export_info = config.get_tags(site)
+    expected_files = find_expected_files(subject.niftis, export_info)
+
+    counts = tag_counts({'STUDY_CMH_0001_01': scan1.niftis,
+                         'STUDY_CMH_0002_01': scan2.niftis}, export_info)
+
+Both build their tables in one step from lists of records, rather than adding
+a row at a time, so they stay fast for sessions with many series and for
+whole studies.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ['tag', 'File', 'bookmark', 'Note', 'Sequence']
+# Position given to tags that don't set an 'Order'
+DEFAULT_POSITION = 0
+
+def get_expected(export_info):
+    """
+    Returns a DataFrame indexed by tag with the expected 'count' of each tag
+    and the 'position' it should be sorted to (the lowest of its 'Order'
+    values).
+    """
+    records = []
+    for tag in export_info:
+        try:
+            ordering = export_info.get(tag, 'Order')
+        except KeyError:
+            ordering = [DEFAULT_POSITION]
+        if not isinstance(ordering, list):
+            ordering = [ordering]
+        records.append((tag, export_info.get(tag, 'Count'), min(ordering)))
+    expected = pd.DataFrame.from_records(records,
+            columns=['tag', 'count', 'position'])
+    return expected.set_index('tag')
+
+def find_expected_files(niftis, export_info):
+    """
+    Tabulates the niftis of a session against the expected tags.
+
+    Returns a DataFrame with the columns 'tag', 'File' (the
+    datman.scan.Series, or '' for missing scans), 'bookmark', 'Note' (e.g.
+    'Repeated Scan' or 'missing(2)') and 'Sequence', sorted by 'Sequence'
+    and then acquisition order. Niftis with tags not in export_info are left
+    out.
+    """
+    expected = get_expected(export_info)
+
+    # tabulate found data in the order they were acquired
+    niftis = sorted(niftis, key=lambda item: item.series_num)
+    found = pd.DataFrame({'tag': [nifti.tag for nifti in niftis],
+                          'File': pd.Series(niftis, dtype=object)},
+                         columns=['tag', 'File'])
+    found = found[found['tag'].isin(expected.index)]
+
+    number = found.groupby('tag').cumcount() + 1
+    found['bookmark'] = found['tag'] + number.astype(str)
+    repeated = number.values > expected['count'].reindex(found['tag']).values
+    found['Note'] = np.where(repeated, 'Repeated Scan', '')
+    found['Sequence'] = expected['position'].reindex(found['tag']).values
+
+    # note any missing data
+    counts = found['tag'].value_counts().reindex(expected.index).fillna(0)
+    n_missing = expected['count'] - counts
+    n_missing = n_missing[n_missing > 0]
+    missing = pd.DataFrame({'tag': n_missing.index,
+            'File': '',
+            'bookmark': '',
+            'Note': ['missing({})'.format(int(n)) for n in n_missing.values],
+            'Sequence': expected['position'].reindex(n_missing.index).values},
+            columns=COLUMNS)
+
+    expected_files = pd.concat([found[COLUMNS], missing], ignore_index=True)
+    expected_files = expected_files.sort_values('Sequence', kind='mergesort')
+    return expected_files.reset_index(drop=True)
+
+def tag_counts(subjects, export_info):
+    """
+    Counts the series of each expected tag for many subjects at once.
+
+        subjects:       A dictionary of subject ID: list of datman.scan.Series
+        export_info:    The datman.config.TagInfo the subjects should match
+
+    Returns a DataFrame with one row for each subject and expected tag, with
+    the columns 'subject', 'tag', 'found', 'expected' and 'missing' (the
+    number of series still needed, 0 if there are enough).
+    """
+    expected = get_expected(export_info)['count']
+
+    records = [(subject, series.tag) for subject in subjects
+               for series in subjects[subject]]
+    found = pd.DataFrame.from_records(records, columns=['subject', 'tag'])
+    found = found.groupby(['subject', 'tag']).size()
+
+    index = pd.MultiIndex.from_product([sorted(subjects),
+            sorted(expected.index)], names=['subject', 'tag'])
+    counts = pd.DataFrame({'found': found.reindex(index).fillna(0).astype(int),
+            'expected': expected.reindex(index.get_level_values(
+                    'tag')).values}, index=index,
+            columns=['found', 'expected'])
+    counts['missing'] = (counts['expected'] - counts['found']).clip(lower=0)
+    return counts.reset_index()
+
+def study_tag_counts(scans, config):
+    """
+    Runs tag_counts() for a list of datman.scan.Scan instances from any
+    number of sites, using each site's ExportInfo. Returns one DataFrame.
+    """
+    by_site = {}
+    for scan in scans:
+        by_site.setdefault(scan.site, {})[scan.id_plus_session] = scan.niftis
+
+    counts = []
+    for site in sorted(by_site):
+        site_counts = tag_counts(by_site[site], config.get_tags(site))
+        site_counts.insert(0, 'site', site)
+        counts.append(site_counts)
+    if not counts:
+        return pd.DataFrame(columns=['site', 'subject', 'tag', 'found',
+                'expected', 'missing'])
+    return pd.concat(counts, ignore_index=True)
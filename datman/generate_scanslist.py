@@ -3,19 +3,28 @@
 Given a directory to unprocessed archives (directly from MR server), generate a scans.csv file.
 Assumptions:
 1. All sessions are named incorrectly and thus should all be added to the scans.csv file.
-2. No follow-up or repeat scans. If you notice duplicate patient names, you must compare the dates manually. This will be done automatically in a future update.
+2. No follow-up or repeat scans. If a patient name appears in more than one archive, the sessions are assigned timepoints in order of their study date and time.
 
 Usage:
-    generate_scanslist.py <archive_dir> <study_name> <site_name>
+    generate_scanslist.py [options] <archive_dir> <study_name> <site_name>
 
+Options:
+    --jobs N        Number of archives to read headers from in parallel
+                    [default: 4]
 
 """
 
 import os
 import glob
 import csv
+import zipfile
+import tarfile
 from docopt import docopt
-import subprocess
+from multiprocessing import Pool
+
+import dicom
+
+import datman.utils
 
 class Session:
     def __init__(self, p_name, s_id, date, time, a_name, timepoint):
@@ -26,41 +35,81 @@ class Session:
         self.a_name = a_name
         self.timepoint = timepoint
 
+def read_session(archive):
+    """
+    Reads the exam details from the dicom headers of an archive.
+
+    Returns a tuple of the Session (None if it couldn't be read) and the
+    reason it couldn't be read.
+    """
+    if not (os.path.isdir(archive) or zipfile.is_zipfile(archive) or
+            archive.endswith('.tar.gz')):
+        return None, "not a zip file, tarball or folder"
+    try:
+        manifest = datman.utils.get_archive_headers(archive,
+                                                    stop_after_first=True)
+    except (IOError, OSError, zipfile.BadZipfile, tarfile.TarError,
+            dicom.errors.InvalidDicomError) as e:
+        return None, "can't read headers: {}".format(e)
+    if not manifest:
+        return None, "no dicoms found"
+    header = manifest.values()[0]
+    values = [str(header.get(field, "")) for field in
+              ['PatientName', 'StudyID', 'StudyDate', 'StudyTime']]
+    return Session(values[0], values[1], values[2], values[3],
+                   os.path.basename(archive).split(".")[0], "01"), None
+
+def read_sessions(archives, jobs=1):
+    """
+    Reads the exam details of each archive in a pool of worker processes.
+
+    Returns a list of Sessions in the same order as archives, archives that
+    can't be read are reported and left out.
+    """
+    if jobs < 2 or len(archives) < 2:
+        results = [read_session(archive) for archive in archives]
+    else:
+        pool = Pool(min(jobs, len(archives)))
+        try:
+            results = pool.map(read_session, archives, chunksize=8)
+        finally:
+            pool.close()
+            pool.join()
+    sessions = []
+    for archive, (session, reason) in zip(archives, results):
+        if session is None:
+            print "Skipping {}, {}".format(archive, reason)
+        else:
+            sessions.append(session)
+    return sessions
+
+def assign_timepoints(session_list):
+    """
+    Numbers the timepoints of each patient's sessions in order of study date
+    and time.
+    """
+    by_patient = {}
+    for session in session_list:
+        by_patient.setdefault(session.p_name, []).append(session)
+
+    for sessions in by_patient.values():
+        sessions.sort(key=lambda x: (x.date, x.time))
+        for num, session in enumerate(sessions, 1):
+            session.timepoint = "{:02d}".format(num)
+
 if __name__ == '__main__':
     args = docopt(__doc__)
     curr_dir = os.getcwd()
     study = args["<study_name>"]
     site = args["<site_name>"]
+    jobs = int(args["--jobs"])
     with open(os.path.join(curr_dir, "scans.csv"),"wb") as outfile:
         writer = csv.writer(outfile, delimiter=" ")
         writer.writerow(["source_name", "target_name", "dicom_PatientName", "dicom_StudyID"])
-        archives = glob.glob(os.path.join(args['<archive_dir>'], "*.zip"))
-        repeat_set = set()
-        session_list = []
-        for archive in archives:
-            #TODO: --headers=StudyDate,StudyTime and compare these to automatically assign repeats
-            header_vals = subprocess.check_output(["archive-manifest.py", "--headers=PatientName,StudyID,StudyDate,StudyTime", "--oneseries", archive])
-            reader = csv.reader(header_vals.splitlines())
-            #Skip header line
-            reader.next()
-            patient_vals = reader.next()
-            #Order that archive-manifest returns these is not the expected order, thus the unexpected indicies below
-            curr_patient = Session(patient_vals[1], patient_vals[3], patient_vals[2], patient_vals[4], os.path.basename(archive).split(".")[0], "01")
-            print curr_patient.p_name
-
-            if curr_patient.p_name in repeat_set:
-                match = [x for x in session_list if x.p_name == curr_patient.p_name]
-                if match[0].date < curr_patient.date or (match[0].date == curr_patient.date and match[0].time < curr_patient.time):
-                    match[0].timepoint = "01"
-                    curr_patient.timepoint = "02"
-                else:
-                    match[0].timepoint ="02"
-                    curr_patient.timepoint = "01"
-            else:
-                repeat_set.add(curr_patient.p_name)
-            session_list.append(curr_patient)
+        archives = sorted(glob.glob(os.path.join(args['<archive_dir>'], "*.zip")))
+        session_list = read_sessions(archives, jobs)
+        for session in session_list:
+            print session.p_name
+        assign_timepoints(session_list)
         for session in session_list:
             writer.writerow([session.a_name, study + "_" + site + "_" + session.p_name.upper() + "_" + session.timepoint + "_01", session.p_name, session.s_id])
-
-
-
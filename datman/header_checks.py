@@ -0,0 +1,301 @@
+"""
+Compares the dicom headers of a session against the gold standard dicoms for
+its site, without calling out to qcmon's qc-headers.
+
+The gold standards are the dicoms in a study's 'std' folder, named with the
+datman convention so the site and tag they belong to can be found. They are
+read once per process and kept in memory, so checking many sessions (or
+many series in one session) only reads each standard once.
+
+Differences are written to header-diff.log one per line, each starting with
+the path of the dicom so dm_qc_report.py can match them to a series:
+
+    /path/to/STUDY_SITE_0001_01_01_T1_02_SagT1.dcm: header EchoTime, expected = 2.9, actual = 3.1
+
+Every field present in the standard is compared except those in
+IGNORED_FIELDS (identifiers, dates and times and other values expected to
+change between sessions) and sequences. Numeric values match if they are
+within 'tolerance' of each other.
+
+    comparisons = get_comparisons(subject, config.get_path('std'))
+    check_headers(comparisons, log_file)
+"""
+import os
+import glob
+import logging
+from multiprocessing import Pool
+
+import dicom as dcm
+
+import datman.scan
+import datman.scanid
+import datman.qc_cache
+
+logger = logging.getLogger(__name__)
+
+# Name used to record logs made by this module in each subject's QC cache
+TOOL = 'datman-headers'
+
+IGNORED_FIELDS = set([
+        'AccessionNumber', 'AcquisitionDate', 'AcquisitionDateTime',
+        'AcquisitionNumber', 'AcquisitionTime', 'ContentDate', 'ContentTime',
+        'DeviceSerialNumber', 'FrameOfReferenceUID', 'ImageComments',
+        'ImageOrientationPatient', 'ImagePositionPatient', 'ImagesInAcquisition',
+        'InstanceCreationDate', 'InstanceCreationTime', 'InstanceNumber',
+        'LargestImagePixelValue', 'OperatorsName', 'PatientAge',
+        'PatientBirthDate', 'PatientID', 'PatientName', 'PatientSex',
+        'PatientSize', 'PatientWeight', 'PerformedProcedureStepDescription',
+        'PerformedProcedureStepID', 'PerformedProcedureStepStartDate',
+        'PerformedProcedureStepStartTime', 'PixelData', 'ReferringPhysicianName',
+        'RequestingPhysician', 'SOPInstanceUID', 'SeriesDate',
+        'SeriesDescription', 'SeriesInstanceUID', 'SeriesNumber', 'SeriesTime',
+        'SliceLocation', 'SmallestImagePixelValue', 'StudyDate',
+        'StudyDescription', 'StudyID', 'StudyInstanceUID', 'StudyTime',
+        'WindowCenter', 'WindowWidth'])
+
+DEFAULT_TOLERANCE = 0.001
+
+_standards = {}
+_headers = {}
+
+class HeaderCheckError(Exception):
+    pass
+
+def get_standards(standard_dir, site):
+    """
+    Returns a dictionary of tag: datman.scan.Series for every gold standard
+    in standard_dir that belongs to site. The standards folder is only
+    searched once.
+    """
+    return load_standards(standard_dir).get(site, {})
+
+def load_standards(standard_dir):
+    """
+    Returns find_standards(standard_dir), only searching the folder the first
+    time it's requested.
+    """
+    standard_dir = os.path.abspath(standard_dir)
+    try:
+        return _standards[standard_dir]
+    except KeyError:
+        _standards[standard_dir] = find_standards(standard_dir)
+        return _standards[standard_dir]
+
+def find_standards(standard_dir):
+    """
+    Reads the names of the files in standard_dir. Returns a dictionary of
+    site: {tag: datman.scan.Series}.
+
+    Files that don't match the datman naming convention are logged and
+    ignored.
+    """
+    standards = {}
+    misnamed_files = []
+    for item in glob.glob(os.path.join(standard_dir, "*")):
+        try:
+            standard = datman.scan.Series(item)
+        except datman.scanid.ParseException:
+            misnamed_files.append(item)
+            continue
+        standards.setdefault(standard.site, {})[standard.tag] = standard
+
+    if misnamed_files:
+        logger.error("Standards files misnamed, ignoring: \n" \
+                "{}".format("\n".join(misnamed_files)))
+
+    return standards
+
+def read_header(path):
+    """
+    Returns a dictionary of field name: value for every element (other than
+    sequences) in a dicom's header. The pixel data is never read.
+    """
+    header = dcm.read_file(path, stop_before_pixels=True)
+    values = {}
+    for field in header.dir():
+        try:
+            element = header.data_element(field)
+        except Exception:
+            continue
+        if element is None or element.VR == 'SQ':
+            continue
+        values[field] = element.value
+    return values
+
+def get_standard_header(path):
+    """
+    Returns read_header(path), reading the file only the first time each
+    version of it is requested.
+    """
+    mtime = os.path.getmtime(path)
+    try:
+        cached_mtime, header = _headers[path]
+    except KeyError:
+        cached_mtime = None
+    if cached_mtime != mtime:
+        header = read_header(path)
+        _headers[path] = (mtime, header)
+    return header
+
+def values_match(expected, actual, tolerance=DEFAULT_TOLERANCE):
+    """
+    Returns True if two header values are the same. Numbers (including
+    numeric strings) only need to be within tolerance of each other and
+    multi-valued fields must match element by element.
+    """
+    if isinstance(expected, (list, tuple)) or isinstance(actual,
+            (list, tuple)):
+        if not (isinstance(expected, (list, tuple)) and
+                isinstance(actual, (list, tuple))):
+            return False
+        if len(expected) != len(actual):
+            return False
+        return all(values_match(exp, act, tolerance)
+                   for exp, act in zip(expected, actual))
+    try:
+        return abs(float(expected) - float(actual)) <= tolerance
+    except (TypeError, ValueError):
+        return str(expected).strip() == str(actual).strip()
+
+def compare_headers(dicom_path, standard_path, ignore=IGNORED_FIELDS,
+        tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares a dicom's header to its gold standard. Returns a list of log
+    lines, one for each field that differs.
+    """
+    standard = get_standard_header(standard_path)
+    header = read_header(dicom_path)
+
+    differences = []
+    for field in sorted(standard):
+        if field in ignore:
+            continue
+        expected = standard[field]
+        if field not in header:
+            differences.append("{}: header {} missing, expected = {}".format(
+                    dicom_path, field, expected))
+            continue
+        actual = header[field]
+        if not values_match(expected, actual, tolerance):
+            differences.append("{}: header {}, expected = {}, actual = "
+                    "{}".format(dicom_path, field, expected, actual))
+    return differences
+
+def get_comparisons(subject, standard_dir):
+    """
+    Returns a list of (dicom path, standard path) for each of a subject's
+    dicoms that has a gold standard.
+    """
+    standards = get_standards(standard_dir, subject.site)
+    comparisons = []
+    for dicom in subject.dicoms:
+        try:
+            standard = standards[dicom.tag]
+        except KeyError:
+            logger.debug('No standard with tag {} found in {}'.format(
+                    dicom.tag, standard_dir))
+            continue
+        comparisons.append((dicom.path, standard.path))
+    return comparisons
+
+def check_headers(comparisons, log_file, ignore=IGNORED_FIELDS,
+        tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares each (dicom, standard) pair and writes any differences to
+    log_file, replacing its previous contents. Like qc-headers, the log is
+    only made if there is at least one comparison. Returns the number of
+    differences found.
+
+    If any comparison can't be made, the differences from the others are
+    still written and then HeaderCheckError is raised, so the log isn't
+    taken as complete.
+    """
+    if not comparisons:
+        return 0
+
+    differences = []
+    failed = []
+    for dicom_path, standard_path in comparisons:
+        try:
+            differences.extend(compare_headers(dicom_path, standard_path,
+                    ignore, tolerance))
+        except Exception as e:
+            logger.error("Failed to compare {} to {}. Reason: {}".format(
+                    dicom_path, standard_path, e))
+            failed.append(dicom_path)
+
+    with open(log_file, 'w') as log:
+        for line in differences:
+            log.write(line + '\n')
+    if failed:
+        raise HeaderCheckError("Failed to compare {} of {} dicoms to their "
+                "standards: {}".format(len(failed), len(comparisons),
+                ", ".join(failed)))
+    return len(differences)
+
+def check_subject(subject, standard_dir, rewrite=False):
+    """
+    Writes header-diff.log for a datman.scan.Scan if it doesn't exist or
+    is out of date with the subject's dicoms and standards. Returns the path
+    to the log, or None if no comparisons could be made.
+    """
+    log_file = os.path.join(subject.qc_path, 'header-diff.log')
+    comparisons = get_comparisons(subject, standard_dir)
+    if not comparisons:
+        return None
+
+    inputs = sorted(set(path for pair in comparisons for path in pair))
+    cache = datman.qc_cache.get_cache(subject.qc_path)
+    tool = datman.qc_cache.tool_version(TOOL)
+    if not rewrite and cache.is_current(log_file, inputs, tool):
+        logger.debug("{} is up to date, skipping.".format(log_file))
+        return log_file
+
+    if not os.path.isdir(subject.qc_path):
+        os.makedirs(subject.qc_path)
+    check_headers(comparisons, log_file)
+    cache.update(log_file, inputs, tool)
+    return log_file
+
+def _check_session(args):
+    session, config, rewrite = args
+    try:
+        subject = datman.scan.Scan(session, config)
+        check_subject(subject, config.get_path('std'), rewrite)
+    except Exception as e:
+        logger.error("Header check failed for {}. Reason: {}".format(session,
+                e))
+        return False
+    return True
+
+def check_study(config, sessions=None, jobs=1, rewrite=False):
+    """
+    Checks the headers of every session in the study's dicom folder (or only
+    the given sessions) against the study's gold standards, in a pool of
+    'jobs' processes. Returns a list of the sessions that failed.
+    """
+    if sessions is None:
+        sessions = sorted(os.listdir(config.get_path('dcm')))
+
+    # Read every standard before forking so each worker shares them
+    for site_standards in load_standards(config.get_path('std')).values():
+        for standard in site_standards.values():
+            try:
+                get_standard_header(standard.path)
+            except Exception as e:
+                logger.error("Can't read standard {}. Reason: {}".format(
+                        standard.path, e))
+
+    job_args = [(session, config, rewrite) for session in sessions]
+    if jobs < 2 or len(sessions) < 2:
+        results = [_check_session(args) for args in job_args]
+    else:
+        pool = Pool(jobs)
+        try:
+            results = pool.map(_check_session, job_args)
+        finally:
+            pool.close()
+            pool.join()
+
+    return [session for session, success in zip(sessions, results)
+            if not success]
@@ -0,0 +1,273 @@
+"""
+Keeps an index of every datman named file in a project's data folders (nii,
+dcm, mnc, nrrd) in a SQLite database, so tools can look files up by tag,
+subject or format without walking and parsing the whole tree each time.
+
+    index = datman.index.get_index(config)
+    index.update()
+    for entry in index.find(tag='PDT2', format='nii'):
+        print(entry.path)
+
+The index is kept in metadata/.file_index.sqlite. If that can't be written
+(e.g. a read-only metadata folder) the index is kept in memory instead, and
+the folders are read in full each run. Each row holds the path,
+format folder, session folder, the parsed name (study, site, subject,
+timepoint, session, tag, series, description) and the size and mtime of the
+file.
+
+update() is incremental: each format folder and its session folders are
+listed once, and only session folders whose mtime changed since the last
+update (i.e. files were added, removed or renamed) are re-read. Files that
+are rewritten in place don't change their folder's mtime, so their size and
+mtime in the index may be out of date until something else in the folder
+changes. Files whose names don't follow the datman convention aren't
+indexed.
+"""
+import os
+import sqlite3
+import logging
+from collections import namedtuple
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+import datman.scanid as scanid
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = '.file_index.sqlite'
+FORMATS = ['nii', 'dcm', 'mnc', 'nrrd']
+COLUMNS = ['path', 'format', 'folder', 'study', 'site', 'subject',
+        'timepoint', 'session', 'tag', 'series', 'description', 'size',
+        'mtime']
+
+Entry = namedtuple('Entry', COLUMNS)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    format TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    study TEXT,
+    site TEXT,
+    subject TEXT,
+    timepoint TEXT,
+    session TEXT,
+    tag TEXT,
+    series TEXT,
+    description TEXT,
+    size INTEGER,
+    mtime REAL
+);
+CREATE INDEX IF NOT EXISTS files_tag ON files (tag);
+CREATE INDEX IF NOT EXISTS files_subject
+    ON files (study, site, subject, timepoint, session);
+CREATE INDEX IF NOT EXISTS files_format ON files (format);
+CREATE INDEX IF NOT EXISTS files_folder ON files (folder);
+CREATE TABLE IF NOT EXISTS folders (
+    path TEXT PRIMARY KEY,
+    format TEXT NOT NULL,
+    mtime REAL
+);
+"""
+
+_indexes = {}
+
+def get_index(config, db_path=None):
+    """
+    Returns the FileIndex for the config's current study, opening it the
+    first time it's requested. Format folders not set in the config are
+    left out.
+    """
+    folders = {}
+    for fmt in FORMATS:
+        try:
+            folders[fmt] = config.get_path(fmt)
+        except KeyError:
+            continue
+    if db_path is None:
+        db_path = os.path.join(config.get_path('meta'), INDEX_NAME)
+    db_path = os.path.abspath(db_path)
+
+    try:
+        return _indexes[db_path]
+    except KeyError:
+        index = open_index(db_path, folders)
+        _indexes[db_path] = index
+        return index
+
+def is_writable(db_path):
+    # SQLite writes its journal next to the database, so the folder has to
+    # be writable too
+    if os.path.exists(db_path) and not os.access(db_path, os.W_OK):
+        return False
+    return os.access(os.path.dirname(db_path), os.W_OK)
+
+def open_index(db_path, folders):
+    """
+    Returns the FileIndex kept at db_path, or one kept in memory if db_path
+    can't be written to.
+    """
+    if is_writable(db_path):
+        try:
+            return FileIndex(db_path, folders)
+        except sqlite3.Error as e:
+            reason = e
+    else:
+        reason = "not writable"
+    logger.warning("Can't keep the file index in {} ({}), keeping it in "
+            "memory for this run instead".format(db_path, reason))
+    return FileIndex(':memory:', folders)
+
+def parse_entry(fmt, folder, entry):
+    """
+    Returns the index row for a directory entry, or None if it isn't a file
+    with a datman style name (or is a broken link).
+    """
+    try:
+        ident, tag, series, description = scanid.parse_filename(entry.name)
+    except scanid.ParseException:
+        return None
+    try:
+        if not entry.is_file():
+            return None
+        stat = entry.stat()
+    except OSError:
+        logger.debug("Can't read {}, not indexing it".format(entry.path))
+        return None
+    return (entry.path, fmt, folder, ident.study, ident.site, ident.subject,
+            ident.timepoint, ident.session, tag, series, description,
+            stat.st_size, stat.st_mtime)
+
+def list_folders(path):
+    """
+    Returns a list of (path, mtime) for each folder inside path.
+    """
+    folders = []
+    try:
+        entries = list(scandir(path))
+    except OSError:
+        logger.debug("Can't read {}, skipping it".format(path))
+        return folders
+    for entry in entries:
+        try:
+            if entry.is_dir():
+                folders.append((entry.path, entry.stat().st_mtime))
+        except OSError:
+            continue
+    return folders
+
+class FileIndex(object):
+    """
+    The index of the datman named files in a project.
+
+        db_path:    The SQLite database to keep the index in. It's made if
+                    it doesn't exist.
+        folders:    A dictionary of format name: path to the folder holding
+                    that format's session folders.
+    """
+    def __init__(self, db_path, folders):
+        self.db_path = db_path
+        self.folders = dict((fmt, os.path.abspath(path))
+                for fmt, path in folders.items())
+        # Several processes may update a project's index at once, wait for
+        # each other's transactions rather than failing
+        self._db = sqlite3.connect(db_path, timeout=60)
+        # Give paths back as plain strings, like os.listdir
+        self._db.text_factory = str
+        self._db.executescript(SCHEMA)
+
+    def update(self):
+        """
+        Brings the index up to date with the format folders. Returns the
+        number of session folders that were re-read or dropped.
+        """
+        changed = 0
+        with self._db:
+            known = dict(self._db.execute('SELECT path, mtime FROM folders'))
+            found = set()
+            for fmt in sorted(self.folders):
+                for folder, mtime in list_folders(self.folders[fmt]):
+                    found.add(folder)
+                    if known.get(folder) == mtime:
+                        continue
+                    self._index_folder(fmt, folder, mtime)
+                    changed += 1
+            for folder in set(known) - found:
+                logger.debug("{} no longer exists, dropping it from the "
+                        "index".format(folder))
+                self._drop_folder(folder)
+                changed += 1
+        logger.debug("Updated {} folders in {}".format(changed, self.db_path))
+        return changed
+
+    def find(self, tag=None, subject=None, format=None, site=None,
+            folder=None):
+        """
+        Returns a list of Entry for every indexed file matching all of the
+        given criteria, sorted by path.
+
+            tag:        A tag or list of tags
+            subject:    A datman subject ID. The session is only matched if
+                        it's included.
+            format:     A format folder name or list of them (e.g. 'nii')
+            site:       A site code
+            folder:     The path to a session folder
+        """
+        clauses = []
+        values = []
+        for column, value in [('tag', tag), ('format', format)]:
+            if value is None:
+                continue
+            if not isinstance(value, (list, tuple, set)):
+                value = [value]
+            clauses.append('{} IN ({})'.format(column,
+                    ', '.join('?' * len(value))))
+            values.extend(value)
+        if subject is not None:
+            ident = scanid.parse(subject)
+            fields = [('study', ident.study), ('site', ident.site),
+                      ('subject', ident.subject),
+                      ('timepoint', ident.timepoint)]
+            if ident.session:
+                fields.append(('session', ident.session))
+            for column, value in fields:
+                clauses.append('{} = ?'.format(column))
+                values.append(value)
+        if site is not None:
+            clauses.append('site = ?')
+            values.append(site)
+        if folder is not None:
+            clauses.append('folder = ?')
+            values.append(os.path.abspath(folder))
+
+        query = 'SELECT {} FROM files'.format(', '.join(COLUMNS))
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        query += ' ORDER BY path'
+        return [Entry(*row) for row in self._db.execute(query, values)]
+
+    def close(self):
+        self._db.close()
+        _indexes.pop(self.db_path, None)
+
+    def _index_folder(self, fmt, folder, mtime):
+        logger.debug("Indexing {}".format(folder))
+        self._db.execute('DELETE FROM files WHERE folder = ?', (folder,))
+        try:
+            entries = list(scandir(folder))
+        except OSError as e:
+            logger.error("Can't index {}. Reason: {}".format(folder, e))
+            entries = []
+        rows = [parse_entry(fmt, folder, entry) for entry in entries]
+        self._db.executemany('INSERT OR REPLACE INTO files VALUES '
+                '({})'.format(', '.join('?' * len(COLUMNS))),
+                [row for row in rows if row is not None])
+        self._db.execute('INSERT OR REPLACE INTO folders VALUES (?, ?, ?)',
+                (folder, fmt, mtime))
+
+    def _drop_folder(self, folder):
+        self._db.execute('DELETE FROM files WHERE folder = ?', (folder,))
+        self._db.execute('DELETE FROM folders WHERE path = ?', (folder,))
@@ -0,0 +1,236 @@
+"""
+Sends a script's logging to the datman log server (bin/dm_log_server.py)
+without holding the script up when the server is slow or down.
+
+    datman.log_client.add_server_handler(logger, config)
+
+Log calls only put the record on a bounded queue. A background thread takes
+the waiting records off the queue, up to 'batch_size' at a time, and sends
+each batch to the server in one write. If the queue is full (the server
+can't keep up) or a batch can't be sent, the records are written to a spool
+file in the folder set as LOG_SPOOL_DIR in the site config instead, or
+dropped if it isn't set. Either way the script carries on. The number of
+records spooled or dropped is logged when the handler is closed (which
+logging does at exit).
+
+Processes forked after the handler is added (e.g. multiprocessing pool
+workers) start their own background thread the first time they log, and send
+what's left before they exit.
+"""
+import os
+import copy
+import socket
+import logging
+import logging.handlers
+import threading
+import datetime
+import multiprocessing.util
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+logger = logging.getLogger(__name__)
+
+# The log server's format, with the time since spooled records are read later
+FORMAT = logging.Formatter("%(asctime)s [%(name)s] %(levelname)s: "
+        "%(message)s")
+
+# Marks the end of the records for the listener
+_STOP = object()
+
+class Spool(object):
+    """
+    Keeps the records that couldn't be sent, in a file at path, or counts
+    them as dropped if path is None.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.spooled = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def write(self, records):
+        with self._lock:
+            if self.path is None:
+                self.dropped += len(records)
+                return
+            try:
+                with open(self.path, 'a') as spool:
+                    spool.write(''.join(FORMAT.format(record) + '\n'
+                            for record in records))
+            except IOError:
+                self.dropped += len(records)
+            else:
+                self.spooled += len(records)
+
+    def report(self):
+        if self.spooled:
+            logger.warning("{} log records couldn't be sent to the log "
+                    "server, they were saved to {}".format(self.spooled,
+                    self.path))
+        if self.dropped:
+            logger.warning("{} log records couldn't be sent to the log "
+                    "server and were dropped".format(self.dropped))
+
+class BatchSocketHandler(logging.handlers.SocketHandler):
+    """
+    A SocketHandler that can send many records in one write.
+    """
+    def send_batch(self, records):
+        """
+        Sends records to the server, returns False if they couldn't be
+        sent.
+        """
+        self.send(''.join(self.makePickle(record) for record in records))
+        # SocketHandler.send drops the socket when it fails (and while
+        # waiting to retry a failed connection)
+        return self.sock is not None
+
+class QueueListener(object):
+    """
+    Sends the records put on record_queue from a background thread.
+
+        record_queue:   The queue records are put on.
+        handler:        The BatchSocketHandler to send them with.
+        spool:          The Spool to keep records that couldn't be sent.
+        batch_size:     The most records to send at once.
+    """
+    def __init__(self, record_queue, handler, spool, batch_size=100):
+        self.queue = record_queue
+        self.handler = handler
+        self.spool = spool
+        self.batch_size = batch_size
+        self._thread = None
+
+    def copy(self, record_queue, spool):
+        """
+        Returns a new listener for record_queue with its own connection to
+        the server.
+        """
+        return QueueListener(record_queue, BatchSocketHandler(
+                self.handler.host, self.handler.port), spool,
+                self.batch_size)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='log-client')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        """
+        Sends what's left on the queue (waiting at most timeout seconds)
+        and stops the thread.
+        """
+        if self._thread is None:
+            return
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        self._thread = None
+        self.handler.close()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = _STOP in batch
+            records = [record for record in batch if record is not _STOP]
+            if records:
+                self._send(records)
+            if stop:
+                return
+
+    def _send(self, records):
+        try:
+            sent = self.handler.send_batch(records)
+        except Exception:
+            sent = False
+        if not sent:
+            self.spool.write(records)
+
+class QueueHandler(logging.Handler):
+    """
+    Puts records on record_queue for a QueueListener, or gives them to
+    spool if the queue is full. Never waits.
+    """
+    def __init__(self, record_queue, spool, listener=None):
+        logging.Handler.__init__(self)
+        self.queue = record_queue
+        self.spool = spool
+        self.listener = listener
+        self._pid = os.getpid()
+
+    def _check_process(self):
+        if self._pid == os.getpid():
+            return
+        # This is a forked copy, which has the queue but not the thread
+        # sending from it (and may have copied a lock while it was held)
+        self._pid = os.getpid()
+        self.queue = queue.Queue(self.queue.maxsize)
+        self.spool = Spool(self.spool.path)
+        if self.listener is not None:
+            self.listener = self.listener.copy(self.queue, self.spool)
+            self.listener.start()
+            # Forked multiprocessing workers exit without running atexit
+            multiprocessing.util.Finalize(None, self.close, exitpriority=10)
+
+    def prepare(self, record):
+        # Fill in the message and traceback now, the arguments may change
+        # (and the traceback is gone) by the time the record is sent. This
+        # is done to a copy, the other handlers still need the original.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = FORMAT.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self._check_process()
+            record = self.prepare(record)
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.spool.write([record])
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+            self.spool.report()
+        logging.Handler.close(self)
+
+def get_spool_path(config, name):
+    try:
+        spool_dir = config.get_key('LOG_SPOOL_DIR')
+    except KeyError:
+        return None
+    name = name.replace('.py', '')
+    return os.path.join(spool_dir, '{}-{}-{}-{}.log'.format(
+            datetime.date.today(), name, socket.gethostname(), os.getpid()))
+
+def add_server_handler(log, config, maxsize=1000, batch_size=100):
+    """
+    Sends the records given to log to the log server set as LOGSERVER in the
+    config, and returns the QueueHandler added to log.
+    """
+    server_ip = config.get_key('LOGSERVER')
+    spool = Spool(get_spool_path(config, log.name))
+    record_queue = queue.Queue(maxsize)
+    listener = QueueListener(record_queue, BatchSocketHandler(server_ip,
+            logging.handlers.DEFAULT_TCP_LOGGING_PORT), spool, batch_size)
+    handler = QueueHandler(record_queue, spool, listener)
+    listener.start()
+    log.addHandler(handler)
+    return handler
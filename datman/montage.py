@@ -0,0 +1,126 @@
+"""
+Renders slice montages of nifti images without calling out to FSL.
+
+The montages mimic the output of FSL's 'slicer <image> -S <gap> <width> <png>':
+every <gap>th axial slice is tiled left to right, top to bottom, into an
+image that is <width> pixels wide. Images are read with nibabel, so
+uncompressed niftis are memory-mapped and only the first volume of a 4D image
+is ever read.
+
+    render('sub_T1.nii.gz', 'sub_T1.png', 5, 1600)
+
+    render_batch([('sub_RST.nii.gz', 'sub_RST_raw.png', 2, 600),
+                  ('sub_RST_sfnr.nii.gz', 'sub_RST_sfnr.png', 2, 600)])
+"""
+import logging
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import nibabel as nib
+import PIL.Image
+
+logger = logging.getLogger(__name__)
+
+def load_volume(path):
+    """
+    Returns the first 3D volume of a nifti image as an array reoriented to RAS,
+    so that the third axis runs from inferior to superior.
+    """
+    img = nib.load(path)
+    if len(img.shape) > 3:
+        # Slicing the proxy only reads the one volume from disk
+        index = (slice(None),) * 3 + (0,) * (len(img.shape) - 3)
+        data = np.asarray(img.dataobj[index])
+    else:
+        data = np.asarray(img.dataobj)
+
+    current = nib.orientations.io_orientation(img.affine)
+    ras = nib.orientations.axcodes2ornt(('R', 'A', 'S'))
+    transform = nib.orientations.ornt_transform(current, ras)
+    return nib.orientations.apply_orientation(data, transform)
+
+def normalize(data, low=2, high=98):
+    """
+    Scales data to 0-255 using the given percentiles of its finite, non-zero
+    values as the limits (values outside the limits are clipped).
+    """
+    data = np.nan_to_num(np.asarray(data, dtype=np.float32))
+    values = data[data != 0]
+    if not values.size:
+        return np.zeros(data.shape, dtype=np.uint8)
+
+    lower, upper = np.percentile(values, [low, high])
+    if upper <= lower:
+        upper = lower + 1
+    scaled = (np.clip(data, lower, upper) - lower) / (upper - lower) * 255
+    return np.round(scaled).astype(np.uint8)
+
+def get_axial_slices(data, gap):
+    """
+    Returns every <gap>th axial slice of a 3D array, rotated so anterior is
+    at the top of the slice.
+    """
+    gap = max(int(gap), 1)
+    return [np.rot90(data[:, :, idx]) for idx in range(0, data.shape[2], gap)]
+
+def make_montage(slices, width):
+    """
+    Tiles a list of equally sized 2D uint8 arrays into a greyscale PIL image
+    that is <width> pixels wide.
+    """
+    rows, cols = slices[0].shape
+    per_row = max(int(width) // cols, 1)
+    n_rows = int(np.ceil(len(slices) / float(per_row)))
+
+    tiled = np.zeros((n_rows * rows, per_row * cols), dtype=np.uint8)
+    for num, image in enumerate(slices):
+        top = (num // per_row) * rows
+        left = (num % per_row) * cols
+        tiled[top:top + rows, left:left + cols] = image
+
+    montage = PIL.Image.fromarray(tiled, mode='L')
+    if montage.width != width:
+        height = max(int(round(montage.height * width / float(montage.width))),
+                     1)
+        montage = montage.resize((int(width), height), PIL.Image.BILINEAR)
+    return montage
+
+def render(fpath, pic, slicergap, picwidth):
+    """
+    Generates a montage png from a nifti file
+        fpath       -- submitted image file name
+        pic         -- fullpath to for output image
+        slicergap   -- int of "gap" between slices in Montage
+        picwidth    -- width (in pixels) of output image
+    """
+    data = normalize(load_volume(fpath))
+    make_montage(get_axial_slices(data, slicergap), picwidth).save(pic)
+
+def _render_job(job):
+    try:
+        render(*job)
+    except Exception as e:
+        logger.error('Failed to render {} to {}. Reason: {}'.format(job[0],
+                job[1], e))
+        return False
+    return True
+
+def render_batch(jobs, threads=4):
+    """
+    Renders several montages at once.
+
+        jobs        -- a list of (fpath, pic, slicergap, picwidth) tuples
+        threads     -- the number of images to render at the same time
+
+    Failures are logged rather than raised. Returns a list of the pics that
+    could not be made.
+    """
+    if not jobs:
+        return []
+    pool = ThreadPool(max(min(threads, len(jobs)), 1))
+    try:
+        results = pool.map(_render_job, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    return [job[1] for job, success in zip(jobs, results) if not success]
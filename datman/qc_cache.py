@@ -0,0 +1,194 @@
+"""
+Keeps track of the inputs each QC output was made from, so that QC stages are
+only re-run when their inputs (or the tool that made them) change.
+
+The record for a subject's QC folder is kept in a json file in that folder.
+For each output it stores the tool version used and the size, mtime and
+sha1 hash of every input. An output is current if it exists, was made by the
+same tool version and every input has the same size and mtime. If only the
+mtime of an input has changed (e.g. a series was re-exported unchanged) the
+hash is compared before deciding the output is stale.
+
+    cache = datman.qc_cache.get_cache(qc_dir)
+    if not cache.is_current(output, [nifti], 'qc-fmri'):
+        datman.utils.run('qc-fmri {} {}'.format(nifti, prefix))
+        cache.update(output, [nifti], 'qc-fmri')
+
+Outputs that exist but have no record (i.e. were made before the cache was
+in use) are taken to be current, and a record is made for them, as long as
+none of their inputs is newer than the output.
+"""
+import os
+import json
+import hashlib
+import logging
+
+import datman.utils
+
+logger = logging.getLogger(__name__)
+
+CACHE_NAME = '.qc_cache.json'
+
+_caches = {}
+
+def get_cache(qc_path):
+    """
+    Returns the ArtifactCache for a QC folder, loading it the first time it's
+    requested.
+    """
+    qc_path = os.path.abspath(qc_path)
+    try:
+        return _caches[qc_path]
+    except KeyError:
+        cache = ArtifactCache(qc_path)
+        _caches[qc_path] = cache
+        return cache
+
+def tool_version(tool):
+    """
+    Returns the environment module loaded for tool (e.g. 'qcmon/1.0.1') if
+    there is one, otherwise just the tool name.
+    """
+    for module in datman.utils.get_loaded_modules().split():
+        if module.split('/')[0].lower() == tool.lower():
+            return module
+    return tool
+
+def file_hash(path, block_size=1048576):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as stream:
+        for block in iter(lambda: stream.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+class ArtifactCache(object):
+    """
+    The record of the inputs used to make each output in a QC folder.
+
+        qc_path:    The subject's QC folder. Outputs are recorded by their
+                    path relative to this folder.
+    """
+    def __init__(self, qc_path):
+        self.qc_path = qc_path
+        self.cache_file = os.path.join(qc_path, CACHE_NAME)
+        self._hashes = {}
+        try:
+            with open(self.cache_file, 'r') as stream:
+                self.records = json.load(stream)
+        except (IOError, ValueError):
+            self.records = {}
+
+    def is_current(self, output, inputs, tool=None):
+        """
+        Returns True if output exists and was made from the current version
+        of each input with the same tool version.
+        """
+        if not os.path.exists(output):
+            return False
+
+        key = self._key(output)
+        try:
+            record = self.records[key]
+        except KeyError:
+            return self._adopt(output, inputs, tool)
+
+        if record.get('tool') != tool:
+            logger.info("{} was made with {}, current tool is {}".format(
+                    output, record.get('tool'), tool))
+            return False
+
+        if sorted(record['inputs']) != sorted(inputs):
+            return False
+
+        changed = False
+        for path in inputs:
+            recorded = record['inputs'][path]
+            current = self._stat(path)
+            if recorded is None or current is None:
+                if recorded != current:
+                    return False
+                continue
+            if current['size'] != recorded['size']:
+                return False
+            if current['mtime'] == recorded['mtime']:
+                continue
+            # Touched but maybe not modified, only the contents matter
+            if self._hash(path, current) != recorded['hash']:
+                logger.info("Input {} has changed since {} was made".format(
+                        path, output))
+                return False
+            recorded['mtime'] = current['mtime']
+            changed = True
+
+        if changed:
+            self.save()
+        return True
+
+    def _adopt(self, output, inputs, tool):
+        """
+        Records an output made before the cache was in use, unless an input
+        has been modified since the output was written.
+        """
+        output_mtime = os.path.getmtime(output)
+        for path in inputs:
+            current = self._stat(path)
+            if current is not None and current['mtime'] > output_mtime:
+                logger.info("No record of inputs for {} and {} is newer, "
+                        "remaking it".format(output, path))
+                return False
+        logger.debug("No record of inputs for {}, assuming it's "
+                "current".format(output))
+        self.update(output, inputs, tool)
+        return True
+
+    def update(self, output, inputs, tool=None):
+        """
+        Records the current state of the inputs that output was made from.
+        """
+        signatures = {}
+        for path in inputs:
+            current = self._stat(path)
+            if current is not None:
+                current['hash'] = self._hash(path, current)
+            signatures[path] = current
+        self.records[self._key(output)] = {'tool': tool,
+                                           'inputs': signatures}
+        self.save()
+
+    def remove(self, output):
+        """
+        Forgets the record for an output, so it will be remade.
+        """
+        if self.records.pop(self._key(output), None) is not None:
+            self.save()
+
+    def save(self):
+        if not os.path.isdir(self.qc_path):
+            return
+        temp_file = self.cache_file + '.tmp'
+        try:
+            with open(temp_file, 'w') as stream:
+                json.dump(self.records, stream, indent=1, sort_keys=True)
+            os.rename(temp_file, self.cache_file)
+        except (IOError, OSError) as e:
+            logger.error("Failed to save QC cache {}. Reason: {}".format(
+                    self.cache_file, e))
+
+    def _key(self, output):
+        return os.path.relpath(os.path.abspath(output), self.qc_path)
+
+    def _stat(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    def _hash(self, path, signature):
+        # Inputs are shared by several outputs, only hash each version once
+        key = (path, signature['size'], signature['mtime'])
+        try:
+            return self._hashes[key]
+        except KeyError:
+            self._hashes[key] = file_hash(path)
+            return self._hashes[key]
@@ -0,0 +1,230 @@
+"""
+Concurrency safe access to a study's QC checklist (metadata/checklist.csv).
+
+Many QC jobs may finish at the same time and each needs to add its report to
+the checklist. Rather than every job re-reading and appending to
+checklist.csv, new reports are appended to a journal file beside it
+(checklist.csv.journal) while holding an exclusive lock on
+checklist.csv.lock. The journal is later compacted into checklist.csv (also
+under the lock), so the file people edit to sign off on reports is only
+rewritten in one place.
+
+    store = datman.qc_checklist.get_store(checklist_path)
+    store.add('qc_STUDY_SITE_0001_01.html')
+    ...
+    store.compact()
+
+Jobs that finish while another is compacting can call compact(blocking=False)
+to leave their entries in the journal for a later compaction instead of
+waiting.
+
+Locks are taken with fcntl.lockf so they also work on NFS mounts.
+"""
+import os
+import errno
+import fcntl
+import logging
+import contextlib
+
+logger = logging.getLogger(__name__)
+
+_stores = {}
+
+def get_store(checklist_path):
+    """
+    Returns the ChecklistStore for a checklist, so its index is only built
+    once per process.
+    """
+    checklist_path = os.path.abspath(checklist_path)
+    try:
+        return _stores[checklist_path]
+    except KeyError:
+        store = ChecklistStore(checklist_path)
+        _stores[checklist_path] = store
+        return store
+
+class ChecklistLocked(Exception):
+    pass
+
+def get_report_name(entry):
+    """
+    Returns the report name (file name with no extension) from a checklist
+    line, so that .pdf and .html reports for a subject are treated as the
+    same entry. Returns None for blank lines.
+    """
+    fields = entry.split(None, 1)
+    if not fields:
+        return None
+    return os.path.splitext(fields[0].strip())[0]
+
+class ChecklistStore(object):
+    """
+    A checklist.csv file plus its journal of reports waiting to be added.
+
+        checklist_path:     The full path to checklist.csv
+    """
+    def __init__(self, checklist_path):
+        self.path = checklist_path
+        self.journal = checklist_path + '.journal'
+        self.lock_path = checklist_path + '.lock'
+        self._index = set()
+        # (mtime, size) of checklist.csv when it was last indexed and how
+        # far into the journal has been read
+        self._checklist_state = None
+        self._journal_offset = 0
+
+    @contextlib.contextmanager
+    def locked(self, blocking=True):
+        """
+        Holds an exclusive lock on the checklist for the duration of the
+        block. If blocking is False, ChecklistLocked is raised instead of
+        waiting for another process to release the lock.
+        """
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        with open(self.lock_path, 'a') as lock_file:
+            try:
+                fcntl.lockf(lock_file, flags)
+            except IOError as e:
+                if e.errno in (errno.EACCES, errno.EAGAIN):
+                    raise ChecklistLocked(self.path)
+                raise
+            try:
+                yield
+            finally:
+                fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+    def __contains__(self, report):
+        self._refresh()
+        return get_report_name(os.path.basename(report)) in self._index
+
+    def reports(self):
+        """
+        Returns the set of report names (no extension) in the checklist or
+        waiting in the journal.
+        """
+        self._refresh()
+        return set(self._index)
+
+    def add(self, report):
+        """
+        Adds a report's file name to the checklist journal, unless it (or
+        the same report with a different extension) is already present.
+        Returns True if the report was added.
+        """
+        report_file_name = os.path.basename(report)
+        report_name = get_report_name(report_file_name)
+        with self.locked():
+            self._refresh()
+            if report_name in self._index:
+                return False
+            with open(self.journal, 'a') as journal:
+                journal.write(report_file_name + '\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+                self._journal_offset = journal.tell()
+            self._index.add(report_name)
+        return True
+
+    def compact(self, blocking=True):
+        """
+        Moves any journalled reports into checklist.csv and empties the
+        journal. checklist.csv is rewritten atomically so a reader never sees
+        a partial file. Returns the number of reports added.
+
+        If blocking is False and another process holds the lock nothing is
+        done, the journal will be compacted by a later call.
+        """
+        try:
+            with self.locked(blocking):
+                return self._compact()
+        except ChecklistLocked:
+            logger.debug("{} is locked, not compacting".format(self.path))
+            return 0
+
+    def _compact(self):
+        pending = self._read_journal()
+        if not pending:
+            return 0
+
+        existing = set()
+        lines = []
+        try:
+            with open(self.path, 'r') as checklist:
+                lines = checklist.readlines()
+        except IOError:
+            logger.info("{} does not exist. Creating it".format(self.path))
+        for line in lines:
+            existing.add(get_report_name(line))
+
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        added = 0
+        for entry in pending:
+            name = get_report_name(entry)
+            if name in existing:
+                continue
+            existing.add(name)
+            lines.append(entry + '\n')
+            added += 1
+
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as checklist:
+            checklist.writelines(lines)
+        if os.path.exists(self.path):
+            # keep the permissions people have set on the checklist
+            os.chmod(temp_path, os.stat(self.path).st_mode & 0o7777)
+        os.rename(temp_path, self.path)
+        open(self.journal, 'w').close()
+
+        self._checklist_state = None
+        self._journal_offset = 0
+        self._index = set()
+        self._refresh()
+        return added
+
+    def _refresh(self):
+        """
+        Brings the index up to date. checklist.csv is only re-read if it has
+        changed and only the new part of the journal is read.
+        """
+        state = self._get_state(self.path)
+        if state != self._checklist_state:
+            self._index = set()
+            self._journal_offset = 0
+            try:
+                with open(self.path, 'r') as checklist:
+                    for line in checklist:
+                        self._index.add(get_report_name(line))
+            except IOError:
+                pass
+            self._index.discard(None)
+            self._checklist_state = state
+
+        for entry in self._read_journal(self._journal_offset):
+            self._index.add(get_report_name(entry))
+
+    def _read_journal(self, offset=0):
+        entries = []
+        try:
+            with open(self.journal, 'r') as journal:
+                if offset > os.fstat(journal.fileno()).st_size:
+                    # journal was compacted by someone else
+                    offset = 0
+                journal.seek(offset)
+                for line in journal:
+                    line = line.strip()
+                    if line:
+                        entries.append(line)
+                self._journal_offset = journal.tell()
+        except IOError:
+            self._journal_offset = 0
+        return entries
+
+    def _get_state(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
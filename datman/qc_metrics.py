@@ -0,0 +1,321 @@
+"""
+Computes fMRI and DTI QC metrics in-process, in place of qcmon's
+qc-scanlength, qc-fmri and qc-spikecount.
+
+Except for head motion, everything is computed from the image a few volumes
+at a time, so memory use is a handful of 3D volumes no matter how long the
+scan is. The file is kept open between reads: volumes are stored one after
+another in a nifti, so a .nii.gz is then decompressed once, front to back,
+rather than from the start again for every few volumes. Each voxel's
+time series is detrended with a second order polynomial before the temporal
+standard deviation and correlations are computed, using running sums so the
+whole time series never needs to be in memory:
+
+    tmean   The mean of each voxel's time series
+    tsd     The standard deviation of each voxel's detrended time series
+    sfnr    tmean / tsd
+    corr    The correlation of each voxel's detrended time series with the
+            detrended global signal (the mean of the brain voxels, found
+            from the first volume)
+    spikes  The number of volumes in each slice whose mean intensity is more
+            than 'threshold' robust standard deviations away from that slice's
+            median. Volumes are grouped by b-value first for DTI.
+
+    fmri_qc('sub_RST.nii.gz', '/qc/sub/sub_RST')
+    spikecount('sub_DTI.nii.gz', '/qc/sub/sub_DTI_spikecount.csv',
+               'sub_DTI.bval')
+
+fmri_qc() writes the same files qc-scanlength and qc-fmri did, in the same
+layout: <prefix>_scanlengths.csv (ntrs), <prefix>_stats.csv (mean_fd,
+n_bad_fd, %_bad_fd, global_corr, mean_sfnr), <prefix>_fd.csv,
+<prefix>_sfnr.nii.gz and <prefix>_corr.nii.gz. Like qc-fmri, framewise
+displacement is computed from AFNI's 3dvolreg motion estimates, with the
+rotations taken as arcs on a 50mm sphere. If 3dvolreg fails the motion
+columns are left empty.
+"""
+import os
+import csv
+import shutil
+import logging
+import tempfile
+
+import numpy as np
+import nibabel as nib
+
+import datman.utils
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 16
+SPIKE_THRESHOLD = 5.0
+# Framewise displacement above this (in mm) is counted as bad
+FD_THRESHOLD = 0.2
+HEAD_RADIUS = 50.0
+STATS_COLUMNS = ['mean_fd', 'n_bad_fd', '%_bad_fd', 'global_corr',
+                 'mean_sfnr']
+
+def scan_length(path):
+    """
+    Returns the number of volumes in a nifti, read from its header only.
+    """
+    shape = nib.load(path).shape
+    return shape[3] if len(shape) > 3 else 1
+
+def load_image(path):
+    """
+    Opens a nifti for reading a few volumes at a time. The file is kept open
+    so that each read of a .nii.gz carries on from the last one instead of
+    decompressing the stream from the start.
+    """
+    return nib.load(path, keep_file_open=True)
+
+def iter_volumes(img, chunk_size=CHUNK_SIZE):
+    """
+    Yields (first volume number, 4D float64 array) for every chunk_size
+    volumes of a 4D image.
+    """
+    n_vols = img.shape[3] if len(img.shape) > 3 else 1
+    for start in range(0, n_vols, chunk_size):
+        stop = min(start + chunk_size, n_vols)
+        if len(img.shape) > 3:
+            chunk = img.dataobj[..., start:stop]
+        else:
+            chunk = np.asarray(img.dataobj)[..., np.newaxis]
+        yield start, np.asarray(chunk, dtype=np.float64)
+
+def get_design(n_vols):
+    """
+    Returns a (n_vols, 3) matrix of constant, linear and quadratic trends over
+    a time series.
+    """
+    time = np.linspace(-1, 1, n_vols) if n_vols > 1 else np.zeros(1)
+    return np.column_stack([np.ones(n_vols), time, time ** 2])
+
+class Accumulator(object):
+    """
+    Running sums over the volumes of a 4D image, from which the detrended
+    temporal statistics can be computed without holding the whole series.
+    """
+    def __init__(self, shape, n_vols):
+        self.n_vols = n_vols
+        self.design = get_design(n_vols)
+        # X^T y for each voxel, one volume per regressor
+        self.fit = np.zeros((3,) + shape)
+        # y^T y for each voxel
+        self.squares = np.zeros(shape)
+        # the voxels averaged for the global signal, set from the first
+        # volume
+        self.mask = None
+        # X^T g, g^T g and y^T g for the global signal g
+        self.global_fit = np.zeros(3)
+        self.global_squares = 0.0
+        self.global_products = np.zeros(shape)
+
+    def add(self, start, chunk):
+        stop = start + chunk.shape[3]
+        weights = self.design[start:stop]
+        self.fit += np.tensordot(weights.T, np.moveaxis(chunk, 3, 0), axes=1)
+        self.squares += np.einsum('xyzt,xyzt->xyz', chunk, chunk)
+        if self.mask is None:
+            self.mask = get_mask(chunk[..., 0])
+        if self.mask.any():
+            signal = chunk[self.mask].mean(axis=0)
+        else:
+            signal = chunk.reshape(-1, chunk.shape[3]).mean(axis=0)
+        self.global_fit += weights.T.dot(signal)
+        self.global_squares += signal.dot(signal)
+        self.global_products += np.tensordot(chunk, signal, axes=([3], [0]))
+
+    def detrended(self, products, left_fit, right_fit):
+        """
+        Converts the running sum of y_i * y_j for two sets of voxels to the
+        sum of the products of their detrended series, given X^T y_i and
+        X^T y_j.
+        """
+        inverse = np.linalg.pinv(self.design.T.dot(self.design))
+        return products - np.einsum('ab,a...,b...->...', inverse, left_fit,
+                right_fit)
+
+    def results(self):
+        """
+        Returns the tmean, tsd, sfnr and corr volumes.
+        """
+        dof = max(self.n_vols - 3, 1)
+        tmean = self.fit[0] / self.n_vols
+
+        rss = self.detrended(self.squares, self.fit, self.fit)
+        rss = np.clip(rss, 0, None)
+        tsd = np.sqrt(rss / dof)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sfnr = np.where(tsd > 0, tmean / tsd, 0)
+
+        global_fit = self.global_fit.reshape((3, 1, 1, 1))
+        cross = self.detrended(self.global_products, self.fit, global_fit)
+        global_rss = self.detrended(self.global_squares, global_fit,
+                global_fit).item()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = np.where((rss > 0) & (global_rss > 0),
+                    cross / np.sqrt(rss * global_rss), 0)
+
+        return tmean, tsd, sfnr, corr
+
+def count_spikes(slice_means, groups=None, threshold=SPIKE_THRESHOLD):
+    """
+    Returns the number of spikes in each slice, given the (slice, volume)
+    array of slice mean intensities. groups is a sequence of labels (e.g.
+    b-values) for each volume. Volumes are only compared with others in their
+    group.
+    """
+    if groups is None:
+        groups = np.zeros(slice_means.shape[1])
+    groups = np.asarray(groups)
+
+    spikes = np.zeros(slice_means.shape[0], dtype=int)
+    for group in np.unique(groups):
+        values = slice_means[:, groups == group]
+        if values.shape[1] < 3:
+            continue
+        median = np.median(values, axis=1)[:, np.newaxis]
+        deviation = np.abs(values - median)
+        spread = 1.4826 * np.median(deviation, axis=1)[:, np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            outliers = np.where(spread > 0, deviation > threshold * spread,
+                                False)
+        spikes += outliers.sum(axis=1)
+    return spikes
+
+def get_mask(volume):
+    """
+    Returns the voxels whose intensity is at least 20% of the bright end of
+    a volume, a rough brain mask for the global signal and for summarizing
+    the metric maps.
+    """
+    values = volume[volume > 0]
+    if not values.size:
+        return np.zeros(volume.shape, dtype=bool)
+    return volume > 0.2 * np.percentile(values, 98)
+
+def compute_metrics(path, chunk_size=CHUNK_SIZE):
+    """
+    Reads a 4D nifti once and returns an Accumulator holding its running
+    sums, along with the loaded image.
+    """
+    img = load_image(path)
+    n_vols = img.shape[3] if len(img.shape) > 3 else 1
+    sums = Accumulator(img.shape[:3], n_vols)
+    for start, chunk in iter_volumes(img, chunk_size):
+        sums.add(start, chunk)
+    return img, sums
+
+def save_map(data, img, path):
+    header = img.header.copy()
+    header.set_data_dtype(np.float32)
+    nib.Nifti1Image(data.astype(np.float32), img.affine, header).to_filename(
+            path)
+
+def write_csv(path, header, rows):
+    with open(path, 'wb') as stream:
+        writer = csv.writer(stream)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+def framewise_displacement(params, radius=HEAD_RADIUS):
+    """
+    Returns the framewise displacement (in mm) for each volume, given the
+    (volume, 6) motion estimates from 3dvolreg (roll, pitch and yaw in
+    degrees, then three translations in mm). The first volume's is 0.
+    """
+    params = np.atleast_2d(np.asarray(params, dtype=np.float64))
+    moves = np.abs(np.diff(params, axis=0))
+    moves[:, :3] = np.radians(moves[:, :3]) * radius
+    return np.concatenate([[0.0], moves.sum(axis=1)])
+
+def motion_params(path):
+    """
+    Runs 3dvolreg on a nifti and returns its (volume, 6) motion estimates,
+    or None if it fails.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='qc_metrics')
+    try:
+        params = os.path.join(tmp_dir, 'motion.1D')
+        return_code, _ = datman.utils.run('3dvolreg -prefix {} -1Dfile {} '
+                '{}'.format(os.path.join(tmp_dir, 'reg.nii.gz'), params,
+                path))
+        if return_code or not os.path.exists(params):
+            logger.error("3dvolreg failed for {}, motion statistics won't "
+                    "be reported".format(path))
+            return None
+        return np.loadtxt(params, ndmin=2)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def fmri_qc(path, prefix, chunk_size=CHUNK_SIZE):
+    """
+    Computes the fMRI QC metrics for a nifti and writes
+    <prefix>_scanlengths.csv, <prefix>_stats.csv, <prefix>_fd.csv,
+    <prefix>_sfnr.nii.gz and <prefix>_corr.nii.gz. Returns a dictionary of
+    the summary statistics (with the motion statistics set to None if they
+    couldn't be computed).
+    """
+    img, sums = compute_metrics(path, chunk_size)
+    tmean, tsd, sfnr, corr = sums.results()
+    mask = get_mask(tmean)
+
+    def masked_mean(data):
+        return float(data[mask].mean()) if mask.any() else 0.0
+
+    stats = dict.fromkeys(STATS_COLUMNS)
+    stats['global_corr'] = masked_mean(corr)
+    stats['mean_sfnr'] = masked_mean(sfnr)
+
+    params = motion_params(path)
+    if params is not None:
+        fd = framewise_displacement(params)
+        n_bad = int((fd > FD_THRESHOLD).sum())
+        stats['mean_fd'] = float(fd.mean())
+        stats['n_bad_fd'] = n_bad
+        stats['%_bad_fd'] = 100.0 * n_bad / len(fd)
+        write_csv(prefix + '_fd.csv', ['fd'], [[value] for value in fd])
+
+    save_map(sfnr, img, prefix + '_sfnr.nii.gz')
+    save_map(corr, img, prefix + '_corr.nii.gz')
+    write_csv(prefix + '_scanlengths.csv', ['ntrs'], [[sums.n_vols]])
+    write_csv(prefix + '_stats.csv', STATS_COLUMNS,
+              [['' if stats[column] is None else stats[column]
+                for column in STATS_COLUMNS]])
+    stats['ntrs'] = sums.n_vols
+    return stats
+
+def read_bvals(path):
+    """
+    Returns the b-values from an FSL style .bval file, rounded to the nearest
+    hundred so volumes with the same nominal b-value are grouped together.
+    """
+    with open(path, 'r') as stream:
+        bvals = [float(value) for value in stream.read().split()]
+    return np.round(np.array(bvals) / 100) * 100
+
+def spikecount(path, output, bval=None, threshold=SPIKE_THRESHOLD,
+        chunk_size=CHUNK_SIZE):
+    """
+    Counts the spikes in each slice of a nifti and writes them to output.
+    If a bval file is given, volumes are only compared with others that have
+    the same b-value. Returns the per slice counts.
+    """
+    img = load_image(path)
+    n_vols = img.shape[3] if len(img.shape) > 3 else 1
+    slice_means = np.zeros((img.shape[2], n_vols))
+    for start, chunk in iter_volumes(img, chunk_size):
+        slice_means[:, start:start + chunk.shape[3]] = chunk.mean(axis=(0, 1))
+
+    groups = None
+    if bval:
+        groups = read_bvals(bval)
+        if len(groups) != n_vols:
+            logger.error("{} has {} b-values for {} volumes, ignoring "
+                    "them.".format(bval, len(groups), n_vols))
+            groups = None
+
+    spikes = count_spikes(slice_means, groups, threshold)
+    write_csv(output, ['slice', 'n_spikes'], enumerate(spikes))
+    return spikes
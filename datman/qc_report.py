@@ -0,0 +1,241 @@
+"""
+Builds QC report pages out of separately cached sections.
+
+A report is a page template filled with a list of sections (e.g. the scan
+table and one section per series). Each section is rendered by a function
+that writes html to a file-like Section, and the result is stored in a json
+file in the report's folder together with a 'signature' describing what it
+was made from (e.g. the size and mtime of the series files). When the report
+is rebuilt a section whose signature is unchanged, and whose images still
+exist, is copied from the cache instead of being rendered again. Adding a
+series or a repeat session only renders the sections it affects.
+
+    report = Report(report_path, subject_id)
+    report.add_section('table', table_signature, write_table)
+    for series in series_list:
+        report.add_section(series.file_name, get_signature(series),
+                functools.partial(write_series, series))
+    report.write(summary={'series': len(series_list)})
+
+Each report also stores a small summary, which write_index() reads to build
+a study-wide index page without opening any of the reports themselves.
+"""
+import os
+import re
+import json
+import time
+import string
+import logging
+from StringIO import StringIO
+
+logger = logging.getLogger(__name__)
+
+CACHE_NAME = '.qc_report.json'
+INDEX_NAME = 'index.html'
+
+STYLE = ('body { font-family: futura,sans-serif;'
+         '        text-align: center;}\n'
+         'img {width:90%; \n'
+         '   display: block\n;'
+         '   margin-left: auto;\n'
+         '   margin-right: auto }\n'
+         'table { margin: 25px auto; \n'
+         '        border-collapse: collapse;\n'
+         '        text-align: left;\n'
+         '        width: 90%; \n'
+         '        border: 1px solid grey;\n'
+         '        border-bottom: 2px solid black;} \n'
+         'th {background: black;\n'
+         '    color: white;\n'
+         '    text-transform: uppercase;\n'
+         '    padding: 10px;}\n'
+         'td {border-top: thin solid;\n'
+         '    border-bottom: thin solid;\n'
+         '    padding: 10px;}\n')
+
+PAGE = string.Template('<HTML><TITLE>${title}</TITLE>\n'
+                       '<head>\n<style>\n${style}</style></head>\n'
+                       '<h1> ${heading} <h1/>${body}')
+
+INDEX_ROW = string.Template('<tr><td><a href="${link}">${subject}</a></td>'
+                            '<td>${series}</td>'
+                            '<td>${missing}</td>'
+                            '<td>${header_diffs}</td>'
+                            '<td>${updated}</td></tr>\n')
+
+IMAGE_PATTERN = re.compile(r'<img src="([^"]+)"')
+
+class Section(object):
+    """
+    Collects the html for one section of a report. Has the 'write' method and
+    'name' attribute of the report file, so functions that write to a
+    report file can write to a section instead.
+    """
+    def __init__(self, report_path):
+        self.name = report_path
+        self._buffer = StringIO()
+
+    def write(self, text):
+        self._buffer.write(text)
+
+    def getvalue(self):
+        return self._buffer.getvalue()
+
+def file_signature(*paths):
+    """
+    Returns a list of [path, size, mtime] for each path, with None for the
+    size and mtime of paths that don't exist.
+    """
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            signature.append([path, None, None])
+        else:
+            signature.append([path, stat.st_size, stat.st_mtime])
+    return signature
+
+class Report(object):
+    """
+    A QC report page and the cached sections it is made from.
+
+        path:       The full path to the html page
+        subject_id: The session the report is for, used in the page's title
+        use_cache:  If False every section is rendered again, and the
+                    cached copies replaced
+    """
+    def __init__(self, path, subject_id, use_cache=True):
+        self.path = path
+        self.subject_id = subject_id
+        self.cache_file = os.path.join(os.path.dirname(path), CACHE_NAME)
+        self.rendered = []
+        self.reused = []
+        self._sections = []
+        try:
+            with open(self.cache_file, 'r') as stream:
+                self.cache = json.load(stream)
+        except (IOError, ValueError):
+            self.cache = {}
+        self._cached_sections = self.cache.get('sections', {}) if use_cache \
+                else {}
+        self._new_sections = {}
+
+    def add_section(self, key, signature, render):
+        """
+        Adds the next section to the page. render(section) is only called if
+        there's no cached copy made with the same signature. A signature of
+        None means the section is always rendered (and never cached).
+        """
+        html = self._get_cached(key, signature)
+        if html is None:
+            section = Section(self.path)
+            render(section)
+            html = section.getvalue()
+            self.rendered.append(key)
+            if signature is not None:
+                self._new_sections[key] = {'signature': signature,
+                                           'html': html}
+        else:
+            self.reused.append(key)
+            self._new_sections[key] = self._cached_sections[key]
+        self._sections.append(html)
+
+    def _get_cached(self, key, signature):
+        if signature is None:
+            return None
+        try:
+            cached = self._cached_sections[key]
+        except KeyError:
+            return None
+        # json turns tuples into lists, so compare it the same way
+        if cached['signature'] != json.loads(json.dumps(signature)):
+            return None
+        report_dir = os.path.dirname(self.path)
+        for image in IMAGE_PATTERN.findall(cached['html']):
+            if not os.path.exists(os.path.join(report_dir, image)):
+                logger.debug("{} is missing, re-rendering section {}".format(
+                        image, key))
+                return None
+        return cached['html']
+
+    def write(self, summary=None):
+        """
+        Writes the page from the sections added since the report was opened
+        and saves the section cache. Sections that were not added again are
+        dropped from the cache.
+        """
+        page = PAGE.substitute(title='{} qc'.format(self.subject_id),
+                style=STYLE,
+                heading='QC report for {}'.format(self.subject_id),
+                body=''.join(self._sections))
+        if isinstance(page, unicode):
+            # cached sections are read back from json as unicode
+            page = page.encode('utf-8')
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as report:
+            report.write(page)
+        os.rename(temp_path, self.path)
+
+        summary = dict(summary or {})
+        summary['updated'] = time.strftime('%Y-%m-%d %H:%M')
+        self.cache = {'sections': self._new_sections, 'summary': summary}
+        temp_cache = self.cache_file + '.tmp'
+        try:
+            with open(temp_cache, 'w') as stream:
+                json.dump(self.cache, stream)
+            os.rename(temp_cache, self.cache_file)
+        except (IOError, OSError) as e:
+            logger.error("Failed to save report cache {}. Reason: {}".format(
+                    self.cache_file, e))
+        logger.debug("Wrote {}. Rendered sections: {}. Reused: {}".format(
+                self.path, self.rendered, self.reused))
+
+def read_summary(subject_qc_dir):
+    """
+    Returns the summary saved with the report in a subject's QC folder, or
+    None if there isn't one.
+    """
+    try:
+        with open(os.path.join(subject_qc_dir, CACHE_NAME), 'r') as stream:
+            return json.load(stream).get('summary')
+    except (IOError, ValueError):
+        return None
+
+def write_index(qc_dir, study_name):
+    """
+    Writes index.html in a study's QC folder, linking to the report of every
+    subject there with the summary saved when it was made. Only the summaries
+    are read. Returns the path to the index.
+    """
+    rows = []
+    for subject in sorted(os.listdir(qc_dir)):
+        subject_dir = os.path.join(qc_dir, subject)
+        if not os.path.isdir(subject_dir):
+            continue
+        summary = read_summary(subject_dir)
+        if summary is None:
+            continue
+        values = {'series': '', 'missing': '', 'header_diffs': '',
+                  'updated': ''}
+        values.update(summary)
+        values['subject'] = subject
+        values['link'] = os.path.join(subject, summary.get('report',
+                'qc_{}.html'.format(subject)))
+        rows.append(INDEX_ROW.substitute(values))
+
+    body = ('<table><tr><th>Session</th><th>Series</th><th>Missing</th>'
+            '<th>Header differences</th><th>Updated</th></tr>\n'
+            '{}</table>\n'.format(''.join(rows)))
+    page = PAGE.substitute(title='{} qc'.format(study_name), style=STYLE,
+            heading='QC reports for {}'.format(study_name), body=body)
+
+    if isinstance(page, unicode):
+        page = page.encode('utf-8')
+
+    index = os.path.join(qc_dir, INDEX_NAME)
+    temp_path = index + '.tmp'
+    with open(temp_path, 'wb') as stream:
+        stream.write(page)
+    os.rename(temp_path, index)
+    return index
@@ -0,0 +1,174 @@
+"""
+Finds the QC reports in a study (or all studies below a folder) that are
+missing, out of date or not yet signed off.
+
+Each project is read in a single pass: one directory listing of the nifti
+folder and of each session folder in it, with the stat results of every
+entry kept from the listing (scandir caches them on each entry, so no file is
+stat'ed twice), one stat of each session's QC report and one read of the
+checklist. Projects can be scanned in parallel, which mostly helps on network
+file systems where each listing or stat is slow.
+
+    statuses = scan_projects(find_projects('/archive/data'), jobs=4)
+
+Each project's status is a dictionary with the lists:
+
+    unlisted    Sessions with no entry in metadata/checklist.csv
+    missing     Sessions with a checklist entry but no QC report
+    stale       Reports older than some of the session's data, with the
+                newer files
+    unsigned    Reports in the checklist that haven't been signed off on
+"""
+import os
+import logging
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+logger = logging.getLogger(__name__)
+
+def read_checklist(checklist_file):
+    """
+    Returns a dictionary of report name (without extension): list of the
+    comments after it. Reports added by QC jobs but not yet merged into the
+    checklist (see datman.qc_checklist) are included with no comments.
+    """
+    checklist_dict = {}
+
+    for path in [checklist_file + '.journal', checklist_file]:
+        try:
+            with open(path) as checklist:
+                lines = checklist.readlines()
+        except IOError:
+            continue
+
+        for line in lines:
+            entry = line.strip().split()
+            if not entry:
+                continue
+            key = os.path.splitext(entry[0])[0]
+            checklist_dict[key] = entry[1:]
+    return checklist_dict
+
+def find_projects(root, maxdepth=2):
+    """
+    Search for datman project directories below root.
+
+    A project directory is defined as a directory having a
+    metadata/checklist.csv file.
+
+    Returns a list of absolute paths to project folders.
+    """
+    if os.path.exists(os.path.join(root, 'metadata', 'checklist.csv')):
+        return [root]
+
+    paths = []
+    if maxdepth < 1:
+        return paths
+    try:
+        entries = sorted(scandir(root), key=lambda entry: entry.name)
+    except OSError:
+        return paths
+    for entry in entries:
+        try:
+            if not entry.is_dir():
+                continue
+        except OSError:
+            continue
+        paths.extend(find_projects(entry.path, maxdepth - 1))
+    return paths
+
+def get_mtime(entry):
+    """
+    Returns the mtime of a directory entry. If a broken link is found 0 is
+    returned and a message is given.
+
+    This is needed because when the target of a link is blacklisted and removed
+    the links are not cleaned up. The broken links cannot just be removed from
+    here because this may be run by many users with insufficient privileges.
+    """
+    try:
+        return entry.stat().st_mtime
+    except OSError:
+        if entry.is_symlink():
+            logger.warning("Found broken link: {}".format(entry.path))
+            return 0
+        raise
+
+def list_session(session_dir):
+    """
+    Returns a list of (path, mtime) for everything in a session's folder.
+    """
+    return [(entry.path, get_mtime(entry)) for entry in scandir(session_dir)]
+
+def scan_project(projectdir):
+    """
+    Returns the QC status of every (non-phantom) session in a project.
+    """
+    status = {'project': projectdir, 'unlisted': [], 'missing': [],
+              'stale': [], 'unsigned': []}
+
+    checklist = read_checklist(os.path.join(projectdir, 'metadata',
+            'checklist.csv'))
+    nii_dir = os.path.join(projectdir, 'data', 'nii')
+    qc_dir = os.path.join(projectdir, 'qc')
+
+    try:
+        sessions = sorted((entry for entry in scandir(nii_dir)
+                           if entry.is_dir()), key=lambda entry: entry.name)
+    except OSError as e:
+        logger.error("Can't read {}. Reason: {}".format(nii_dir, e))
+        return status
+
+    for session in sessions:
+        if '_PHA_' in session.name:
+            continue
+
+        report_name = 'qc_' + session.name
+        report = os.path.join(qc_dir, session.name, report_name + '.html')
+
+        if report_name not in checklist:
+            status['unlisted'].append(session.path)
+            continue
+
+        try:
+            report_mtime = os.stat(report).st_mtime
+        except OSError:
+            status['missing'].append(session.path)
+            continue
+
+        contents = list_session(session.path)
+        data_mtime = max([mtime for path, mtime in contents
+                          if path.endswith('.nii.gz')] +
+                         [get_mtime(session)])
+        if data_mtime > report_mtime:
+            newer = sorted(path for path, mtime in contents
+                           if mtime > report_mtime)
+            if newer:
+                status['stale'].append({'report': report,
+                                        'session': session.path,
+                                        'data_mtime': data_mtime,
+                                        'report_mtime': report_mtime,
+                                        'newer': newer})
+
+        if not checklist[report_name]:
+            status['unsigned'].append(report)
+
+    return status
+
+def scan_projects(projects, jobs=1):
+    """
+    Returns a list of scan_project() results for each project, reading up to
+    'jobs' projects at once.
+    """
+    if jobs < 2 or len(projects) < 2:
+        return [scan_project(project) for project in projects]
+    pool = ThreadPool(min(jobs, len(projects)))
+    try:
+        return pool.map(scan_project, projects)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,206 @@
+"""
+Opt-in timing of the SQL run by datman.dashboard, to show how much of a slow
+run goes into the database and which dashboard methods it goes to.
+
+    datman.query_stats.enable(datman.dashboard.db.engine,
+                              report_path='extract_db_stats.json')
+
+or set DM_DASHBOARD_STATS=/path/to/report.json before running any script
+that uses the dashboard.
+
+Once enabled, every statement run on the engine is timed (through
+SQLAlchemy's cursor execute events) and charged to the dashboard method that
+ran it, for the study the dashboard object was made for. Statements run by a
+method called from another instrumented method (e.g. get_add_session from
+inside get_add_scan) are charged to the outer one, so nothing is counted
+twice. Statements from outside any instrumented method are charged to
+'other'. For each study and method the number of calls, the number of
+statements, the total time spent in SQL, the total time spent in the method
+and the slowest statements are kept.
+
+When the process exits the totals are logged and, if a report path was
+given, written to it as json. When not enabled, the instrumented methods only
+pay for one check of a global.
+"""
+import time
+import json
+import heapq
+import atexit
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+STATS_ENV = 'DM_DASHBOARD_STATS'
+OTHER = 'other'
+UNKNOWN_STUDY = 'unknown'
+
+_stats = None
+_report_path = None
+
+def enable(engine, report_path=None, slowest=5):
+    """
+    Starts timing the statements run on engine, and returns the QueryStats.
+    The report is made at exit, and also written as json to report_path if
+    it's given. Can be called again to add more engines.
+    """
+    global _stats, _report_path
+    if _stats is None:
+        _stats = QueryStats(slowest)
+        atexit.register(_report_at_exit)
+    if report_path:
+        _report_path = report_path
+    _stats.attach(engine)
+    return _stats
+
+def disable():
+    """
+    Stops timing statements and forgets the totals, without a report.
+    """
+    global _stats, _report_path
+    if _stats is not None:
+        _stats.detach()
+    _stats = None
+    _report_path = None
+
+def get_stats():
+    """
+    Returns the QueryStats being kept, or None if not enabled.
+    """
+    return _stats
+
+def _report_at_exit():
+    if _stats is not None:
+        _stats.report(_report_path)
+
+def instrumented(method):
+    """
+    Charges the statements run while method runs to its name and the study
+    of its instance (read from a 'study_name' attribute, if it has one).
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if _stats is None:
+            return method(*args, **kwargs)
+        study = None
+        if args:
+            study = getattr(args[0], 'study_name', None)
+        with _stats.operation(method.__name__, study):
+            return method(*args, **kwargs)
+    return wrapper
+
+class QueryStats(object):
+    """
+    The statement counts and times for each study and method.
+
+        slowest:    The number of slowest statements to keep for each
+                    method.
+    """
+    def __init__(self, slowest=5):
+        self.slowest = slowest
+        self.records = {}
+        self._engines = []
+        self._lock = threading.Lock()
+        # the method running in each thread
+        self._local = threading.local()
+
+    def attach(self, engine):
+        if engine in self._engines:
+            return
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+        self._engines.append(engine)
+
+    def detach(self):
+        for engine in self._engines:
+            event.remove(engine, 'before_cursor_execute',
+                    self._before_execute)
+            event.remove(engine, 'after_cursor_execute', self._after_execute)
+        self._engines = []
+
+    @contextmanager
+    def operation(self, name, study=None):
+        """
+        Charges statements run inside the block to name and study, unless
+        it's inside another operation already.
+        """
+        if getattr(self._local, 'operation', None) is not None:
+            yield
+            return
+
+        self._local.operation = (study or UNKNOWN_STUDY, name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            key = self._local.operation
+            self._local.operation = None
+            with self._lock:
+                record = self._get_record(key)
+                record['calls'] += 1
+                record['total_time'] += time.time() - start
+
+    def report(self, report_path=None):
+        """
+        Logs the totals (the slowest methods first) and writes them to
+        report_path as json if it's given. Returns the totals as a
+        dictionary of study: method: totals.
+        """
+        with self._lock:
+            totals = {}
+            for (study, method), record in self.records.items():
+                summary = dict(record)
+                summary['slowest'] = [{'seconds': seconds,
+                                       'statement': statement}
+                                      for seconds, statement in
+                                      sorted(record['slowest'], reverse=True)]
+                totals.setdefault(study, {})[method] = summary
+
+        rows = sorted(((study, method, summary) for study in totals
+                       for method, summary in totals[study].items()),
+                      key=lambda row: row[2]['sql_time'], reverse=True)
+        for study, method, summary in rows:
+            logger.info("{} {}: {} calls, {} statements, {:.3f}s in SQL "
+                    "({:.3f}s in total)".format(study, method,
+                    summary['calls'], summary['statements'],
+                    summary['sql_time'], summary['total_time']))
+
+        if report_path:
+            try:
+                with open(report_path, 'w') as output:
+                    json.dump(totals, output, indent=2, sort_keys=True)
+            except IOError as e:
+                logger.error("Failed writing dashboard query report {}. "
+                        "Reason: {}".format(report_path, e))
+        return totals
+
+    def _get_record(self, key):
+        try:
+            return self.records[key]
+        except KeyError:
+            record = {'calls': 0, 'statements': 0, 'sql_time': 0.0,
+                      'total_time': 0.0, 'slowest': []}
+            self.records[key] = record
+            return record
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+            executemany):
+        conn.info.setdefault('query_stats_start', []).append(time.time())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+            executemany):
+        elapsed = time.time() - conn.info['query_stats_start'].pop()
+        key = getattr(self._local, 'operation', None)
+        if key is None:
+            key = (UNKNOWN_STUDY, OTHER)
+        with self._lock:
+            record = self._get_record(key)
+            record['statements'] += 1
+            record['sql_time'] += elapsed
+            heapq.heappush(record['slowest'], (elapsed, statement))
+            if len(record['slowest']) > self.slowest:
+                heapq.heappop(record['slowest'])
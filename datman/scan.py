@@ -7,6 +7,13 @@ and uniform.
     does not change after the object is created. Certain attribute values may
     become out of date if this is not true.
 
+    Creating a Scan is cheap: the nii and dcm folders are only listed (once
+    each) the first time niftis, dicoms, their tags or get_tagged_* are used,
+    and the project is only looked up in the config when first needed. A
+    ParseException for misnamed files is raised at that point, not when the
+    Scan is made. Series and DatmanNamed use __slots__ so the many Series
+    of a study don't each carry an attribute dictionary.
+
 
     Both Scan and Series inherit from DatmanNamed and have the following
     attributes:
@@ -34,6 +41,8 @@ and uniform.
 
         is_phantom      True if the subject id used to create this instance
                         belongs to a phantom, false otherwise.
+        project         The project the subject belongs to, according to
+                        the config's XNAT archive mapping.
         nii_path        The path to this subject's nifti data.
         dcm_path        The path to this subject's dicom data.
         qc_path         The path to this subject's generated qc outputs.
@@ -58,9 +67,13 @@ and uniform.
                                 are found returns an empty list.
 """
 import os
-import glob
 import logging
 
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
 import datman.utils
 import datman.scanid as scanid
 
@@ -73,12 +86,27 @@ except:
 else:
     dash_available = True
 
+def list_files(path):
+    """
+    Returns the paths of everything in a folder from a single directory
+    listing, or an empty list if the folder can't be read. Hidden files
+    (e.g. macOS '._' resource forks) are left out, as glob did.
+    """
+    try:
+        return [entry.path for entry in scandir(path)
+                if not entry.name.startswith('.')]
+    except OSError:
+        return []
+
 class DatmanNamed(object):
     """
     A parent class for all classes that will obey the datman naming scheme
 
         ident:      A datman.scanid.Identifier instance
     """
+    __slots__ = ('full_id', 'id_plus_session', 'study', 'site', 'subject',
+            'timepoint', 'session')
+
     def __init__(self, ident):
         self.full_id = ident.get_full_subjectid_with_timepoint()
         self.id_plus_session = ident.get_full_subjectid_with_timepoint_session()
@@ -97,6 +125,9 @@ class Series(DatmanNamed):
     May raise a ParseException if the given file name does not match the
     datman naming convention.
     """
+    __slots__ = ('path', 'ext', 'file_name', 'tag', 'series_num',
+            'description')
+
     def __init__(self, path):
         self.path = path
         self.ext = datman.utils.get_extension(path)
@@ -132,7 +163,8 @@ class Scan(DatmanNamed):
         config:         A config object made from a project_settings.yml file
 
     May raise a ParseException if the given subject_id does not match the
-    datman naming convention
+    datman naming convention, and the first time niftis, dicoms or their tags
+    are used if any of the files found are misnamed.
     """
     def __init__(self, subject_id, config):
 
@@ -146,38 +178,65 @@ class Scan(DatmanNamed):
             message = "{} does not match datman convention".format(subject_id)
             raise datman.scanid.ParseException(message)
 
-        try:
-            self.project = config.map_xnat_archive_to_project(subject_id)
-        except Exception as e:
-            message = 'Failed getting project from config: {}'.format(str(e))
-            raise Exception(message)
-
         DatmanNamed.__init__(self, ident)
 
+        self.__id = subject_id
+        self.__config = config
+        self.__project = None
+
         self.nii_path = self.__get_path('nii', config)
         self.dcm_path = self.__get_path('dcm', config)
         self.qc_path = self.__get_path('qc', config)
         self.resource_path = self.__get_path('resources', config, session=True)
 
-        self.niftis = self.__get_series(self.nii_path, ['.nii', '.nii.gz'])
-        self.dicoms = self.__get_series(self.dcm_path, ['.dcm'])
-
-        self.__nii_dict = self.__make_dict(self.niftis)
-        self.__dcm_dict = self.__make_dict(self.dicoms)
+        self.__niftis = None
+        self.__dicoms = None
+        self.__nii_dict = None
+        self.__dcm_dict = None
 
-        self.nii_tags = self.__nii_dict.keys()
-        self.dcm_tags = self.__dcm_dict.keys()
+    @property
+    def project(self):
+        if self.__project is None:
+            try:
+                self.__project = self.__config.map_xnat_archive_to_project(
+                        self.__id)
+            except Exception as e:
+                message = 'Failed getting project from config: {}'.format(
+                        str(e))
+                raise Exception(message)
+        return self.__project
+
+    @property
+    def niftis(self):
+        if self.__niftis is None:
+            self.__niftis = self.__get_series(self.nii_path,
+                    ['.nii', '.nii.gz'])
+        return self.__niftis
+
+    @property
+    def dicoms(self):
+        if self.__dicoms is None:
+            self.__dicoms = self.__get_series(self.dcm_path, ['.dcm'])
+        return self.__dicoms
+
+    @property
+    def nii_tags(self):
+        return self.__get_nii_dict().keys()
+
+    @property
+    def dcm_tags(self):
+        return self.__get_dcm_dict().keys()
 
     def get_tagged_nii(self, tag):
         try:
-            matched_niftis = self.__nii_dict[tag]
+            matched_niftis = self.__get_nii_dict()[tag]
         except KeyError:
             matched_niftis = []
         return matched_niftis
 
     def get_tagged_dcm(self, tag):
         try:
-            matched_dicoms = self.__dcm_dict[tag]
+            matched_dicoms = self.__get_dcm_dict()[tag]
         except KeyError:
             matched_dicoms = []
         return matched_dicoms
@@ -196,6 +255,16 @@ class Scan(DatmanNamed):
             db_session = None
         return db_session
 
+    def __get_nii_dict(self):
+        if self.__nii_dict is None:
+            self.__nii_dict = self.__make_dict(self.niftis)
+        return self.__nii_dict
+
+    def __get_dcm_dict(self):
+        if self.__dcm_dict is None:
+            self.__dcm_dict = self.__make_dict(self.dicoms)
+        return self.__dcm_dict
+
     def __check_session(self, id_str):
         """
         Adds a default session number of "_01" if it's missing and the id
@@ -219,10 +288,9 @@ class Scan(DatmanNamed):
         This method will generate a ParseException if any files are not named
         according to the datman naming convention.
         """
-        glob_path = os.path.join(path, "*")
         series_list = []
         badly_named = []
-        for item in glob.glob(glob_path):
+        for item in list_files(path):
             if datman.utils.get_extension(item) in ext_list:
                 try:
                     series = Series(item)
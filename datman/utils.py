@@ -113,6 +113,58 @@ def check_blacklist(scan_name, study=None):
                     return
 
 
+def get_blacklist_comments(scan_names, study):
+    """Like check_blacklist() for many scans of one study at once, reading
+    the blacklist only once.
+
+    Returns a dictionary of scan name: blacklist comment, with None for scans
+    that aren't blacklisted or have no comment.
+    """
+    comments = dict((scan_name, None) for scan_name in scan_names)
+
+    blacklist_ids = {}
+    for scan_name in scan_names:
+        try:
+            ident, tag, series_num, _ = scanid.parse_filename(scan_name)
+        except scanid.ParseException:
+            logger.warning('Invalid session id:{}'.format(scan_name))
+            continue
+        blacklist_ids[scan_name] = "_".join([str(ident), tag, series_num])
+    if not blacklist_ids:
+        return comments
+
+    cfg = datman.config.config(study=study)
+    try:
+        blacklist_path = os.path.join(cfg.get_path('meta'), 'blacklist.csv')
+    except KeyError:
+        logger.warning('Unable to identify meta path for study:{}'
+                       .format(study))
+        return comments
+
+    try:
+        with open(blacklist_path, 'r') as f:
+            lines = f.readlines()
+    except IOError:
+        logger.warning('Unable to open blacklist file:{} for reading'
+                       .format(blacklist_path))
+        return comments
+
+    entries = []
+    for line in lines:
+        parts = line.split(None, 1)
+        if parts:  # fix for empty lines
+            entries.append(parts)
+
+    for scan_name, blacklist_id in blacklist_ids.items():
+        for parts in entries:
+            if blacklist_id in parts[0]:
+                try:
+                    comments[scan_name] = parts[1].strip()
+                except IndexError:
+                    pass
+                break
+    return comments
+
 def get_subject_from_filename(filename):
     filename = os.path.basename(filename)
     filename = filename.split('_')[0:5]
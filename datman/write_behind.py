@@ -0,0 +1,127 @@
+"""
+Runs updates that nothing waits on (e.g. dashboard database writes) in a
+background thread, so slow writes don't hold up the caller.
+
+    updates = WriteBehindQueue(lambda: datman.dashboard.dashboard(study))
+    updates.put('session STUDY_CMH_0001_01', add_session, 'STUDY_CMH_0001_01')
+    ...
+    failed = updates.close()
+
+The object returned by 'setup' is made in the worker thread, so anything it
+holds that's tied to a thread (like a database session) belongs to the
+worker. Each task is called with it followed by the task's own arguments.
+
+The queue is bounded: put() waits when it's full, so a stalled database slows
+the caller down rather than letting updates pile up without limit. If the
+worker stops unexpectedly put() and flush() raise RuntimeError instead of
+waiting forever. The worker runs the tasks one at a time, in the order they
+were queued, and each task does its own database commits. A task that raises
+is logged and recorded in 'failed' (with its description and the error), and
+the rest carry on. flush() waits until every task queued so far is done and
+close() does the same before stopping the worker.
+"""
+import logging
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the tasks for the worker
+_STOP = object()
+# How often (in seconds) a waiting put() or flush() checks the worker is
+# still running
+CHECK_INTERVAL = 1
+
+class WriteBehindQueue(object):
+    """
+    A background worker that runs queued tasks.
+
+        setup:      A callable returning the object each task is given as
+                    its first argument, made in the worker thread.
+        maxsize:    The most tasks that can wait at once.
+    """
+    def __init__(self, setup, maxsize=100):
+        self.failed = []
+        self._setup = setup
+        self._queue = queue.Queue(maxsize)
+        self._worker = threading.Thread(target=self._run,
+                name='write-behind')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def put(self, description, task, *args, **kwargs):
+        """
+        Queues task(setup_result, *args, **kwargs) to run in the worker.
+        Waits for room if the queue is full.
+        """
+        while True:
+            if not self._worker.is_alive():
+                raise RuntimeError("Can't queue {}, the queue is closed"
+                        .format(description))
+            try:
+                self._queue.put((description, task, args, kwargs),
+                        timeout=CHECK_INTERVAL)
+                return
+            except queue.Full:
+                continue
+
+    def flush(self):
+        """
+        Waits until every task queued so far has run.
+        """
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                if not self._worker.is_alive():
+                    raise RuntimeError("The write-behind worker stopped with "
+                            "{} tasks left".format(
+                            self._queue.unfinished_tasks))
+                self._queue.all_tasks_done.wait(CHECK_INTERVAL)
+
+    def close(self):
+        """
+        Runs every queued task, stops the worker and returns the list of
+        (description, error) for each task that failed. Each failure has
+        already been logged when it happened.
+        """
+        if self._worker.is_alive():
+            self._queue.put(_STOP)
+            self._worker.join()
+        return self.failed
+
+    def _run(self):
+        try:
+            target = self._setup()
+        except Exception as e:
+            logger.error("Failed to set up the write-behind worker. "
+                    "Reason: {}".format(e))
+            target = None
+            setup_error = e
+        else:
+            setup_error = None
+
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                if setup_error is not None:
+                    self._fail(item[0], setup_error)
+                else:
+                    self._run_task(target, *item)
+            finally:
+                self._queue.task_done()
+
+    def _run_task(self, target, description, task, args, kwargs):
+        try:
+            task(target, *args, **kwargs)
+        except Exception as e:
+            self._fail(description, e)
+
+    def _fail(self, description, error):
+        logger.error("Queued update {} failed. Reason: {}".format(description,
+                error))
+        self.failed.append((description, error))
@@ -28,5 +28,6 @@ setup(
        'Intended Audience :: Science/Research',
     ],
     install_requires=['docopt', 'matplotlib', 'numpy', 'pandas', 'requests',
-        'scipy', 'scikit-image', 'pyyaml', 'nibabel', 'pydicom', 'qbatch'],
+        'scipy', 'scikit-image', 'pyyaml', 'nibabel', 'pydicom', 'qbatch',
+        'pillow', 'scandir'],
  )
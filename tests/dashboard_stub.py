@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+"""
+A stand-in for the dashboard package (its 'db' object and the models
+datman.dashboard uses) on a local SQLite file, so datman.dashboard can be
+tested and benchmarked without the production database.
+
+Usage:
+    dashboard_stub.py [options]
+
+Options:
+    --db FILE           The SQLite file to use. A temporary one is made (and
+                        removed) if not given.
+    --sessions N        The number of sessions to seed the study with
+                        [default: 2000]
+    --scans N           The number of scans in each session [default: 10]
+    --repeat N          How many times to time each operation [default: 20]
+
+Run on its own it seeds a synthetic study and prints the time and number of
+SQL statements each datman.dashboard operation takes. Tests use it by
+calling install() before importing datman.dashboard:
+
+    import dashboard_stub
+    dashboard_stub.install()
+    import datman.dashboard
+"""
+import os
+import sys
+import time
+import types
+import shutil
+import tempfile
+from datetime import datetime
+
+from mock import patch
+from sqlalchemy import (create_engine, event, Table, Column, Integer, String,
+        Boolean, DateTime, ForeignKey)
+from sqlalchemy.orm import scoped_session, sessionmaker, relationship
+from sqlalchemy.ext.declarative import declarative_base
+
+STUDY = 'STUDY'
+SITES = ['CMH', 'MRC', 'ZHH']
+SCANTYPES = ['T1', 'T2', 'PDT2', 'DTI60-1000', 'RST', 'EMP', 'OBS', 'IMI',
+             'FMAP', 'SPRL']
+
+Base = declarative_base()
+
+class Database(object):
+    """
+    Mimics the flask-sqlalchemy object datman.dashboard uses as 'db'.
+    """
+    def __init__(self):
+        self.session = scoped_session(sessionmaker())
+        self.engine = None
+
+db = Database()
+Base.query = db.session.query_property()
+
+study_sites = Table('study_sites', Base.metadata,
+        Column('study_id', Integer, ForeignKey('studies.id')),
+        Column('site_id', Integer, ForeignKey('sites.id')))
+
+study_scantypes = Table('study_scantypes', Base.metadata,
+        Column('study_id', Integer, ForeignKey('studies.id')),
+        Column('scantype_id', Integer, ForeignKey('scantypes.id')))
+
+class Study(Base):
+    __tablename__ = 'studies'
+    id = Column(Integer, primary_key=True)
+    nickname = Column(String(32), index=True)
+    sites = relationship('Site', secondary=study_sites)
+    scantypes = relationship('ScanType', secondary=study_scantypes)
+
+class Site(Base):
+    __tablename__ = 'sites'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(32))
+
+class ScanType(Base):
+    __tablename__ = 'scantypes'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(32), index=True)
+
+class Session(Base):
+    __tablename__ = 'sessions'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(64), index=True)
+    study_id = Column(Integer, ForeignKey('studies.id'), index=True)
+    site_id = Column(Integer, ForeignKey('sites.id'))
+    date = Column(DateTime)
+    is_phantom = Column(Boolean, default=False)
+    is_repeated = Column(Boolean, default=False)
+    repeat_count = Column(Integer, default=1)
+    cl_comment = Column(String(256))
+    study = relationship('Study')
+    site = relationship('Site')
+    scans = relationship('Session_Scan', back_populates='session')
+
+    def delete(self):
+        db.session.delete(self)
+        db.session.commit()
+
+class Scan(Base):
+    __tablename__ = 'scans'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(128), index=True)
+    series_number = Column(Integer)
+    scantype_id = Column(Integer, ForeignKey('scantypes.id'))
+    description = Column(String(128))
+    repeat_number = Column(Integer)
+    bl_comment = Column(String(256))
+    scantype = relationship('ScanType')
+
+class Session_Scan(Base):
+    __tablename__ = 'session_scans'
+    id = Column(Integer, primary_key=True)
+    session_id = Column(Integer, ForeignKey('sessions.id'), index=True)
+    scan_id = Column(Integer, ForeignKey('scans.id'), index=True)
+    is_primary = Column(Boolean, default=True)
+    scan_name = Column(String(128))
+    session = relationship('Session', back_populates='scans')
+    scan = relationship('Scan')
+
+def install():
+    """
+    Makes this module importable as 'dashboard' (with 'dashboard.models').
+    """
+    if 'dashboard' in sys.modules:
+        return sys.modules['dashboard']
+    models = types.ModuleType('dashboard.models')
+    for model in [Study, Site, ScanType, Session, Scan, Session_Scan]:
+        setattr(models, model.__name__, model)
+    package = types.ModuleType('dashboard')
+    package.db = db
+    package.models = models
+    sys.modules['dashboard'] = package
+    sys.modules['dashboard.models'] = models
+    return package
+
+def use_database(path):
+    """
+    Points the stand-in at a new (empty) SQLite file and makes the tables.
+    """
+    db.session.remove()
+    if db.engine is not None:
+        db.engine.dispose()
+    db.engine = create_engine('sqlite:///{}'.format(path))
+    db.session.configure(bind=db.engine)
+    Base.metadata.create_all(db.engine)
+    return db.engine
+
+def patch_datman():
+    """
+    Starts (and returns) patches for the config and metadata lookups
+    datman.dashboard makes, so they don't need a real study.
+    """
+    patches = [patch('datman.config.config'),
+               patch('datman.utils.check_checklist', return_value=None),
+               patch('datman.utils.check_blacklist', return_value=None),
+               patch('datman.utils.get_blacklist_comments',
+                     side_effect=lambda names, study: dict.fromkeys(names))]
+    mocks = [item.start() for item in patches]
+    mocks[0].return_value.map_xnat_archive_to_project.side_effect = \
+            lambda study: study
+    return patches
+
+def session_name(site, number):
+    return '{}_{}_{:04d}_01'.format(STUDY, site, number)
+
+def scan_name(session, scantype, series, repeat='01'):
+    return '{}_{}_{}_{:02d}_{}-desc'.format(session, repeat, scantype,
+            series, scantype)
+
+def seed(n_sessions, n_scans):
+    """
+    Fills the database with one study, its sites and scantypes, and
+    n_sessions sessions (spread over the sites) each with n_scans primary
+    scans.
+    """
+    engine = db.engine
+    with engine.begin() as connection:
+        connection.execute(Study.__table__.insert(), [{'id': 1,
+                'nickname': STUDY}])
+        connection.execute(Site.__table__.insert(), [{'id': number + 1,
+                'name': site} for number, site in enumerate(SITES)])
+        connection.execute(ScanType.__table__.insert(), [{'id': number + 1,
+                'name': name} for number, name in enumerate(SCANTYPES)])
+        connection.execute(study_sites.insert(), [{'study_id': 1,
+                'site_id': number + 1} for number in range(len(SITES))])
+        connection.execute(study_scantypes.insert(), [{'study_id': 1,
+                'scantype_id': number + 1}
+                for number in range(len(SCANTYPES))])
+
+        sessions = []
+        scans = []
+        links = []
+        for number in range(n_sessions):
+            site_id = number % len(SITES) + 1
+            name = session_name(SITES[site_id - 1], number)
+            sessions.append({'id': number + 1, 'name': name, 'study_id': 1,
+                    'site_id': site_id, 'date': datetime(2017, 1, 1),
+                    'is_phantom': False, 'is_repeated': False,
+                    'repeat_count': 1})
+            for series in range(n_scans):
+                scan_id = len(scans) + 1
+                scantype_id = series % (len(SCANTYPES) - 1) + 1
+                scantype = SCANTYPES[scantype_id - 1]
+                scan = scan_name(name, scantype, series + 1)
+                scans.append({'id': scan_id,
+                        'name': scan.rsplit('_', 1)[0],
+                        'series_number': series + 1,
+                        'scantype_id': scantype_id,
+                        'description': scantype + '-desc',
+                        'repeat_number': 1})
+                links.append({'session_id': number + 1, 'scan_id': scan_id,
+                        'is_primary': True,
+                        'scan_name': scan.rsplit('_', 1)[0]})
+        connection.execute(Session.__table__.insert(), sessions)
+        connection.execute(Scan.__table__.insert(), scans)
+        connection.execute(Session_Scan.__table__.insert(), links)
+
+def session_scans(number, n_scans):
+    """
+    Returns the session name and file names of the scans seed() made for
+    session 'number'.
+    """
+    name = session_name(SITES[number % len(SITES)], number)
+    scans = [scan_name(name, SCANTYPES[series % (len(SCANTYPES) - 1)],
+             series + 1) for series in range(n_scans)]
+    return name, scans
+
+class StatementCounter(object):
+    """
+    Counts the SQL statements run on an engine while in use as a context
+    manager.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+        self.statements = []
+
+    def _record(self, conn, cursor, statement, parameters, context,
+            executemany):
+        self.count += 1
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+def benchmark(operation, repeat):
+    """
+    Runs operation(number) for each number in range(repeat) and returns the
+    mean time and the mean number of SQL statements per call.
+    """
+    with StatementCounter(db.engine) as counter:
+        start = time.time()
+        for number in range(repeat):
+            operation(number)
+        elapsed = time.time() - start
+    return elapsed / repeat, counter.count / float(repeat)
+
+def main():
+    from datman.docopt import docopt
+    arguments = docopt(__doc__)
+    n_sessions = int(arguments['--sessions'])
+    n_scans = int(arguments['--scans'])
+    repeat = min(int(arguments['--repeat']), n_sessions)
+
+    tmp_dir = None
+    path = arguments['--db']
+    if not path:
+        tmp_dir = tempfile.mkdtemp(prefix='dashboard_stub')
+        path = os.path.join(tmp_dir, 'dashboard.sqlite')
+
+    install()
+    patch_datman()
+    import datman.dashboard
+
+    try:
+        use_database(path)
+        start = time.time()
+        seed(n_sessions, n_scans)
+        print('Seeded {} sessions with {} scans each in {:.2f}s'.format(
+                n_sessions, n_scans, time.time() - start))
+
+        dashboard = datman.dashboard.dashboard(STUDY)
+
+        def get_add_session(number):
+            dashboard.get_add_session(session_scans(number, n_scans)[0])
+
+        def get_add_scan(number):
+            dashboard.get_add_scan(session_scans(number, n_scans)[1][0])
+
+        def get_add_scans(number):
+            name, scans = session_scans(number, n_scans)
+            dashboard.get_add_scans(name, scans)
+
+        def add_new_session(number):
+            name, scans = session_scans(n_sessions + number, n_scans)
+            dashboard.get_add_scans(name, scans, create=True)
+
+        def delete_extra_scans(number):
+            name, scans = session_scans(number, n_scans)
+            dashboard.delete_extra_scans(name + '_01', scans[:-1])
+
+        def link_scan(number):
+            target = dashboard.get_add_session(
+                    session_scans(number + 1, n_scans)[0])
+            scan = dashboard.get_add_scan(session_scans(number, n_scans)[1][0])
+            datman.dashboard.get_add_session_scan_link(target, scan)
+
+        print('{:<20} {:>12} {:>12}'.format('operation', 'ms/call',
+                'SQL/call'))
+        for operation in [get_add_session, get_add_scan, get_add_scans,
+                          add_new_session, delete_extra_scans, link_scan]:
+            seconds, statements = benchmark(operation, repeat)
+            print('{:<20} {:>12.2f} {:>12.1f}'.format(operation.__name__,
+                    seconds * 1000, statements))
+    finally:
+        db.session.remove()
+        if tmp_dir:
+            shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
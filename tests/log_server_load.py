@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+Replays logging from many clients at once against dm_log_server.py and
+reports how fast the records are taken and how long clients are held up.
+
+Usage:
+    log_server_load.py [options]
+
+Options:
+    --clients N         The number of clients logging at once [default: 200]
+    --records N         The number of records each client sends
+                        [default: 500]
+    --host STR          The log server to test. If not given a server is
+                        started on a free local port, writing to a temporary
+                        folder, and the records written are counted.
+    --port N            The log server's port [default: 9020]
+    --json              Have the started server write json lines
+
+Each client is a thread with its own logging.handlers.SocketHandler sending
+DEBUG records, the way a cluster job using --log-to-server does. The time
+spent in each emit() is what a client would lose to logging.
+"""
+import os
+import sys
+import time
+import shutil
+import logging
+import logging.handlers
+import tempfile
+import threading
+import importlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from datman.docopt import docopt
+
+log_server = importlib.import_module('bin.dm_log_server')
+
+def run_client(host, port, number, records, waits):
+    handler = logging.handlers.SocketHandler(host, port)
+    name = 'load_client_{}'.format(number)
+    longest = 0.0
+    for count in range(records):
+        record = logging.makeLogRecord({'name': name,
+                'levelname': 'DEBUG', 'levelno': logging.DEBUG,
+                'msg': 'record {} of {} from client {}'.format(count,
+                        records, number)})
+        start = time.time()
+        handler.emit(record)
+        longest = max(longest, time.time() - start)
+    handler.close()
+    waits[number] = longest
+
+def start_server(log_dir, json_lines, n_clients):
+    socket_map = {}
+    log_files = log_server.LogFiles(log_dir, json_lines)
+    receiver = log_server.LogRecordReceiver('127.0.0.1', 0, log_files,
+            map=socket_map)
+    stopped = threading.Event()
+    # once stopped, carry on until every client connection is read and closed
+    done = lambda: (stopped.is_set() and receiver.connections == n_clients
+            and list(socket_map.values()) == [receiver])
+    thread = threading.Thread(target=log_server.serve, args=(log_files,),
+            kwargs={'flush_interval': 0.5, 'map': socket_map, 'stop': done})
+    thread.daemon = True
+    thread.start()
+    return receiver.socket.getsockname()[1], stopped, thread
+
+def count_lines(log_dir):
+    total = 0
+    for name in os.listdir(log_dir):
+        with open(os.path.join(log_dir, name)) as log:
+            total += sum(1 for _ in log)
+    return total
+
+def main():
+    arguments = docopt(__doc__)
+    n_clients = int(arguments['--clients'])
+    n_records = int(arguments['--records'])
+    host = arguments['--host']
+    port = int(arguments['--port'])
+
+    log_dir = None
+    if host is None:
+        log_dir = tempfile.mkdtemp(prefix='log_server_load')
+        host = '127.0.0.1'
+        port, stopped, server = start_server(log_dir, arguments['--json'],
+                n_clients)
+
+    try:
+        waits = [0.0] * n_clients
+        clients = [threading.Thread(target=run_client,
+                args=(host, port, number, n_records, waits))
+                for number in range(n_clients)]
+        start = time.time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.time() - start
+
+        total = n_clients * n_records
+        print('Sent {} records from {} clients in {:.2f}s ({:.0f} '
+                'records/s)'.format(total, n_clients, elapsed,
+                total / elapsed))
+        waits.sort()
+        print('Longest emit per client: median {:.1f}ms, max {:.1f}ms'.format(
+                waits[len(waits) // 2] * 1000, waits[-1] * 1000))
+
+        if log_dir:
+            stopped.set()
+            server.join()
+            written = count_lines(log_dir)
+            print('Server wrote {} of {} records in {:.2f}s'.format(written,
+                    total, time.time() - start))
+    finally:
+        if log_dir:
+            shutil.rmtree(log_dir)
+
+if __name__ == '__main__':
+    main()
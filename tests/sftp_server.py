@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""
+A local stand-in for the scanner sftp server, serving files from a folder.
+
+Used by the dm_sftp tests, and can be run on its own to benchmark dm_sftp
+without access to a real server (point FTPSERVER at localhost and FTPPORT at
+the port it prints).
+
+Usage:
+    sftp_server.py [options] <root>
+
+Arguments:
+    <root>              Folder to serve. Users log in with any user name and
+                        the password given by --password
+
+Options:
+    --port N            Port to listen on, 0 picks a free port [default: 0]
+    --password STR      Password to accept [default: password]
+    --delay SECS        Seconds to wait before answering each read, to mimic
+                        a slow link [default: 0]
+"""
+import os
+import socket
+import threading
+import time
+
+import paramiko
+from paramiko.sftp import SFTP_PERMISSION_DENIED
+
+
+class StubServer(paramiko.ServerInterface):
+    def __init__(self, password):
+        self.password = password
+
+    def check_auth_password(self, username, password):
+        if password == self.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+
+class StubSFTPHandle(paramiko.SFTPHandle):
+    delay = 0
+
+    def read(self, offset, length):
+        if self.delay:
+            time.sleep(self.delay)
+        return paramiko.SFTPHandle.read(self, offset, length)
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(
+                    os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class StubSFTPServer(paramiko.SFTPServerInterface):
+    """Read only sftp access to the folder given as 'root'"""
+    def __init__(self, server, root, delay=0, *args, **kwargs):
+        paramiko.SFTPServerInterface.__init__(self, server, *args, **kwargs)
+        self.root = root
+        self.delay = delay
+
+    def _realpath(self, path):
+        return os.path.join(self.root, self.canonicalize(path).lstrip('/'))
+
+    def list_folder(self, path):
+        path = self._realpath(path)
+        try:
+            contents = []
+            for fname in os.listdir(path):
+                attr = paramiko.SFTPAttributes.from_stat(
+                        os.stat(os.path.join(path, fname)))
+                attr.filename = fname
+                contents.append(attr)
+            return contents
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(
+                    os.stat(self._realpath(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(
+                    os.lstat(self._realpath(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            return SFTP_PERMISSION_DENIED
+        try:
+            readfile = open(self._realpath(path), 'rb')
+        except IOError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        handle = StubSFTPHandle(flags)
+        handle.filename = self._realpath(path)
+        handle.readfile = readfile
+        handle.delay = self.delay
+        return handle
+
+    def canonicalize(self, path):
+        return os.path.normpath('/' + path.lstrip('/')) if path != '.' \
+                else '/'
+
+
+class SFTPServer(object):
+    """
+    Serves <root> over sftp on localhost from a background thread.
+
+    >>> with SFTPServer('/some/folder') as server:
+    ...     pysftp.Connection('localhost', port=server.port, ...)
+    """
+    def __init__(self, root, port=0, password='password', delay=0):
+        self.root = root
+        self.password = password
+        self.delay = delay
+        self.host_key = paramiko.RSAKey.generate(1024)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('127.0.0.1', port))
+        self.port = self.socket.getsockname()[1]
+        self.connections = 0
+        self._transports = []
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def start(self):
+        self.socket.listen(100)
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def serve_forever(self):
+        while True:
+            try:
+                client, _ = self.socket.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer,
+                                            StubSFTPServer, self.root,
+                                            self.delay)
+            transport.start_server(server=StubServer(self.password))
+            self._transports.append(transport)
+
+    def stop(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket.close()
+        for transport in self._transports:
+            transport.close()
+        if self._thread:
+            self._thread.join()
+
+
+def main():
+    from datman.docopt import docopt
+    arguments = docopt(__doc__)
+    server = SFTPServer(os.path.abspath(arguments['<root>']),
+                        port=int(arguments['--port']),
+                        password=arguments['--password'],
+                        delay=float(arguments['--delay']))
+    server.start()
+    print('Serving {} on localhost port {}'.format(server.root, server.port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
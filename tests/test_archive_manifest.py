@@ -0,0 +1,145 @@
+import os
+import shutil
+import tempfile
+import unittest
+import importlib
+import StringIO
+
+from mock import MagicMock, patch
+
+manifest = importlib.import_module('bin.archive-manifest')
+
+HEADERS = ['Path', 'SeriesNumber', 'SeriesDescription']
+
+def fake_headers(archive):
+    """Three series per archive, out of order, named for the archive"""
+    return dict(('{}/series{}'.format(archive, number),
+                 {'SeriesNumber': number,
+                  'SeriesDescription': '{}-desc{}'.format(archive, number)})
+                for number in [3, 1, 2])
+
+class TestGetManifestRows(unittest.TestCase):
+    @patch('datman.utils.get_archive_headers', side_effect=fake_headers)
+    def test_rows_sorted_by_series_with_string_values(self, mock_headers):
+        rows = manifest.get_manifest_rows('exam.zip', HEADERS)
+
+        assert [row['Path'] for row in rows] == ['exam.zip/series1',
+                'exam.zip/series2', 'exam.zip/series3']
+        assert rows[0]['SeriesNumber'] == '1'
+        assert rows[0]['SeriesDescription'] == 'exam.zip-desc1'
+
+    @patch('datman.utils.get_archive_headers', side_effect=fake_headers)
+    def test_missing_headers_left_empty(self, mock_headers):
+        rows = manifest.get_manifest_rows('exam.zip', HEADERS + ['StudyID'])
+
+        assert rows[0]['StudyID'] == ''
+
+    @patch('datman.utils.get_archive_headers', side_effect=fake_headers)
+    def test_only_first_series_with_oneseries(self, mock_headers):
+        rows = manifest.get_manifest_rows('exam.zip', HEADERS,
+                oneseries=True)
+
+        assert [row['Path'] for row in rows] == ['exam.zip/series1']
+
+class TestReadManifests(unittest.TestCase):
+    archives = ['exam{}.zip'.format(number) for number in range(6)]
+
+    def paths(self, jobs):
+        return [[row['Path'] for row in rows] for rows in
+                manifest.read_manifests(self.archives, HEADERS, jobs=jobs)]
+
+    @patch('datman.utils.get_archive_headers', side_effect=fake_headers)
+    def test_archives_read_in_order_with_one_job(self, mock_headers):
+        paths = self.paths(jobs=1)
+
+        assert [archive[0].split('/')[0] for archive in paths] == \
+                self.archives
+
+    @patch('datman.utils.get_archive_headers', side_effect=fake_headers)
+    def test_every_archive_read_with_many_jobs(self, mock_headers):
+        parallel = self.paths(jobs=3)
+
+        assert sorted(parallel) == sorted(self.paths(jobs=1))
+
+class TestCSVWriter(unittest.TestCase):
+    columns = sorted(HEADERS)
+    rows = [{'Path': 'exam/series1', 'SeriesNumber': '1',
+             'SeriesDescription': 'T1'},
+            {'Path': 'exam/series2', 'SeriesNumber': '2',
+             'SeriesDescription': 'Rest, eyes open'}]
+    expected = ('Path,SeriesDescription,SeriesNumber\n'
+                'exam/series1,T1,1\n'
+                'exam/series2,"Rest, eyes open",2\n')
+
+    def test_writes_file_with_unix_line_endings(self):
+        tmp = tempfile.mkdtemp(prefix='test_archive_manifest')
+        try:
+            output = os.path.join(tmp, 'manifest.csv')
+            writer = manifest.CSVWriter(output, self.columns)
+            writer.write(self.rows[:1])
+            writer.write(self.rows[1:])
+            writer.close()
+
+            with open(output, 'rb') as result:
+                assert result.read() == self.expected
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_prints_without_output(self):
+        stdout = StringIO.StringIO()
+        with patch('sys.stdout', stdout):
+            writer = manifest.CSVWriter(None, self.columns)
+            writer.write(self.rows)
+            writer.close()
+
+        assert stdout.getvalue() == self.expected
+        assert not stdout.closed
+
+class TestColumnarWriters(unittest.TestCase):
+    """pyarrow is optional, so a stand-in records what's written"""
+    columns = sorted(HEADERS)
+
+    def setUp(self):
+        self.pyarrow = MagicMock()
+        modules = {'pyarrow': self.pyarrow,
+                   'pyarrow.parquet': self.pyarrow.parquet,
+                   'pyarrow.feather': self.pyarrow.feather}
+        self.patcher = patch.dict('sys.modules', modules)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def rows(self, start, stop):
+        return [{'Path': 'exam/series{}'.format(number),
+                 'SeriesNumber': str(number), 'SeriesDescription': 'T1'}
+                for number in range(start, stop)]
+
+    def test_parquet_written_one_row_group_per_batch(self):
+        writer = manifest.get_writer('parquet', 'manifest.parquet',
+                self.columns)
+        writer.write(self.rows(0, 2))
+        writer.write(self.rows(2, 3))
+        writer.close()
+
+        from_pandas = self.pyarrow.Table.from_pandas
+        batches = [call[0][0] for call in from_pandas.call_args_list]
+        assert [len(batch) for batch in batches] == [2, 1]
+        assert list(batches[0].columns) == self.columns
+        parquet_writer = self.pyarrow.parquet.ParquetWriter.return_value
+        assert parquet_writer.write_table.call_count == 2
+        assert parquet_writer.close.called
+
+    def test_feather_written_once_at_close(self):
+        writer = manifest.get_writer('feather', 'manifest.feather',
+                self.columns)
+        writer.write(self.rows(0, 2))
+        writer.write(self.rows(2, 3))
+        assert not self.pyarrow.feather.write_feather.called
+
+        writer.close()
+
+        data, output = self.pyarrow.feather.write_feather.call_args[0]
+        assert output == 'manifest.feather'
+        assert list(data.columns) == self.columns
+        assert list(data['SeriesNumber']) == ['0', '1', '2']
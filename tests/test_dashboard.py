@@ -0,0 +1,147 @@
+import os
+import shutil
+import tempfile
+import unittest
+import logging
+
+from mock import patch
+
+import dashboard_stub
+
+dashboard_stub.install()
+import datman.dashboard
+import datman.exceptions
+
+logging.disable(logging.CRITICAL)
+
+N_SESSIONS = 1000
+N_SCANS = 10
+
+class TestDashboardQueries(unittest.TestCase):
+    """
+    Checks how many SQL statements each dashboard operation takes on a
+    seeded study, so that changes that add queries (or make the number grow
+    with the size of the study) are caught.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.patches = dashboard_stub.patch_datman()
+        cls.tmp = tempfile.mkdtemp(prefix='test_dashboard')
+        cls.engine = dashboard_stub.use_database(os.path.join(cls.tmp,
+                'dashboard.sqlite'))
+        dashboard_stub.seed(N_SESSIONS, N_SCANS)
+
+    @classmethod
+    def tearDownClass(cls):
+        dashboard_stub.db.session.remove()
+        for item in cls.patches:
+            item.stop()
+        shutil.rmtree(cls.tmp)
+
+    def setUp(self):
+        self.db = datman.dashboard.dashboard(dashboard_stub.STUDY)
+
+    def tearDown(self):
+        dashboard_stub.db.session.rollback()
+
+    def count(self, operation, *args, **kwargs):
+        with dashboard_stub.StatementCounter(self.engine) as counter:
+            result = operation(*args, **kwargs)
+        return result, counter.count
+
+    def test_study_loaded_in_one_query(self):
+        _, statements = self.count(datman.dashboard.dashboard,
+                dashboard_stub.STUDY)
+
+        assert statements == 1
+
+    def test_get_add_session(self):
+        name, _ = dashboard_stub.session_scans(10, N_SCANS)
+
+        session, statements = self.count(self.db.get_add_session, name)
+
+        assert session.name == name
+        assert statements <= 2
+
+    def test_get_add_scan(self):
+        _, scans = dashboard_stub.session_scans(11, N_SCANS)
+
+        scan, statements = self.count(self.db.get_add_scan, scans[3])
+
+        assert scan is not None
+        assert statements <= 2
+
+    def test_get_add_scans_for_existing_session(self):
+        name, scans = dashboard_stub.session_scans(12, N_SCANS)
+
+        found, statements = self.count(self.db.get_add_scans, name, scans)
+
+        assert sorted(found) == sorted(scans)
+        # doesn't depend on the number of scans
+        assert statements <= 3
+
+    def test_get_add_scans_for_new_session(self):
+        name, scans = dashboard_stub.session_scans(N_SESSIONS + 1, N_SCANS)
+
+        found, statements = self.count(self.db.get_add_scans, name, scans,
+                create=True)
+
+        assert sorted(found) == sorted(scans)
+        # one insert for each scan and each link, and at most one read of
+        # each scantype
+        assert statements <= 4 + len(dashboard_stub.SCANTYPES) + 2 * N_SCANS
+        assert len(self.db.get_add_session(name).scans) == N_SCANS
+
+    def test_get_add_scans_rolls_back_failed_flush(self):
+        name, scans = dashboard_stub.session_scans(N_SESSIONS + 2, N_SCANS)
+
+        with patch.object(dashboard_stub.db.session, 'flush',
+                side_effect=Exception('constraint failed')):
+            self.assertRaises(datman.exceptions.DashboardException,
+                    self.db.get_add_scans, name, scans, create=True)
+
+        # nothing was left pending and the session can still be used
+        assert not dashboard_stub.db.session.new
+        assert self.db.get_add_session(name) is None
+        found = self.db.get_add_scans(name, scans, create=True)
+        assert sorted(found) == sorted(scans)
+
+    def test_delete_extra_scans(self):
+        name, scans = dashboard_stub.session_scans(13, N_SCANS)
+
+        _, statements = self.count(self.db.delete_extra_scans, name + '_01',
+                scans[:-2])
+
+        assert statements <= 5
+        remaining = [link.scan_name for link in
+                     self.db.get_add_session(name).scans]
+        assert len(remaining) == N_SCANS - 2
+        assert scans[-1].rsplit('_', 1)[0] not in remaining
+
+    def test_delete_extra_scans_keeps_linked_scans(self):
+        source, scans = dashboard_stub.session_scans(14, N_SCANS)
+        target, _ = dashboard_stub.session_scans(15, N_SCANS)
+        link = datman.dashboard.get_add_session_scan_link(
+                self.db.get_add_session(target), self.db.get_add_scan(scans[0]))
+
+        self.db.delete_extra_scans(target + '_01', [])
+
+        links = self.db.get_add_session(target).scans
+        assert [item.scan_name for item in links] == [link.scan_name]
+
+    def test_link_helper(self):
+        _, scans = dashboard_stub.session_scans(16, N_SCANS)
+        target, _ = dashboard_stub.session_scans(17, N_SCANS)
+        session = self.db.get_add_session(target)
+        scan = self.db.get_add_scan(scans[0])
+
+        _, new_statements = self.count(
+                datman.dashboard.get_add_session_scan_link, session, scan)
+        session = self.db.get_add_session(target)
+        scan = self.db.get_add_scan(scans[0])
+        _, existing_statements = self.count(
+                datman.dashboard.get_add_session_scan_link, session, scan)
+
+        # the session and scan are re-read after the commits that made them
+        assert new_statements <= 4
+        assert existing_statements <= 3
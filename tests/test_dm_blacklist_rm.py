@@ -1,4 +1,6 @@
 import os
+import shutil
+import tempfile
 import unittest
 import importlib
 
@@ -65,41 +67,96 @@ class GetSearchPaths(unittest.TestCase):
 
         assert sorted(search_paths) == sorted(expected)
 
+class BlacklistMatcher(unittest.TestCase):
+    matcher = remove.BlacklistMatcher(['STUDY_SITE_0001_01_01_T1_02_SagT1',
+            'STUDY_SITE_0002_01_01_DTI60-1000_05_Ax-DTI-60'])
+
+    def test_matches_names_starting_with_an_entry(self):
+        assert self.matcher.matches('STUDY_SITE_0001_01_01_T1_02_SagT1.nii.gz')
+        assert self.matcher.matches(
+                'STUDY_SITE_0002_01_01_DTI60-1000_05_Ax-DTI-60_FA.nii.gz')
+
+    def test_doesnt_match_other_names(self):
+        assert not self.matcher.matches(
+                'STUDY_SITE_0001_01_01_T1_03_SagT1.nii.gz')
+        assert not self.matcher.matches('STUDY_SITE_0001')
+        assert not self.matcher.matches('qc_STUDY_SITE_0001_01_01_T1_02_SagT1')
+
 class FindFiles(unittest.TestCase):
-    search_path = '/some/path/some/where'
-    item = 'STUDY_SITE_ID_01_01_TAG_NUM_DESCR'
+    item = 'STUDY_SITE_ID_01_01_TAG_01_DESCR'
+
+    def setUp(self):
+        self.search_path = tempfile.mkdtemp(prefix='test_blacklist_rm')
+        self.matcher = remove.BlacklistMatcher([self.item])
+
+    def tearDown(self):
+        shutil.rmtree(self.search_path)
+
+    def make(self, *path):
+        full_path = os.path.join(self.search_path, *path)
+        if not os.path.exists(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        with open(full_path, 'w') as output:
+            output.write('data')
+        return full_path
+
+    def test_returns_empty_list_when_no_results(self):
+        self.make('STUDY_SITE_ID_01', 'STUDY_SITE_ID_01_01_TAG_02_DESCR.nii')
+
+        assert remove.find_files(self.search_path, self.matcher) == []
+
+    def test_finds_matches_in_all_subfolders(self):
+        expected = [self.make('STUDY_SITE_ID_01', self.item + '.nii'),
+                    self.make('STUDY_SITE_ID_01', self.item + '.bvec'),
+                    self.make('pipeline', 'STUDY_SITE_ID_01',
+                            self.item + '_FA.nii.gz')]
+        self.make('STUDY_SITE_ID_01', 'STUDY_SITE_ID_01_01_TAG_02_DESCR.nii')
+
+        actual = remove.find_files(self.search_path, self.matcher)
+
+        assert sorted(actual) == sorted(expected)
+
+    def test_doesnt_return_matching_folders(self):
+        os.makedirs(os.path.join(self.search_path, self.item))
+
+        assert remove.find_files(self.search_path, self.matcher) == []
+
+class CollectBlacklistedItems(unittest.TestCase):
+    item = 'STUDY_SITE_ID_01_01_TAG_01_DESCR'
 
-    @patch('datman.utils.run')
-    def test_returns_empty_list_when_no_results(self, mock_find):
-        mock_find.return_value = (0, '')
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='test_blacklist_rm')
+        self.paths = {}
+        for key in ['nii', 'dcm', 'qc']:
+            self.paths[key] = os.path.join(self.root, key)
+            os.makedirs(self.paths[key])
+            with open(os.path.join(self.paths[key], self.item + '.nii'),
+                    'w') as output:
+                output.write('data')
+        self.config = MagicMock()
+        self.config.get_key.return_value = self.paths
+        self.config.get_path.side_effect = lambda key: self.paths[key]
 
-        actual_result = remove.find_files(self.search_path, self.item)
-        expected_result = []
+    def tearDown(self):
+        shutil.rmtree(self.root)
 
-        assert actual_result == expected_result
+    def test_searches_paths_in_parallel(self):
+        found = remove.collect_blacklisted_items([self.item], self.config,
+                ['qc'], jobs=2)
 
-    @patch('datman.utils.run')
-    def test_doesnt_include_empty_string_in_result_list(self, mock_find):
-        # Without the .strip() argument, the empty string will always appear as
-        # as the last item in the returned list. This test should fail if it is
-        # removed for any reason, to guard against this problem.
-        mock_find.return_value = (0, '{}/{}.dcm\n'.format(self.search_path,
-                self.item))
+        assert sorted(found) == sorted([
+                os.path.join(self.paths['nii'], self.item + '.nii'),
+                os.path.join(self.paths['dcm'], self.item + '.nii')])
 
-        actual_result = remove.find_files(self.search_path, self.item)
-        expected_result = ['{}/{}.dcm'.format(self.search_path, self.item)]
+    def test_nested_paths_only_report_files_once(self):
+        self.paths['data'] = self.root
 
-        assert actual_result == expected_result
+        found = remove.collect_blacklisted_items([self.item], self.config,
+                ['qc'])
 
-    @patch('datman.utils.run')
-    def test_correctly_splits_string_with_multiple_matches(self, mock_find):
-        mock_find.return_value = (0, '{path}/{item}.nii\n{path}/{item}.bval\n'
-                    '{path}/{item}.bvec\n'.format(path=self.search_path,
-                    item=self.item))
+        assert len(found) == 3
 
-        actual_result = remove.find_files(self.search_path, self.item)
-        expected_result = ['{}/{}.nii'.format(self.search_path, self.item),
-                           '{}/{}.bval'.format(self.search_path, self.item),
-                           '{}/{}.bvec'.format(self.search_path, self.item)]
+    def test_space_reported_for_dry_run(self):
+        found = remove.collect_blacklisted_items([self.item], self.config, [])
 
-        assert sorted(actual_result) == sorted(expected_result)
+        assert remove.report_space(found) == 12
@@ -0,0 +1,71 @@
+import os
+import unittest
+import importlib
+import tempfile
+import logging
+
+from mock import patch
+
+logging.disable(logging.CRITICAL)
+
+link = importlib.import_module('bin.dm_link')
+
+
+class ReadLookupTable(unittest.TestCase):
+    def setUp(self):
+        handle, self.lookup_path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w') as lookup:
+            lookup.write("source_name target_name dicom_StudyID\n"
+                         "2014_0126_FB001 STUDY_CMH_FB001_01_01 512\n"
+                         "2014_0127_FB002 <ignore> 513\n"
+                         "2014_0126_FB001 STUDY_CMH_FB999_01_01 999\n")
+
+    def tearDown(self):
+        os.remove(self.lookup_path)
+
+    def test_indexes_rows_by_source_name(self):
+        index = link.read_lookup_table(self.lookup_path)
+        assert sorted(index.keys()) == ['2014_0126_FB001', '2014_0127_FB002']
+        assert index['2014_0127_FB002']['target_name'] == '<ignore>'
+
+    def test_first_row_is_used_for_duplicate_source_names(self):
+        index = link.read_lookup_table(self.lookup_path)
+        row = index['2014_0126_FB001']
+        assert row['target_name'] == 'STUDY_CMH_FB001_01_01'
+        assert row['dicom_StudyID'] == '512'
+
+
+class GetScanidFromLookupTable(unittest.TestCase):
+    lookup = {'2014_0126_FB001': {'source_name': '2014_0126_FB001',
+                                  'target_name': 'STUDY_CMH_FB001_01_01'}}
+
+    def test_returns_target_name_and_row_for_known_archive(self):
+        with patch.object(link, 'lookup', self.lookup):
+            scanid, info = link.get_scanid_from_lookup_table(
+                    '/zips/2014_0126_FB001.zip')
+        assert scanid == 'STUDY_CMH_FB001_01_01'
+        assert info == self.lookup['2014_0126_FB001']
+
+    def test_returns_none_for_unknown_archive(self):
+        with patch.object(link, 'lookup', self.lookup):
+            result = link.get_scanid_from_lookup_table('/zips/unknown.zip')
+        assert result is None
+
+
+class GetArchiveHeaders(unittest.TestCase):
+    @patch('bin.dm_link.read_headers')
+    def test_headers_read_at_most_once_per_archive(self, mock_read):
+        mock_read.return_value = {'PatientName': 'STUDY_CMH_FB001_01_01'}
+        with patch.object(link, 'headers', {}):
+            link.get_archive_headers('/zips/archive.zip')
+            link.get_archive_headers('/zips/archive.zip')
+        assert mock_read.call_count == 1
+
+    @patch('bin.dm_link.read_headers')
+    def test_read_archive_headers_maps_each_archive(self, mock_read):
+        mock_read.side_effect = lambda path: os.path.basename(path)
+        archives = ['/zips/a.zip', '/zips/b.zip', '/zips/c.zip']
+        result = link.read_archive_headers(archives, threads=2)
+        assert result == {'/zips/a.zip': 'a.zip',
+                          '/zips/b.zip': 'b.zip',
+                          '/zips/c.zip': 'c.zip'}
@@ -0,0 +1,200 @@
+import os
+import json
+import pickle
+import shutil
+import socket
+import struct
+import logging
+import logging.handlers
+import tempfile
+import threading
+import unittest
+import importlib
+
+from mock import MagicMock, patch
+
+log_server = importlib.import_module('bin.dm_log_server')
+
+def make_record(name='dm_qc_report.py', msg='message', level=logging.INFO):
+    return logging.makeLogRecord({'name': name, 'msg': msg,
+            'levelno': level, 'levelname': logging.getLevelName(level)})
+
+def frame(record):
+    data = pickle.dumps(record.__dict__, 1)
+    return struct.pack('>L', len(data)) + data
+
+class TestLogRecordChannel(unittest.TestCase):
+    def setUp(self):
+        self.log_files = MagicMock()
+        self.channel = log_server.LogRecordChannel(None, self.log_files,
+                map={})
+
+    def messages(self):
+        return [call[0][0].msg for call in
+                self.log_files.write.call_args_list]
+
+    def test_records_split_across_reads_are_joined(self):
+        data = frame(make_record(msg='first')) + frame(make_record(
+                msg='second'))
+
+        self.channel.handle_data(data[:3])
+        assert self.messages() == []
+        self.channel.handle_data(data[3:-5])
+        assert self.messages() == ['first']
+        self.channel.handle_data(data[-5:])
+        assert self.messages() == ['first', 'second']
+
+    def test_unreadable_record_skipped(self):
+        bad = 'not a pickle'
+        data = struct.pack('>L', len(bad)) + bad + frame(make_record())
+
+        self.channel.handle_data(data)
+
+        assert self.messages() == ['message']
+
+    def test_record_that_cant_be_written_skipped(self):
+        self.log_files.write.side_effect = [TypeError('bad args'), None]
+        data = frame(make_record(msg='first')) + frame(make_record(
+                msg='second'))
+
+        self.channel.handle_data(data)
+
+        assert self.messages() == ['first', 'second']
+
+    def raise_in_handler(self, error):
+        with patch.object(self.channel, 'close') as mock_close:
+            try:
+                raise error
+            except Exception:
+                self.channel.handle_error()
+        return mock_close
+
+    def test_connection_kept_after_unexpected_error(self):
+        assert not self.raise_in_handler(ValueError('bug')).called
+
+    def test_connection_closed_after_socket_error(self):
+        assert self.raise_in_handler(socket.error('broken')).called
+
+class TestBadRecords(unittest.TestCase):
+    """Records that used to be caught by FileHandler.emit"""
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test_dm_log_server')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def send(self, log_files, *records):
+        channel = log_server.LogRecordChannel(None, log_files, map={})
+        channel.handle_data(''.join(frame(record) for record in records))
+        log_files.close()
+        return [open(os.path.join(self.tmp, name)).read()
+                for name in os.listdir(self.tmp)]
+
+    def test_message_not_matching_args(self):
+        bad = make_record(msg='%s and %s')
+        bad.args = ('one',)
+
+        logs = self.send(log_server.LogFiles(self.tmp), bad,
+                make_record(msg='good'))
+
+        assert logs == ['[dm_qc_report.py] INFO: good\n']
+
+    def test_non_utf8_bytes_as_json(self):
+        logs = self.send(log_server.LogFiles(self.tmp, json_lines=True),
+                make_record(msg='\xff\xfe'), make_record(msg='good'))
+
+        assert len(logs) == 1
+        assert json.loads(logs[0])['message'] == 'good'
+
+class TestLogFiles(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test_dm_log_server')
+        self.patcher = patch('bin.dm_log_server.today',
+                return_value='2018-01-31')
+        self.today = self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.tmp)
+
+    def read(self, name):
+        with open(os.path.join(self.tmp, name)) as log:
+            return log.read()
+
+    def test_output_held_until_flush(self):
+        log_files = log_server.LogFiles(self.tmp)
+
+        log_files.write(make_record())
+        assert not os.path.exists(os.path.join(self.tmp,
+                '2018-01-31-dm_qc_report.log'))
+
+        log_files.flush()
+        assert self.read('2018-01-31-dm_qc_report.log') == \
+                '[dm_qc_report.py] INFO: message\n'
+
+    def test_output_written_when_buffer_full(self):
+        log_files = log_server.LogFiles(self.tmp, buffer_size=50)
+
+        for _ in range(3):
+            log_files.write(make_record(name='__main__'))
+
+        assert self.read('2018-01-31-all.log').count('\n') == 2
+
+    def test_new_files_started_each_day(self):
+        log_files = log_server.LogFiles(self.tmp)
+        log_files.write(make_record(msg='old'))
+
+        self.today.return_value = '2018-02-01'
+        log_files.write(make_record(msg='new'))
+        log_files.close()
+
+        assert 'old' in self.read('2018-01-31-dm_qc_report.log')
+        assert 'new' in self.read('2018-02-01-dm_qc_report.log')
+
+    def test_json_lines(self):
+        log_files = log_server.LogFiles(self.tmp, json_lines=True)
+        record = make_record(level=logging.ERROR)
+        record.host = '10.0.0.1'
+
+        log_files.write(record)
+        log_files.close()
+
+        entry = json.loads(self.read('2018-01-31-dm_qc_report.log'))
+        assert entry['message'] == 'message'
+        assert entry['level'] == 'ERROR'
+        assert entry['host'] == '10.0.0.1'
+
+class TestServe(unittest.TestCase):
+    def test_records_from_socket_handler_written(self):
+        tmp = tempfile.mkdtemp(prefix='test_dm_log_server')
+        socket_map = {}
+        log_files = log_server.LogFiles(tmp)
+        receiver = log_server.LogRecordReceiver('127.0.0.1', 0, log_files,
+                map=socket_map)
+        sent = threading.Event()
+        done = lambda: (sent.is_set() and receiver.connections == 1 and
+                list(socket_map.values()) == [receiver])
+        server = threading.Thread(target=log_server.serve, args=(log_files,),
+                kwargs={'flush_interval': 0.1, 'map': socket_map,
+                        'stop': done})
+        server.daemon = True
+        server.start()
+
+        try:
+            handler = logging.handlers.SocketHandler('127.0.0.1',
+                    receiver.socket.getsockname()[1])
+            for count in range(100):
+                handler.emit(make_record(msg='record {}'.format(count)))
+            handler.close()
+            sent.set()
+            server.join(10)
+
+            assert not server.is_alive()
+            logs = os.listdir(tmp)
+            assert len(logs) == 1
+            with open(os.path.join(tmp, logs[0])) as log:
+                assert log.read().count('\n') == 100
+        finally:
+            sent.set()
+            receiver.close()
+            shutil.rmtree(tmp)
@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+import importlib
+import logging
+
+from mock import MagicMock, patch
+
+import datman.qc_cache
+
+logging.disable(logging.CRITICAL)
+
+qc = importlib.import_module('bin.dm_qc_report')
+
+class TestRecordOnlySuccessfulStages(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test_dm_qc_report')
+        self.nifti = os.path.join(self.tmp, 'STUDY_CMH_0001_01_01_T1_02.nii.gz')
+        with open(self.nifti, 'w') as output:
+            output.write('data')
+        self.report = open(os.path.join(self.tmp, 'qc.html'), 'w')
+
+    def tearDown(self):
+        self.report.close()
+        datman.qc_cache._caches.clear()
+        shutil.rmtree(self.tmp)
+
+    def recorded(self):
+        cache = datman.qc_cache.get_cache(self.tmp)
+        return sorted(cache.records)
+
+    @patch('datman.utils.run', return_value=(1, ''))
+    def test_failed_command_not_recorded(self, mock_run):
+        qc.phantom_anat_qc(self.nifti, self.tmp)
+
+        assert mock_run.called
+        assert self.recorded() == []
+
+    @patch('datman.montage.render', side_effect=IOError('disk full'))
+    def test_failed_montage_not_recorded(self, mock_render):
+        qc.anat_qc(self.nifti, self.tmp, self.report)
+
+        assert self.recorded() == []
+
+    @patch('datman.montage.render')
+    def test_montage_recorded_when_made(self, mock_render):
+        qc.anat_qc(self.nifti, self.tmp, self.report)
+
+        assert self.recorded() == ['STUDY_CMH_0001_01_01_T1_02.png']
+
+class TestRewrite(unittest.TestCase):
+    def test_rewrite_remakes_current_outputs(self):
+        tmp = tempfile.mkdtemp(prefix='test_dm_qc_report')
+        try:
+            output = os.path.join(tmp, 'output.csv')
+            with open(output, 'w') as stream:
+                stream.write('results')
+            assert not qc.needs_update(output, [], qc.QCMON)
+
+            with patch('bin.dm_qc_report.FORCE', True):
+                assert qc.needs_update(output, [], qc.QCMON)
+        finally:
+            datman.qc_cache._caches.clear()
+            shutil.rmtree(tmp)
+
+    @patch('bin.dm_qc_report.docopt', return_value={'--log-to-server': False,
+            '--verbose': False, '--debug': False, '--quiet': False})
+    def test_forced_rebuild_passed_to_jobs(self, mock_docopt):
+        command = qc.make_qc_command('STUDY_CMH_0001_01', 'STUDY',
+                rewrite=True)
+        assert command.endswith(' --update')
+
+        with patch('bin.dm_qc_report.FORCE', True):
+            command = qc.make_qc_command('STUDY_CMH_0001_01', 'STUDY')
+        assert command.endswith(' --rewrite')
+
+class TestRunHeaderQC(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test_dm_qc_report')
+        self.log = os.path.join(self.tmp, 'header-diff.log')
+        self.subject = MagicMock(full_id='STUDY_CMH_0001_01',
+                dicoms=['a.dcm'])
+
+    def tearDown(self):
+        datman.qc_cache._caches.clear()
+        shutil.rmtree(self.tmp)
+
+    @patch('datman.header_checks.get_comparisons',
+           return_value=[('a.dcm', 's1.dcm')])
+    @patch('datman.header_checks.compare_headers',
+           side_effect=IOError('unreadable'))
+    def test_log_not_recorded_when_comparison_fails(self, mock_compare,
+            mock_comparisons):
+        qc.run_header_qc(self.subject, self.tmp, self.log)
+
+        assert os.path.exists(self.log)
+        assert datman.qc_cache.get_cache(self.tmp).records == {}
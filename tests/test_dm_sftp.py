@@ -0,0 +1,227 @@
+import os
+import stat
+import unittest
+import importlib
+import logging
+import tempfile
+import shutil
+import zipfile
+
+import pysftp
+from mock import MagicMock, patch
+
+from sftp_server import SFTPServer
+
+logging.disable(logging.CRITICAL)
+
+sftp = importlib.import_module('bin.dm_sftp')
+
+
+def make_attributes(filename, mtime, mode=stat.S_IFREG, size=0):
+    attributes = MagicMock()
+    attributes.filename = filename
+    attributes.st_mtime = mtime
+    attributes.st_mode = mode
+    attributes.st_size = size
+    return attributes
+
+
+class ProcessDir(unittest.TestCase):
+    def setUp(self):
+        self.zips = tempfile.mkdtemp()
+        self.existing = os.path.join(self.zips, 'old.zip')
+        open(self.existing, 'w').close()
+        os.utime(self.existing, (1000, 1000))
+
+    def tearDown(self):
+        shutil.rmtree(self.zips)
+
+    def test_lists_remote_folder_in_a_single_call(self):
+        connection = MagicMock()
+        connection.listdir_attr.return_value = []
+        sftp.process_dir(connection, 'MRFOLDER', self.zips)
+        connection.listdir_attr.assert_called_once_with('MRFOLDER')
+        assert not connection.stat.called
+
+    def test_returns_only_new_and_updated_files(self):
+        connection = MagicMock()
+        new = make_attributes('new.zip', 500)
+        connection.listdir_attr.return_value = [
+                new,
+                make_attributes('old.zip', 500),
+                make_attributes('subdir', 5000, mode=stat.S_IFDIR)]
+        result = sftp.process_dir(connection, 'MRFOLDER', self.zips)
+        assert result == [('MRFOLDER/new.zip',
+                           os.path.join(self.zips, 'new.zip'), new)]
+
+        updated = make_attributes('old.zip', 2000)
+        connection.listdir_attr.return_value = [updated]
+        result = sftp.process_dir(connection, 'MRFOLDER', self.zips)
+        assert result == [('MRFOLDER/old.zip', self.existing, updated)]
+
+    def test_local_file_with_wrong_size_is_copied_again(self):
+        connection = MagicMock()
+        truncated = make_attributes('old.zip', 500, size=2048)
+        connection.listdir_attr.return_value = [truncated]
+        result = sftp.process_dir(connection, 'MRFOLDER', self.zips)
+        assert result == [('MRFOLDER/old.zip', self.existing, truncated)]
+
+    def test_returns_nothing_for_inaccessible_folder(self):
+        connection = MagicMock()
+        connection.listdir_attr.side_effect = IOError
+        assert sftp.process_dir(connection, 'MRFOLDER', self.zips) == []
+
+
+class CopyFiles(unittest.TestCase):
+    @patch('pysftp.Connection')
+    def test_files_copied_over_parallel_connections(self, mock_connection):
+        files = [('MRFOLDER/{}.zip'.format(i), '/zips/{}.zip'.format(i),
+                  make_attributes('{}.zip'.format(i), 500))
+                 for i in range(10)]
+        copied = []
+        def download(connection, remote_file, target, attributes, verify):
+            copied.append((remote_file, target, attributes))
+
+        with patch.object(sftp, 'download', side_effect=download):
+            sftp.copy_files({'host': 'server'}, files, connections=3)
+
+        assert len(mock_connection.call_args_list) == 3
+        assert sorted(copied) == sorted(files)
+
+    @patch('pysftp.Connection')
+    def test_never_opens_more_connections_than_files(self, mock_connection):
+        files = [('MRFOLDER/1.zip', '/zips/1.zip',
+                  make_attributes('1.zip', 500))]
+        with patch.object(sftp, 'download'):
+            sftp.copy_files({'host': 'server'}, files, connections=4)
+        assert mock_connection.call_count == 1
+
+
+class Download(unittest.TestCase):
+    """Copies files from a local stand-in sftp server"""
+    def setUp(self):
+        self.remote = tempfile.mkdtemp()
+        self.zips = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.remote, 'MRFOLDER'))
+        self.remote_zip = os.path.join(self.remote, 'MRFOLDER', 'exam.zip')
+        with zipfile.ZipFile(self.remote_zip, 'w') as archive:
+            for i in range(20):
+                archive.writestr('series/{}.dcm'.format(i), os.urandom(4096))
+        os.utime(self.remote_zip, (1000, 1000))
+        with open(self.remote_zip, 'rb') as remote_zip:
+            self.contents = remote_zip.read()
+
+        self.server = SFTPServer(self.remote)
+        self.server.start()
+        cnopts = pysftp.CnOpts()
+        cnopts.hostkeys = None
+        self.connect_args = {'host': 'localhost',
+                             'port': self.server.port,
+                             'username': 'user',
+                             'password': 'password',
+                             'cnopts': cnopts}
+        self.target = os.path.join(self.zips, 'exam.zip')
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.remote)
+        shutil.rmtree(self.zips)
+
+    def get_file(self, verify=False):
+        with pysftp.Connection(**self.connect_args) as connection:
+            attributes = connection.stat('MRFOLDER/exam.zip')
+            sftp.download(connection, 'MRFOLDER/exam.zip', self.target,
+                          attributes, verify)
+
+    def write_partial(self, contents, mtime=1000, size=None):
+        partial = self.target + '.partial'
+        with open(partial, 'wb') as output:
+            output.write(contents)
+        if size is None:
+            size = len(self.contents)
+        with open(partial + '.remote', 'w') as info:
+            info.write('{} {}'.format(mtime, size))
+
+    def read_target(self):
+        with open(self.target, 'rb') as target:
+            return target.read()
+
+    def test_completed_copy_moved_into_place_with_remote_mtime(self):
+        self.get_file(verify=True)
+        assert self.read_target() == self.contents
+        assert os.path.getmtime(self.target) == 1000
+        assert not os.path.exists(self.target + '.partial')
+        assert not os.path.exists(self.target + '.partial.remote')
+
+    def test_resumes_from_end_of_partial_file(self):
+        # the first bytes are wrong, so the result shows if the copy resumed
+        self.write_partial('x' * 10000)
+        self.get_file()
+        assert self.read_target() == 'x' * 10000 + self.contents[10000:]
+
+    def test_restarts_when_partial_larger_than_remote(self):
+        self.write_partial(self.contents + 'garbage')
+        self.get_file()
+        assert self.read_target() == self.contents
+
+    def test_restarts_when_remote_file_modified(self):
+        self.write_partial('x' * 10000, mtime=500)
+        self.get_file(verify=True)
+        assert self.read_target() == self.contents
+
+    def test_restarts_when_remote_file_size_changed(self):
+        self.write_partial('x' * 10000, size=len(self.contents) - 1)
+        self.get_file(verify=True)
+        assert self.read_target() == self.contents
+
+    def test_restarts_when_no_record_of_remote_file(self):
+        with open(self.target + '.partial', 'wb') as partial:
+            partial.write('x' * 10000)
+        self.get_file(verify=True)
+        assert self.read_target() == self.contents
+
+    def test_short_copy_left_as_partial_file(self):
+        with pysftp.Connection(**self.connect_args) as connection:
+            attributes = connection.stat('MRFOLDER/exam.zip')
+            attributes.st_size += 100
+            with self.assertRaises(IOError):
+                sftp.download(connection, 'MRFOLDER/exam.zip', self.target,
+                              attributes)
+        assert not os.path.exists(self.target)
+        assert os.path.getsize(self.target + '.partial') == len(self.contents)
+
+    def test_corrupt_zip_is_discarded_when_verifying(self):
+        self.write_partial('x' * len(self.contents))
+        with self.assertRaises(IOError):
+            self.get_file(verify=True)
+        assert not os.path.exists(self.target)
+        assert not os.path.exists(self.target + '.partial')
+        assert not os.path.exists(self.target + '.partial.remote')
+
+    def test_pull_files_copies_everything_over_parallel_connections(self):
+        for i in range(5):
+            shutil.copy(self.remote_zip, os.path.join(self.remote,
+                        'MRFOLDER', 'exam{}.zip'.format(i)))
+        sftp.pull_files(self.connect_args, ['MR*'], self.zips,
+                        connections=3, verify=True)
+        assert sorted(os.listdir(self.zips)) == sorted(
+                os.listdir(os.path.join(self.remote, 'MRFOLDER')))
+        # one connection to list the folders, three to copy
+        assert self.server.connections == 4
+
+    def test_same_file_name_in_two_folders_copied_once(self):
+        os.mkdir(os.path.join(self.remote, 'MRFOLDER2'))
+        shutil.copy(self.remote_zip, os.path.join(self.remote, 'MRFOLDER2',
+                    'exam.zip'))
+        claimed = sftp.ClaimedTargets()
+
+        with patch.object(sftp, 'copy_files') as mock_copy:
+            sftp.pull_files(self.connect_args, ['MR*'], self.zips,
+                            claimed=claimed)
+            # the same name found again by another MRUSER
+            sftp.pull_files(self.connect_args, ['MR*'], self.zips,
+                            claimed=claimed)
+
+        copied = [call[0][1] for call in mock_copy.call_args_list]
+        assert [[target for _, target, _ in files] for files in copied] == \
+                [[self.target], []]
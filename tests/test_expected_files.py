@@ -0,0 +1,70 @@
+import unittest
+
+from mock import MagicMock
+
+import datman.config
+import datman.expected_files as expected_files
+
+def make_series(tag, num):
+    return MagicMock(tag=tag, series_num=num, file_name='{}_{}'.format(tag,
+            num))
+
+class TestFindExpectedFiles(unittest.TestCase):
+    export_info = datman.config.TagInfo({
+            'T1': {'Count': 1, 'Order': [2]},
+            'RST': {'Count': 2, 'Order': [1, 4]},
+            'DTI': {'Count': 1, 'Order': 3},
+            'FMAP': {'Count': 1}})
+
+    def test_found_repeated_and_missing_scans_tabulated(self):
+        niftis = [make_series('T1', 5), make_series('RST', 2),
+                  make_series('T1', 7), make_series('LOC', 1)]
+
+        result = expected_files.find_expected_files(niftis,
+                self.export_info)
+
+        assert list(result.columns) == expected_files.COLUMNS
+        assert list(result['tag']) == ['FMAP', 'RST', 'RST', 'T1', 'T1',
+                                       'DTI']
+        assert list(result['bookmark']) == ['', 'RST1', '', 'T11', 'T12', '']
+        assert list(result['Note']) == ['missing(1)', '', 'missing(1)', '',
+                                        'Repeated Scan', 'missing(1)']
+        assert result.loc[3, 'File'] is niftis[0]
+        assert list(result.index) == list(range(6))
+
+    def test_session_with_no_niftis(self):
+        result = expected_files.find_expected_files([], self.export_info)
+
+        assert sorted(result['Note']) == ['missing(1)'] * 3 + ['missing(2)']
+        assert not any(result['File'])
+
+class TestTagCounts(unittest.TestCase):
+    export_info = datman.config.TagInfo({'T1': {'Count': 1},
+                                         'RST': {'Count': 2}})
+
+    def test_counts_for_every_subject_and_tag(self):
+        subjects = {'SUB2': [make_series('RST', 1), make_series('RST', 2),
+                             make_series('T1', 3), make_series('T1', 4)],
+                    'SUB1': [make_series('RST', 1), make_series('LOC', 2)],
+                    'SUB3': []}
+
+        counts = expected_files.tag_counts(subjects, self.export_info)
+
+        rows = [tuple(row) for row in counts.itertuples(index=False)]
+        assert rows == [('SUB1', 'RST', 1, 2, 1), ('SUB1', 'T1', 0, 1, 1),
+                        ('SUB2', 'RST', 2, 2, 0), ('SUB2', 'T1', 2, 1, 0),
+                        ('SUB3', 'RST', 0, 2, 2), ('SUB3', 'T1', 0, 1, 1)]
+
+    def test_study_counts_use_each_sites_tags(self):
+        config = MagicMock()
+        config.get_tags.side_effect = lambda site: self.export_info if \
+                site == 'CMH' else datman.config.TagInfo({'T1': {'Count': 2}})
+        scans = [MagicMock(site='CMH', id_plus_session='STUDY_CMH_0001_01_01',
+                           niftis=[make_series('T1', 1)]),
+                 MagicMock(site='MRC', id_plus_session='STUDY_MRC_0001_01_01',
+                           niftis=[make_series('T1', 1)])]
+
+        counts = expected_files.study_tag_counts(scans, config)
+
+        assert list(counts['site']) == ['CMH', 'CMH', 'MRC']
+        assert list(counts['missing']) == [2, 0, 1]
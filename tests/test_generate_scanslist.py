@@ -0,0 +1,81 @@
+import os
+import shutil
+import zipfile
+import tempfile
+import unittest
+
+from mock import patch
+
+import datman.generate_scanslist as scanslist
+
+def fake_headers(archive, stop_after_first=False):
+    """The exam details are taken from the archive's name"""
+    name = os.path.basename(archive).split('.')[0]
+    if name == 'empty':
+        return {}
+    patient, date = name.split('-')
+    return {'series1': {'PatientName': patient, 'StudyID': name,
+                        'StudyDate': date, 'StudyTime': '120000'}}
+
+def make_session(p_name, date, time='120000'):
+    return scanslist.Session(p_name, '1', date, time, 'archive', '01')
+
+class TestReadSessions(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test_generate_scanslist')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_zip(self, name):
+        path = os.path.join(self.tmp, name + '.zip')
+        zipfile.ZipFile(path, 'w').close()
+        return path
+
+    @patch('datman.utils.get_archive_headers', side_effect=fake_headers)
+    def test_sessions_kept_in_archive_order(self, mock_headers):
+        archives = [self.make_zip(name) for name in
+                    ['BOB-20180102', 'ANN-20180101', 'CAT-20180103']]
+
+        for jobs in [1, 2]:
+            sessions = scanslist.read_sessions(archives, jobs=jobs)
+
+            assert [session.p_name for session in sessions] == ['BOB', 'ANN',
+                    'CAT']
+            assert sessions[0].a_name == 'BOB-20180102'
+            assert sessions[0].date == '20180102'
+
+    @patch('datman.utils.get_archive_headers', side_effect=fake_headers)
+    def test_unreadable_archives_skipped_with_reason(self, mock_headers):
+        not_zip = os.path.join(self.tmp, 'broken.zip')
+        with open(not_zip, 'w') as archive:
+            archive.write('not a zip file')
+        archives = [self.make_zip('ANN-20180101'), self.make_zip('empty'),
+                    not_zip]
+
+        sessions = scanslist.read_sessions(archives)
+
+        assert [session.p_name for session in sessions] == ['ANN']
+        assert scanslist.read_session(archives[1]) == (None,
+                'no dicoms found')
+        assert 'not a zip file' in scanslist.read_session(not_zip)[1]
+
+    @patch('datman.utils.get_archive_headers',
+           side_effect=IOError('Permission denied'))
+    def test_read_error_reported(self, mock_headers):
+        session, reason = scanslist.read_session(self.make_zip('ANN-2018'))
+
+        assert session is None
+        assert 'Permission denied' in reason
+
+class TestAssignTimepoints(unittest.TestCase):
+    def test_timepoints_numbered_by_date_and_time(self):
+        sessions = [make_session('ANN', '20180301'),
+                    make_session('BOB', '20180101'),
+                    make_session('ANN', '20180101', '130000'),
+                    make_session('ANN', '20180101', '090000')]
+
+        scanslist.assign_timepoints(sessions)
+
+        assert [session.timepoint for session in sessions] == ['03', '01',
+                '02', '01']
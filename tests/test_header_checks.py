@@ -0,0 +1,157 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch, MagicMock
+
+import datman.header_checks as header_checks
+
+STANDARD = {'EchoTime': '2.9',
+            'RepetitionTime': '2000',
+            'PixelSpacing': ['0.9', '0.9'],
+            'SequenceName': '*tfl3d1_ns',
+            'PatientName': 'STANDARD'}
+
+class TestValuesMatch(unittest.TestCase):
+    def test_numbers_within_tolerance_match(self):
+        assert header_checks.values_match('2.9', 2.9004)
+        assert not header_checks.values_match('2.9', '3.1')
+
+    def test_strings_compared_exactly(self):
+        assert header_checks.values_match('*tfl3d1_ns ', '*tfl3d1_ns')
+        assert not header_checks.values_match('*tfl3d1_ns', '*tfl3d1_16')
+
+    def test_multivalued_fields_compared_by_element(self):
+        assert header_checks.values_match(['0.9', '0.9'], ['0.9', '0.9'])
+        assert not header_checks.values_match(['0.9', '0.9'], ['0.9', '1.1'])
+        assert not header_checks.values_match(['0.9', '0.9'], ['0.9'])
+        assert not header_checks.values_match(['0.9', '0.9'], '0.9')
+
+class TestCompareHeaders(unittest.TestCase):
+    dicom = '/data/dcm/STUDY_CMH_0001_01/STUDY_CMH_0001_01_01_T1_02_SagT1.dcm'
+    standard = '/data/std/STUDY_CMH_STD_01_01_T1_02_SagT1.dcm'
+
+    def setUp(self):
+        header_checks._headers.clear()
+
+    @patch('os.path.getmtime')
+    @patch('datman.header_checks.read_header')
+    def test_only_differing_fields_logged(self, mock_read, mock_mtime):
+        header = dict(STANDARD, EchoTime='3.1', PatientName='SUBJECT')
+        mock_read.side_effect = lambda path: STANDARD if path == \
+                self.standard else header
+        mock_mtime.return_value = 1
+
+        diffs = header_checks.compare_headers(self.dicom, self.standard)
+
+        assert diffs == ['{}: header EchoTime, expected = 2.9, actual = '
+                '3.1'.format(self.dicom)]
+
+    @patch('os.path.getmtime')
+    @patch('datman.header_checks.read_header')
+    def test_missing_field_logged(self, mock_read, mock_mtime):
+        header = dict(STANDARD)
+        del header['SequenceName']
+        mock_read.side_effect = lambda path: STANDARD if path == \
+                self.standard else header
+        mock_mtime.return_value = 1
+
+        diffs = header_checks.compare_headers(self.dicom, self.standard)
+
+        assert len(diffs) == 1
+        assert diffs[0].startswith(self.dicom + ': header SequenceName missing')
+
+    @patch('os.path.getmtime')
+    @patch('datman.header_checks.read_header')
+    def test_standard_only_read_once(self, mock_read, mock_mtime):
+        mock_read.return_value = STANDARD
+        mock_mtime.return_value = 1
+
+        for num in range(3):
+            header_checks.compare_headers(self.dicom, self.standard)
+
+        standard_reads = [call for call in mock_read.call_args_list
+                          if call[0][0] == self.standard]
+        assert len(standard_reads) == 1
+        assert mock_read.call_count == 4
+
+class TestStandards(unittest.TestCase):
+    def setUp(self):
+        self.std = tempfile.mkdtemp(prefix='test_header_checks')
+        for name in ['STUDY_CMH_STD_01_01_T1_02_SagT1.dcm',
+                     'STUDY_CMH_STD_01_01_RST_05_Resting.dcm',
+                     'STUDY_MRC_STD_01_01_T1_02_SagT1.dcm',
+                     'not_a_standard.dcm']:
+            open(os.path.join(self.std, name), 'w').close()
+        header_checks._standards.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.std)
+        header_checks._standards.clear()
+
+    def test_standards_grouped_by_site(self):
+        standards = header_checks.get_standards(self.std, 'CMH')
+
+        assert sorted(standards.keys()) == ['RST', 'T1']
+        assert header_checks.get_standards(self.std, 'MRC').keys() == ['T1']
+        assert header_checks.get_standards(self.std, 'ABC') == {}
+
+    @patch('datman.header_checks.find_standards')
+    def test_standards_folder_only_searched_once(self, mock_find):
+        mock_find.return_value = {}
+
+        header_checks.get_standards(self.std, 'CMH')
+        header_checks.get_standards(self.std, 'MRC')
+
+        assert mock_find.call_count == 1
+
+    def test_comparisons_made_for_dicoms_with_standards(self):
+        subject = MagicMock(site='CMH')
+        t1 = MagicMock(tag='T1', path='/dcm/T1.dcm')
+        dti = MagicMock(tag='DTI60-1000', path='/dcm/DTI.dcm')
+        subject.dicoms = [t1, dti]
+
+        comparisons = header_checks.get_comparisons(subject, self.std)
+
+        assert comparisons == [('/dcm/T1.dcm', os.path.join(self.std,
+                'STUDY_CMH_STD_01_01_T1_02_SagT1.dcm'))]
+
+class TestCheckHeaders(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test_header_checks')
+        self.log = os.path.join(self.tmp, 'header-diff.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    @patch('datman.header_checks.compare_headers')
+    def test_log_replaced_with_differences(self, mock_compare):
+        with open(self.log, 'w') as log:
+            log.write('old difference\n')
+        mock_compare.side_effect = lambda dicom, std, ignore, tol: \
+                ['{}: header EchoTime'.format(dicom)]
+
+        found = header_checks.check_headers([('a.dcm', 's1.dcm'),
+                ('b.dcm', 's2.dcm')], self.log)
+
+        assert found == 2
+        with open(self.log) as log:
+            assert log.readlines() == ['a.dcm: header EchoTime\n',
+                                       'b.dcm: header EchoTime\n']
+
+    @patch('datman.header_checks.compare_headers')
+    def test_failed_comparison_raised_after_log_written(self, mock_compare):
+        mock_compare.side_effect = [IOError('unreadable'),
+                ['b.dcm: header EchoTime']]
+
+        with self.assertRaises(header_checks.HeaderCheckError):
+            header_checks.check_headers([('a.dcm', 's1.dcm'),
+                    ('b.dcm', 's2.dcm')], self.log)
+
+        with open(self.log) as log:
+            assert log.readlines() == ['b.dcm: header EchoTime\n']
+
+    def test_no_log_without_comparisons(self):
+        assert header_checks.check_headers([], self.log) == 0
+        assert not os.path.exists(self.log)
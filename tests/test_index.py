@@ -0,0 +1,156 @@
+import os
+import shutil
+import tempfile
+import unittest
+import logging
+
+from mock import MagicMock, patch
+
+import datman.index as index
+
+logging.disable(logging.CRITICAL)
+
+class TestFileIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test_index')
+        self.nii = os.path.join(self.tmp, 'nii')
+        self.dcm = os.path.join(self.tmp, 'dcm')
+        self.session = os.path.join(self.nii, 'STUDY_CMH_0001_01')
+        self.other = os.path.join(self.nii, 'STUDY_MRC_0002_01')
+        for folder in [self.session, self.other,
+                       os.path.join(self.dcm, 'STUDY_CMH_0001_01')]:
+            os.makedirs(folder)
+        self.t1 = self.make(self.session,
+                'STUDY_CMH_0001_01_01_T1_02_SagT1.nii.gz')
+        self.dti = self.make(self.session,
+                'STUDY_CMH_0001_01_01_DTI60-1000_05_Ax-DTI-60.nii.gz')
+        self.make(self.session, 'not_a_datman_name.nii.gz')
+        self.other_t1 = self.make(self.other,
+                'STUDY_MRC_0002_01_01_T1_03_SagT1.nii.gz')
+        self.dicom = self.make(os.path.join(self.dcm, 'STUDY_CMH_0001_01'),
+                'STUDY_CMH_0001_01_01_T1_02_SagT1.dcm')
+
+        self.index = index.FileIndex(os.path.join(self.tmp, 'index.sqlite'),
+                {'nii': self.nii, 'dcm': self.dcm})
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmp)
+
+    def make(self, folder, name):
+        path = os.path.join(folder, name)
+        with open(path, 'w') as output:
+            output.write('data')
+        return path
+
+    def paths(self, **criteria):
+        return [entry.path for entry in self.index.find(**criteria)]
+
+    def test_find_by_tag_and_format(self):
+        self.index.update()
+
+        assert self.paths(tag='T1') == [self.dicom, self.t1, self.other_t1]
+        assert self.paths(tag='T1', format='nii') == [self.t1, self.other_t1]
+        assert self.paths(tag=['T1', 'DTI60-1000'], site='CMH',
+                format='nii') == [self.dti, self.t1]
+
+    def test_find_by_subject(self):
+        self.index.update()
+
+        assert self.paths(subject='STUDY_CMH_0001_01', format='nii') == [
+                self.dti, self.t1]
+        assert self.paths(subject='STUDY_CMH_0001_01_02') == []
+
+    def test_entries_hold_parsed_name_and_size(self):
+        self.index.update()
+
+        entry = self.index.find(tag='DTI60-1000')[0]
+
+        assert entry.folder == self.session
+        assert entry.session == '01'
+        assert entry.series == '05'
+        assert entry.description == 'Ax-DTI-60'
+        assert entry.size == 4
+
+    def test_unchanged_folders_not_reread(self):
+        assert self.index.update() == 3
+
+        with patch('datman.index.parse_entry') as mock_parse:
+            assert self.index.update() == 0
+            assert not mock_parse.called
+
+    def test_added_and_removed_files_found(self):
+        self.index.update()
+        os.remove(self.t1)
+        new = self.make(self.session, 'STUDY_CMH_0001_01_01_T2_06_T2.nii.gz')
+        # make sure the folder's mtime changes on file systems with coarse
+        # timestamps
+        mtime = os.stat(self.session).st_mtime + 10
+        os.utime(self.session, (mtime, mtime))
+
+        assert self.index.update() == 1
+        assert self.paths(folder=self.session) == [self.dti, new]
+
+    def test_removed_folders_dropped(self):
+        self.index.update()
+        shutil.rmtree(self.other)
+
+        assert self.index.update() == 1
+        assert self.paths(site='MRC') == []
+
+    def test_index_kept_between_runs(self):
+        self.index.update()
+        self.index.close()
+
+        self.index = index.FileIndex(self.index.db_path,
+                {'nii': self.nii, 'dcm': self.dcm})
+
+        assert self.index.update() == 0
+        assert self.paths(tag='T1', format='nii') == [self.t1, self.other_t1]
+
+class TestGetIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test_index')
+        self.nii = os.path.join(self.tmp, 'nii')
+        self.meta = os.path.join(self.tmp, 'metadata')
+        for folder in [os.path.join(self.nii, 'STUDY_CMH_0001_01'),
+                       self.meta]:
+            os.makedirs(folder)
+        with open(os.path.join(self.nii, 'STUDY_CMH_0001_01',
+                'STUDY_CMH_0001_01_01_T1_02_SagT1.nii.gz'), 'w') as output:
+            output.write('data')
+        paths = {'nii': self.nii, 'meta': self.meta}
+        self.config = MagicMock()
+        self.config.get_path.side_effect = lambda key: paths[key]
+
+    def tearDown(self):
+        for item in index._indexes.values():
+            item.close()
+        index._indexes.clear()
+        shutil.rmtree(self.tmp)
+
+    def check_works(self, file_index):
+        file_index.update()
+        assert len(list(file_index.find(tag='T1'))) == 1
+
+    def test_index_kept_in_metadata(self):
+        file_index = index.get_index(self.config)
+
+        assert file_index.db_path == os.path.join(self.meta, index.INDEX_NAME)
+        self.check_works(file_index)
+
+    def test_read_only_metadata_kept_in_memory(self):
+        with patch('os.access', return_value=False):
+            file_index = index.get_index(self.config)
+
+        assert file_index.db_path == ':memory:'
+        self.check_works(file_index)
+
+    def test_unopenable_index_kept_in_memory(self):
+        # a folder where the database should be can't be opened
+        os.mkdir(os.path.join(self.meta, index.INDEX_NAME))
+
+        file_index = index.get_index(self.config)
+
+        assert file_index.db_path == ':memory:'
+        self.check_works(file_index)
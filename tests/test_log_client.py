@@ -0,0 +1,184 @@
+import os
+import sys
+import shutil
+import datetime
+import logging
+import tempfile
+import threading
+import unittest
+import importlib
+import multiprocessing
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from mock import MagicMock
+
+import datman.log_client as log_client
+
+log_server = importlib.import_module('bin.dm_log_server')
+
+def make_record(msg='message', args=None):
+    return logging.makeLogRecord({'name': 'dm_qc_report.py', 'msg': msg,
+            'args': args, 'levelno': logging.INFO, 'levelname': 'INFO'})
+
+class TestQueueHandler(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test_log_client')
+        self.spool = log_client.Spool(os.path.join(self.tmp, 'spool.log'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_message_filled_in_before_queued(self):
+        handler = log_client.QueueHandler(queue.Queue(), self.spool)
+        values = ['a']
+
+        handler.emit(make_record('values: %s', (values,)))
+        values.append('b')
+
+        record = handler.queue.get_nowait()
+        assert record.msg == "values: ['a']"
+        assert record.args is None
+
+    def test_record_given_to_other_handlers_unchanged(self):
+        handler = log_client.QueueHandler(queue.Queue(), self.spool)
+        try:
+            raise ValueError('failed')
+        except ValueError:
+            record = logging.makeLogRecord({'msg': 'value: %s',
+                    'args': ('a',), 'exc_info': sys.exc_info()})
+
+        handler.emit(record)
+
+        assert record.msg == 'value: %s'
+        assert record.args == ('a',)
+        assert record.exc_info[0] is ValueError
+        assert 'ValueError: failed' in handler.queue.get_nowait().exc_text
+
+    def test_records_spooled_when_queue_full(self):
+        handler = log_client.QueueHandler(queue.Queue(1), self.spool)
+
+        records = [make_record('record {}'.format(count))
+                   for count in range(3)]
+        for record in records:
+            handler.emit(record)
+
+        assert handler.queue.get_nowait().msg == 'record 0'
+        assert self.spool.spooled == 2
+        with open(self.spool.path) as spool:
+            lines = spool.readlines()
+        # each line starts with the record's time
+        created = datetime.datetime.fromtimestamp(records[2].created)
+        assert lines[1] == ('{},{:03d} [dm_qc_report.py] INFO: record 2\n'
+                .format(created.strftime('%Y-%m-%d %H:%M:%S'),
+                        int(records[2].msecs)))
+
+    def test_records_dropped_without_spool_path(self):
+        spool = log_client.Spool()
+        handler = log_client.QueueHandler(queue.Queue(1), spool)
+
+        handler.emit(make_record())
+        handler.emit(make_record())
+
+        assert spool.dropped == 1
+
+class TestQueueListener(unittest.TestCase):
+    def setUp(self):
+        self.queue = queue.Queue()
+        self.handler = MagicMock()
+        self.spool = log_client.Spool()
+        self.listener = log_client.QueueListener(self.queue, self.handler,
+                self.spool, batch_size=3)
+
+    def test_waiting_records_sent_in_batches(self):
+        for count in range(5):
+            self.queue.put(make_record('record {}'.format(count)))
+
+        self.listener.start()
+        self.listener.stop()
+
+        batches = [[record.msg for record in call[0][0]]
+                   for call in self.handler.send_batch.call_args_list]
+        assert batches == [['record 0', 'record 1', 'record 2'],
+                           ['record 3', 'record 4']]
+        assert self.handler.close.called
+
+    def test_records_kept_when_send_fails(self):
+        self.handler.send_batch.return_value = False
+        self.queue.put(make_record())
+
+        self.listener.start()
+        self.listener.stop()
+
+        assert self.spool.dropped == 1
+
+class TestAddServerHandler(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test_log_client')
+        self.socket_map = {}
+        self.log_files = log_server.LogFiles(self.tmp)
+        self.receiver = log_server.LogRecordReceiver('127.0.0.1', 0,
+                self.log_files, map=self.socket_map)
+        self.stopped = threading.Event()
+        self.server = threading.Thread(target=log_server.serve,
+                args=(self.log_files,), kwargs={'flush_interval': 0.1,
+                'map': self.socket_map, 'stop': self.stopped.is_set})
+        self.server.daemon = True
+        self.server.start()
+
+        # other test modules turn logging off
+        self.disabled = logging.root.manager.disable
+        logging.disable(logging.NOTSET)
+        self.config = MagicMock()
+        self.config.get_key.side_effect = lambda key: {
+                'LOGSERVER': '127.0.0.1'}[key]
+        self.logger = logging.getLogger('test_log_client')
+        self.logger.setLevel(logging.INFO)
+        self.handler = log_client.add_server_handler(self.logger,
+                self.config)
+        # point the sender at the test server
+        sender = self.handler.listener.handler
+        sender.host, sender.port = self.receiver.socket.getsockname()
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+        logging.disable(self.disabled)
+        self.stopped.set()
+        self.server.join(5)
+        self.receiver.close()
+        shutil.rmtree(self.tmp)
+
+    def wait_for_lines(self, count):
+        for _ in range(50):
+            self.stopped.wait(0.1)
+            lines = []
+            for name in os.listdir(self.tmp):
+                with open(os.path.join(self.tmp, name)) as log:
+                    lines.extend(log.readlines())
+            if len(lines) >= count:
+                return lines
+        return lines
+
+    def test_records_reach_server(self):
+        for count in range(10):
+            self.logger.info('record %d', count)
+
+        lines = self.wait_for_lines(10)
+
+        assert len(lines) == 10
+        assert lines[0] == '[test_log_client] INFO: record 0\n'
+
+    def test_forked_process_sends_records(self):
+        def log_from_child():
+            self.logger.info('from child')
+
+        child = multiprocessing.Process(target=log_from_child)
+        child.start()
+        child.join(10)
+
+        assert self.wait_for_lines(1) == [
+                '[test_log_client] INFO: from child\n']
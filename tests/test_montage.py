@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+import logging
+
+import numpy as np
+import nibabel as nib
+import PIL.Image
+
+import datman.montage as montage
+
+logging.disable(logging.CRITICAL)
+
+class Normalize(unittest.TestCase):
+    def test_output_scaled_to_uint8_range(self):
+        data = np.arange(1000, dtype=np.float64).reshape(10, 10, 10)
+        result = montage.normalize(data)
+        assert result.dtype == np.uint8
+        assert result.min() == 0
+        assert result.max() == 255
+
+    def test_empty_image_doesnt_crash(self):
+        result = montage.normalize(np.zeros((4, 4, 4)))
+        assert not result.any()
+
+    def test_nans_ignored(self):
+        data = np.ones((4, 4, 4))
+        data[0, 0, 0] = np.nan
+        result = montage.normalize(data)
+        assert result[0, 0, 0] == 0
+
+class MakeMontage(unittest.TestCase):
+    def test_slices_tiled_to_requested_width(self):
+        slices = [np.full((10, 20), i, dtype=np.uint8) for i in range(7)]
+        image = montage.make_montage(slices, 60)
+        assert image.size == (60, 30)
+        pixels = np.asarray(image)
+        # third slice ends the first row, fourth starts the second
+        assert pixels[0, 45] == 2
+        assert pixels[10, 0] == 3
+
+    def test_montage_resized_when_width_not_a_multiple(self):
+        slices = [np.zeros((10, 20), dtype=np.uint8) for i in range(4)]
+        image = montage.make_montage(slices, 50)
+        assert image.width == 50
+
+class Render(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        data = np.random.rand(8, 8, 12, 5).astype(np.float32)
+        self.nifti = os.path.join(self.tmp, 'image.nii')
+        nib.save(nib.Nifti1Image(data, np.eye(4)), self.nifti)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_uses_every_nth_axial_slice_of_first_volume(self):
+        pic = os.path.join(self.tmp, 'image.png')
+        montage.render(self.nifti, pic, 3, 16)
+        image = PIL.Image.open(pic)
+        # 12 slices with a gap of 3 -> 4 slices, 2 per row
+        assert image.size == (16, 16)
+
+    def test_batch_reports_failures_without_stopping(self):
+        good = os.path.join(self.tmp, 'good.png')
+        bad = os.path.join(self.tmp, 'bad.png')
+        failed = montage.render_batch([
+                (self.nifti, good, 2, 32),
+                (os.path.join(self.tmp, 'missing.nii'), bad, 2, 32)])
+        assert failed == [bad]
+        assert os.path.exists(good)
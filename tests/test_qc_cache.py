@@ -0,0 +1,85 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import logging
+
+import datman.qc_cache as qc_cache
+
+logging.disable(logging.CRITICAL)
+
+class ArtifactCache(unittest.TestCase):
+    def setUp(self):
+        self.qc_dir = tempfile.mkdtemp()
+        self.nifti = os.path.join(self.qc_dir, 'input.nii.gz')
+        self.output = os.path.join(self.qc_dir, 'output.csv')
+        self.write(self.nifti, 'original data')
+        os.utime(self.nifti, (1000, 1000))
+        self.write(self.output, 'results')
+        self.cache = qc_cache.ArtifactCache(self.qc_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.qc_dir)
+
+    def write(self, path, contents):
+        with open(path, 'w') as stream:
+            stream.write(contents)
+
+    def test_missing_output_is_not_current(self):
+        os.remove(self.output)
+        assert not self.cache.is_current(self.output, [self.nifti], 'qcmon')
+
+    def test_existing_output_without_record_is_adopted(self):
+        assert self.cache.is_current(self.output, [self.nifti], 'qcmon')
+        assert 'output.csv' in self.cache.records
+
+    def test_output_without_record_older_than_input_is_not_current(self):
+        os.utime(self.output, (500, 500))
+
+        assert not self.cache.is_current(self.output, [self.nifti], 'qcmon')
+        assert 'output.csv' not in self.cache.records
+
+    def test_output_current_when_inputs_unchanged(self):
+        self.cache.update(self.output, [self.nifti], 'qcmon')
+        assert self.cache.is_current(self.output, [self.nifti], 'qcmon')
+
+    def test_output_stale_when_input_contents_change(self):
+        self.cache.update(self.output, [self.nifti], 'qcmon')
+        self.write(self.nifti, 'reexported!!!')
+        os.utime(self.nifti, (2000, 2000))
+        assert not self.cache.is_current(self.output, [self.nifti], 'qcmon')
+
+    def test_output_current_when_input_only_touched(self):
+        self.cache.update(self.output, [self.nifti], 'qcmon')
+        os.utime(self.nifti, (2000, 2000))
+        assert self.cache.is_current(self.output, [self.nifti], 'qcmon')
+
+    def test_output_stale_when_tool_version_changes(self):
+        self.cache.update(self.output, [self.nifti], 'qcmon/1.0')
+        assert not self.cache.is_current(self.output, [self.nifti],
+                'qcmon/2.0')
+
+    def test_output_stale_when_inputs_added(self):
+        self.cache.update(self.output, [self.nifti], 'qcmon')
+        bval = os.path.join(self.qc_dir, 'input.bval')
+        self.write(bval, '0 1000')
+        assert not self.cache.is_current(self.output, [self.nifti, bval],
+                'qcmon')
+
+    def test_records_saved_to_qc_folder(self):
+        self.cache.update(self.output, [self.nifti], 'qcmon')
+        with open(os.path.join(self.qc_dir, qc_cache.CACHE_NAME)) as stream:
+            saved = json.load(stream)
+        assert saved['output.csv']['tool'] == 'qcmon'
+        reloaded = qc_cache.ArtifactCache(self.qc_dir)
+        assert reloaded.is_current(self.output, [self.nifti], 'qcmon')
+
+class ToolVersion(unittest.TestCase):
+    def test_loaded_module_version_used(self):
+        os.environ['LOADEDMODULES'] = 'FSL/5.0.10:qcmon/1.0.1'
+        try:
+            assert qc_cache.tool_version('qcmon') == 'qcmon/1.0.1'
+            assert qc_cache.tool_version('AFNI') == 'AFNI'
+        finally:
+            del os.environ['LOADEDMODULES']
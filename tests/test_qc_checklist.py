@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import unittest
+from multiprocessing import Pool
+
+import datman.qc_checklist as qc_checklist
+
+def add_reports(args):
+    checklist_path, reports = args
+    store = qc_checklist.ChecklistStore(checklist_path)
+    return sum(1 for report in reports if store.add(report))
+
+class TestChecklistStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test_qc_checklist')
+        self.checklist = os.path.join(self.tmp, 'checklist.csv')
+        with open(self.checklist, 'w') as checklist:
+            checklist.writelines(["qc_subject1.html\n",
+                                  "qc_subject2.html   signed-off\n",
+                                  "qc_subject4.pdf\n",
+                                  "qc_subject5\n"])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def read_checklist(self):
+        with open(self.checklist, 'r') as checklist:
+            return checklist.readlines()
+
+    def test_existing_reports_not_added(self):
+        store = qc_checklist.ChecklistStore(self.checklist)
+
+        assert not store.add('/path/qc_subject1.html')
+        assert not store.add('/path/qc_subject2.html')
+        assert not store.add('/path/qc_subject5.html')
+        assert not os.path.exists(store.journal)
+
+    def test_new_report_journalled_until_compacted(self):
+        store = qc_checklist.ChecklistStore(self.checklist)
+
+        assert store.add('/path/qc_subject3.html')
+        assert '/other/qc_subject3.html' in store
+        assert not store.add('qc_subject3.html')
+        assert len(self.read_checklist()) == 4
+
+        assert store.compact() == 1
+        assert self.read_checklist()[-1] == 'qc_subject3.html\n'
+        assert os.path.getsize(store.journal) == 0
+        assert 'qc_subject3.html' in store
+
+    def test_compact_keeps_sign_offs_made_after_journalling(self):
+        store = qc_checklist.ChecklistStore(self.checklist)
+        store.add('qc_subject3.html')
+        with open(self.checklist, 'w') as checklist:
+            checklist.writelines(["qc_subject1.html   looks good\n",
+                                  "qc_subject3.html   also good"])
+
+        store.compact()
+
+        assert self.read_checklist() == ["qc_subject1.html   looks good\n",
+                                         "qc_subject3.html   also good\n"]
+
+    def test_compact_creates_missing_checklist(self):
+        os.remove(self.checklist)
+        store = qc_checklist.ChecklistStore(self.checklist)
+        store.add('qc_subject1.html')
+
+        store.compact()
+
+        assert self.read_checklist() == ['qc_subject1.html\n']
+
+    def test_nonblocking_compact_skipped_while_locked(self):
+        store = qc_checklist.ChecklistStore(self.checklist)
+        store.add('qc_subject3.html')
+        other = qc_checklist.ChecklistStore(self.checklist)
+
+        # lockf locks belong to the process, so the lock must be held by
+        # another one for this to be tested
+        locked_read, locked_write = os.pipe()
+        release_read, release_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            with other.locked():
+                os.write(locked_write, b'x')
+                os.read(release_read, 1)
+            os._exit(0)
+        os.read(locked_read, 1)
+        try:
+            assert store.compact(blocking=False) == 0
+        finally:
+            os.write(release_write, b'x')
+            os.waitpid(pid, 0)
+        assert store.compact(blocking=False) == 1
+
+    def test_concurrent_writers_add_each_report_once(self):
+        reports = ['qc_subject{}.html'.format(num) for num in range(6, 46)]
+        pool = Pool(4)
+        try:
+            # Every worker tries to add every report
+            added = pool.map(add_reports, [(self.checklist, reports)] * 4)
+        finally:
+            pool.close()
+            pool.join()
+
+        assert sum(added) == len(reports)
+        qc_checklist.ChecklistStore(self.checklist).compact()
+        entries = [line.strip() for line in self.read_checklist()]
+        assert sorted(entries[4:]) == sorted(reports)
+
+class TestGetReportName(unittest.TestCase):
+    def test_extension_and_comment_removed(self):
+        assert qc_checklist.get_report_name(
+                'qc_subject2.html   signed-off\n') == 'qc_subject2'
+
+    def test_blank_line_is_none(self):
+        assert qc_checklist.get_report_name('  \n') is None
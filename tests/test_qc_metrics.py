@@ -0,0 +1,144 @@
+import os
+import csv
+import shutil
+import tempfile
+import unittest
+import logging
+
+import numpy as np
+import nibabel as nib
+from mock import patch
+
+import datman.qc_metrics as qc_metrics
+
+logging.disable(logging.CRITICAL)
+
+def detrend(data):
+    design = qc_metrics.get_design(data.shape[3])
+    series = data.reshape(-1, data.shape[3]).T
+    beta = np.linalg.lstsq(design, series, rcond=None)[0]
+    return (series - design.dot(beta)).T.reshape(data.shape)
+
+def read_csv(path):
+    with open(path, 'r') as stream:
+        return list(csv.reader(stream))
+
+class TestFmriQC(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test_qc_metrics')
+        self.nifti = os.path.join(self.tmp, 'sub_RST.nii.gz')
+        self.prefix = os.path.join(self.tmp, 'sub_RST')
+        rand = np.random.RandomState(0)
+        self.data = 1000 + rand.normal(0, 10, (6, 5, 4, 40))
+        # a linear drift the detrending should remove
+        self.data += np.linspace(0, 50, 40)
+        nib.Nifti1Image(self.data, np.eye(4)).to_filename(self.nifti)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_chunked_maps_match_whole_series(self):
+        img, sums = qc_metrics.compute_metrics(self.nifti, chunk_size=7)
+        tmean, tsd, sfnr, corr = sums.results()
+
+        residuals = detrend(self.data)
+        expected_tsd = np.sqrt((residuals ** 2).sum(axis=3) / (40 - 3))
+        np.testing.assert_allclose(tmean, self.data.mean(axis=3))
+        np.testing.assert_allclose(tsd, expected_tsd, rtol=1e-6)
+        np.testing.assert_allclose(sfnr, tmean / expected_tsd, rtol=1e-6)
+
+        mask = qc_metrics.get_mask(self.data[..., 0])
+        signal = detrend(self.data[mask].mean(axis=0).reshape(1, 1, 1, 40))
+        self.assertAlmostEqual(corr[1, 2, 3], np.corrcoef(residuals[1, 2, 3],
+                signal.ravel())[0, 1], places=6)
+
+    def test_file_kept_open_between_chunks(self):
+        # reopening a .nii.gz for each chunk decompresses it from the start
+        # every time
+        with patch('nibabel.load', wraps=nib.load) as mock_load:
+            qc_metrics.compute_metrics(self.nifti, chunk_size=7)
+
+        assert mock_load.call_count == 1
+        assert mock_load.call_args[1] == {'keep_file_open': True}
+
+    def fake_volreg(self, command):
+        params = command.split()[command.split().index('-1Dfile') + 1]
+        motion = np.zeros((40, 6))
+        # a 0.5mm jump at volume 10, and a 1 degree turn at volume 20
+        motion[10:, 3] = 0.5
+        motion[20:, 0] = 1
+        np.savetxt(params, motion)
+        return 0, ''
+
+    @patch('datman.utils.run')
+    def test_outputs_written_in_qcmon_layout(self, mock_run):
+        mock_run.side_effect = self.fake_volreg
+
+        stats = qc_metrics.fmri_qc(self.nifti, self.prefix)
+
+        assert stats['ntrs'] == 40
+        assert read_csv(self.prefix + '_scanlengths.csv') == [['ntrs'],
+                                                              ['40']]
+        header, values = read_csv(self.prefix + '_stats.csv')
+        assert header == ['mean_fd', 'n_bad_fd', '%_bad_fd', 'global_corr',
+                          'mean_sfnr']
+        assert values[1:3] == ['2', '5.0']
+        self.assertAlmostEqual(float(values[0]),
+                (0.5 + np.radians(1) * 50) / 40)
+        assert len(read_csv(self.prefix + '_fd.csv')) == 41
+        sfnr = nib.load(self.prefix + '_sfnr.nii.gz')
+        assert sfnr.shape == (6, 5, 4)
+        assert nib.load(self.prefix + '_corr.nii.gz').shape == (6, 5, 4)
+
+    @patch('datman.utils.run', return_value=(1, ''))
+    def test_motion_columns_empty_when_volreg_fails(self, mock_run):
+        stats = qc_metrics.fmri_qc(self.nifti, self.prefix)
+
+        assert stats['mean_fd'] is None
+        values = read_csv(self.prefix + '_stats.csv')[1]
+        assert values[:3] == ['', '', '']
+        assert float(values[4]) > 0
+        assert not os.path.exists(self.prefix + '_fd.csv')
+
+    def test_scan_length_read_from_header(self):
+        assert qc_metrics.scan_length(self.nifti) == 40
+
+class TestSpikes(unittest.TestCase):
+    def test_outlying_slice_means_counted(self):
+        slice_means = np.full((3, 20), 100.0)
+        slice_means += np.random.RandomState(0).normal(0, 1, (3, 20))
+        slice_means[1, 5] = 200
+
+        spikes = qc_metrics.count_spikes(slice_means)
+
+        assert list(spikes) == [0, 1, 0]
+
+    def test_volumes_compared_within_bval_group(self):
+        rand = np.random.RandomState(0)
+        slice_means = np.hstack([np.full((2, 5), 1000.0),
+                                 np.full((2, 30), 300.0)])
+        slice_means += rand.normal(0, 1, slice_means.shape)
+        groups = [0] * 5 + [1000] * 30
+
+        assert not qc_metrics.count_spikes(slice_means, groups).any()
+        # without grouping the b0 volumes look like spikes
+        assert qc_metrics.count_spikes(slice_means).sum() == 10
+
+    def test_spikecount_writes_each_slice(self):
+        tmp = tempfile.mkdtemp(prefix='test_qc_metrics')
+        try:
+            nifti = os.path.join(tmp, 'sub_DTI.nii.gz')
+            bval = os.path.join(tmp, 'sub_DTI.bval')
+            output = os.path.join(tmp, 'sub_DTI_spikecount.csv')
+            data = np.random.RandomState(0).normal(500, 5, (4, 4, 3, 12))
+            data[:, :, 2, 6] += 500
+            nib.Nifti1Image(data, np.eye(4)).to_filename(nifti)
+            with open(bval, 'w') as stream:
+                stream.write(' '.join(['0'] * 2 + ['995'] * 10))
+
+            qc_metrics.spikecount(nifti, output, bval)
+
+            assert read_csv(output) == [['slice', 'n_spikes'], ['0', '0'],
+                                        ['1', '0'], ['2', '1']]
+        finally:
+            shutil.rmtree(tmp)
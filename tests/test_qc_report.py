@@ -0,0 +1,133 @@
+import os
+import shutil
+import tempfile
+import unittest
+import logging
+
+from mock import MagicMock
+
+import datman.qc_report as qc_report
+
+logging.disable(logging.CRITICAL)
+
+class TestReport(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='test_qc_report')
+        self.subject = 'STUDY_CMH_0001_01'
+        self.report_path = os.path.join(self.tmp, 'qc_{}.html'.format(
+                self.subject))
+        self.image = os.path.join(self.tmp, 'T1.png')
+        open(self.image, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def render(self, text, image=None):
+        def write(section):
+            section.write('<h2>{}</h2>'.format(text))
+            if image:
+                relpath = os.path.relpath(image,
+                        os.path.dirname(section.name))
+                section.write('<img src="{}" >'.format(relpath))
+        return MagicMock(side_effect=write)
+
+    def build(self, sections, use_cache=True):
+        report = qc_report.Report(self.report_path, self.subject,
+                use_cache=use_cache)
+        for key, signature, render in sections:
+            report.add_section(key, signature, render)
+        report.write(summary={'series': len(sections)})
+        with open(self.report_path, 'r') as page:
+            return report, page.read()
+
+    def test_page_made_from_sections_in_order(self):
+        report, page = self.build([('a', [1], self.render('first')),
+                                   ('b', [1], self.render('second'))])
+
+        assert page.startswith('<HTML><TITLE>{} qc</TITLE>'.format(
+                self.subject))
+        assert page.index('first') < page.index('second')
+        assert report.rendered == ['a', 'b']
+
+    def test_unchanged_sections_reused(self):
+        self.build([('a', [1], self.render('first', self.image)),
+                    ('b', [1], self.render('second'))])
+
+        first = self.render('first again')
+        second = self.render('second again')
+        report, page = self.build([('a', [1], first), ('b', [2], second)])
+
+        assert not first.called
+        assert second.called
+        assert report.reused == ['a']
+        assert 'first' in page and 'second again' in page
+
+    def test_every_section_rendered_without_cache(self):
+        self.build([('a', [1], self.render('first'))])
+
+        first = self.render('first again')
+        report, page = self.build([('a', [1], first)], use_cache=False)
+
+        assert first.called
+        assert report.rendered == ['a']
+        assert 'first again' in page
+
+    def test_new_sections_added_without_rerendering_old(self):
+        self.build([('a', [1], self.render('first'))])
+
+        first = self.render('first')
+        report, page = self.build([('a', [1], first),
+                                   ('b', [1], self.render('repeat'))])
+
+        assert not first.called
+        assert report.rendered == ['b']
+        assert 'repeat' in page
+
+    def test_section_rerendered_when_image_missing(self):
+        self.build([('a', [1], self.render('first', self.image))])
+        os.remove(self.image)
+
+        first = self.render('first')
+        self.build([('a', [1], first)])
+
+        assert first.called
+
+    def test_unsigned_sections_always_rendered(self):
+        self.build([('notes', None, self.render('notes'))])
+
+        notes = self.render('notes')
+        self.build([('notes', None, notes)])
+
+        assert notes.called
+
+class TestIndex(unittest.TestCase):
+    def setUp(self):
+        self.qc_dir = tempfile.mkdtemp(prefix='test_qc_report')
+
+    def tearDown(self):
+        shutil.rmtree(self.qc_dir)
+
+    def test_index_lists_subjects_with_summaries(self):
+        for subject in ['STUDY_CMH_0002_01', 'STUDY_CMH_0001_01',
+                        'STUDY_CMH_0003_01']:
+            os.mkdir(os.path.join(self.qc_dir, subject))
+        for subject in ['STUDY_CMH_0002_01', 'STUDY_CMH_0001_01']:
+            report = qc_report.Report(os.path.join(self.qc_dir, subject,
+                    'qc_{}.html'.format(subject)), subject)
+            report.write(summary={'series': 3, 'missing': 1,
+                    'header_diffs': 0,
+                    'report': 'qc_{}.html'.format(subject)})
+
+        index = qc_report.write_index(self.qc_dir, 'STUDY')
+
+        with open(index, 'r') as page:
+            contents = page.read()
+        assert contents.index('STUDY_CMH_0001_01') < contents.index(
+                'STUDY_CMH_0002_01')
+        assert 'STUDY_CMH_0001_01/qc_STUDY_CMH_0001_01.html' in contents
+        assert 'STUDY_CMH_0003_01' not in contents
+
+class TestFileSignature(unittest.TestCase):
+    def test_missing_files_have_no_size(self):
+        assert qc_report.file_signature('/does/not/exist') == [
+                ['/does/not/exist', None, None]]
@@ -0,0 +1,91 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import logging
+
+import datman.qc_status as qc_status
+
+logging.disable(logging.CRITICAL)
+
+def touch(path, mtime=None):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    open(path, 'w').close()
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+class TestScanProject(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='test_qc_status')
+        self.project = os.path.join(self.root, 'STUDY')
+        self.nii = os.path.join(self.project, 'data', 'nii')
+        self.qc = os.path.join(self.project, 'qc')
+        old = time.time() - 1000
+
+        for session in ['STUDY_CMH_0001_01', 'STUDY_CMH_0002_01',
+                        'STUDY_CMH_0003_01', 'STUDY_CMH_0004_01',
+                        'STUDY_CMH_PHA_FBN0001']:
+            touch(os.path.join(self.nii, session,
+                    '{}_01_T1_02_SagT1.nii.gz'.format(session)), old)
+            os.utime(os.path.join(self.nii, session), (old, old))
+
+        # signed off and up to date
+        touch(os.path.join(self.qc, 'STUDY_CMH_0001_01',
+                'qc_STUDY_CMH_0001_01.html'))
+        # not signed off, and data added after the report
+        touch(os.path.join(self.qc, 'STUDY_CMH_0002_01',
+                'qc_STUDY_CMH_0002_01.html'), old + 10)
+        touch(os.path.join(self.nii, 'STUDY_CMH_0002_01',
+                'STUDY_CMH_0002_01_01_RST_03_Rest.nii.gz'))
+
+        checklist = os.path.join(self.project, 'metadata', 'checklist.csv')
+        touch(checklist)
+        with open(checklist, 'w') as stream:
+            stream.write('qc_STUDY_CMH_0001_01.html   signed off\n'
+                         'qc_STUDY_CMH_0002_01.html\n')
+        # report added by a QC job but not yet merged into the checklist
+        with open(checklist + '.journal', 'w') as stream:
+            stream.write('qc_STUDY_CMH_0003_01.html\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_sessions_sorted_into_lists(self):
+        status = qc_status.scan_project(self.project)
+
+        assert status['unlisted'] == [os.path.join(self.nii,
+                'STUDY_CMH_0004_01')]
+        assert status['missing'] == [os.path.join(self.nii,
+                'STUDY_CMH_0003_01')]
+        assert status['unsigned'] == [os.path.join(self.qc,
+                'STUDY_CMH_0002_01', 'qc_STUDY_CMH_0002_01.html')]
+
+    def test_stale_report_lists_newer_files(self):
+        status = qc_status.scan_project(self.project)
+
+        assert len(status['stale']) == 1
+        stale = status['stale'][0]
+        assert stale['session'] == os.path.join(self.nii, 'STUDY_CMH_0002_01')
+        assert stale['newer'] == [os.path.join(self.nii, 'STUDY_CMH_0002_01',
+                'STUDY_CMH_0002_01_01_RST_03_Rest.nii.gz')]
+
+    def test_broken_links_dont_crash(self):
+        os.symlink('/does/not/exist', os.path.join(self.nii,
+                'STUDY_CMH_0001_01', 'STUDY_CMH_0001_01_01_T2_04_T2.nii.gz'))
+
+        status = qc_status.scan_project(self.project)
+
+        assert [stale['session'] for stale in status['stale']] == [
+                os.path.join(self.nii, 'STUDY_CMH_0002_01')]
+
+    def test_projects_found_below_root(self):
+        other = os.path.join(self.root, 'group', 'OTHER')
+        touch(os.path.join(other, 'metadata', 'checklist.csv'))
+
+        projects = qc_status.find_projects(self.root)
+
+        assert projects == [self.project, other]
+        assert qc_status.scan_projects(projects, jobs=2)[0]['project'] == \
+                self.project
@@ -0,0 +1,94 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import logging
+
+import dashboard_stub
+
+dashboard_stub.install()
+import datman.dashboard
+import datman.query_stats as query_stats
+
+logging.disable(logging.CRITICAL)
+
+class TestQueryStats(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.patches = dashboard_stub.patch_datman()
+        cls.tmp = tempfile.mkdtemp(prefix='test_query_stats')
+        cls.engine = dashboard_stub.use_database(os.path.join(cls.tmp,
+                'dashboard.sqlite'))
+        dashboard_stub.seed(20, 5)
+
+    @classmethod
+    def tearDownClass(cls):
+        dashboard_stub.db.session.remove()
+        for item in cls.patches:
+            item.stop()
+        shutil.rmtree(cls.tmp)
+
+    def setUp(self):
+        self.stats = query_stats.enable(self.engine, slowest=2)
+        self.db = datman.dashboard.dashboard(dashboard_stub.STUDY)
+
+    def tearDown(self):
+        query_stats.disable()
+        dashboard_stub.db.session.rollback()
+
+    def record(self, method):
+        return self.stats.records[(dashboard_stub.STUDY, method)]
+
+    def test_statements_charged_to_outer_method(self):
+        name, scans = dashboard_stub.session_scans(25, 5)
+
+        self.db.get_add_scan(scans[0], create=True)
+
+        record = self.record('get_add_scan')
+        assert record['calls'] == 1
+        assert record['statements'] > 2
+        assert record['sql_time'] <= record['total_time']
+        assert (dashboard_stub.STUDY, 'get_add_session') not in \
+                self.stats.records
+
+    def test_calls_counted_and_slowest_kept(self):
+        for number in range(3):
+            name, _ = dashboard_stub.session_scans(number, 5)
+            self.db.get_add_session(name)
+
+        record = self.record('get_add_session')
+        assert record['calls'] == 3
+        assert len(record['slowest']) == 2
+
+    def test_statements_outside_methods_charged_to_other(self):
+        dashboard_stub.db.session.query(dashboard_stub.Site).all()
+
+        record = self.stats.records[(query_stats.UNKNOWN_STUDY,
+                query_stats.OTHER)]
+        assert record['statements'] == 1
+
+    def test_report_written_as_json(self):
+        name, scans = dashboard_stub.session_scans(1, 5)
+        self.db.delete_extra_scans(name + '_01', scans)
+        report = os.path.join(self.tmp, 'report.json')
+
+        self.stats.report(report)
+
+        with open(report) as stream:
+            totals = json.load(stream)
+        method = totals[dashboard_stub.STUDY]['delete_extra_scans']
+        assert method['calls'] == 1
+        assert method['slowest'][0]['statement']
+        assert method['slowest'][0]['seconds'] >= \
+                method['slowest'][-1]['seconds']
+
+    def test_nothing_recorded_when_disabled(self):
+        query_stats.disable()
+        name, _ = dashboard_stub.session_scans(2, 5)
+
+        self.db.get_add_session(name)
+
+        assert query_stats.get_stats() is None
+        assert self.stats.records.get((dashboard_stub.STUDY,
+                'get_add_session')) is None
@@ -1,4 +1,6 @@
 import os
+import shutil
+import tempfile
 import unittest
 
 from nose.tools import raises
@@ -33,6 +35,11 @@ class TestSeries(unittest.TestCase):
         assert series.description == 'SagT1Bravo-09mm'
         assert series.full_id == 'STUDY_SITE_9999_01'
 
+    def test_series_has_no_attribute_dict(self):
+        series = datman.scan.Series(self.good_name)
+
+        assert not hasattr(series, '__dict__')
+
 class TestScan(unittest.TestCase):
     good_name = "STUDY_CMH_9999_01"
     bad_name = "STUDYCMH_9999"
@@ -89,7 +96,7 @@ class TestScan(unittest.TestCase):
         assert subject.niftis == []
         assert subject.dicoms == []
 
-    @patch('glob.glob')
+    @patch('datman.scan.list_files')
     def test_niftis_with_either_extension_type_found(self, mock_glob):
         simple_ext = "{}_01_T1_02_SagT1-BRAVO.nii".format(self.good_name)
         complex_ext = "{}_01_DTI60-1000_05_Ax-DTI-60.nii.gz".format(self.good_name)
@@ -106,7 +113,7 @@ class TestScan(unittest.TestCase):
         assert sorted(found_niftis) == sorted(expected)
 
     @raises(datman.scanid.ParseException)
-    @patch('glob.glob')
+    @patch('datman.scan.list_files')
     def test_subject_series_with_nondatman_name_causes_parse_exception(self,
             mock_glob):
         well_named = "{}_01_T1_02_SagT1-BRAVO.nii".format(self.good_name)
@@ -117,8 +124,9 @@ class TestScan(unittest.TestCase):
         mock_glob.return_value = nii_list
 
         subject = datman.scan.Scan(self.good_name, self.config)
+        subject.niftis
 
-    @patch('glob.glob')
+    @patch('datman.scan.list_files')
     def test_dicoms_lists_only_dicom_files(self, mock_glob):
         dicom1 = "{}_01_T1_02_SagT1-BRAVO.dcm".format(self.good_name)
         dicom2 = "{}_01_DTI60-1000_05_Ax-DTI-60.dcm".format(self.good_name)
@@ -135,7 +143,7 @@ class TestScan(unittest.TestCase):
 
         assert sorted(found_dicoms) == sorted(expected)
 
-    @patch('glob.glob')
+    @patch('datman.scan.list_files')
     def test_nii_tags_lists_all_tags(self, mock_glob):
         T1 = "STUDY_CAMH_9999_01_01_T1_02_SagT1-BRAVO.nii"
         DTI = "STUDY_CAMH_9999_01_01_DTI60-1000_05_Ax-DTI-60.nii"
@@ -147,7 +155,7 @@ class TestScan(unittest.TestCase):
         assert sorted(subject.nii_tags) == sorted(['T1', 'DTI60-1000'])
         assert subject.dcm_tags == []
 
-    @patch('glob.glob')
+    @patch('datman.scan.list_files')
     def test_dcm_tags_lists_all_tags(self, mock_glob):
         T1 = "STUDY_CAMH_9999_01_01_T1_02_SagT1-BRAVO.dcm"
         DTI = "STUDY_CAMH_9999_01_01_DTI60-1000_05_Ax-DTI-60.dcm"
@@ -159,7 +167,7 @@ class TestScan(unittest.TestCase):
         assert sorted(subject.dcm_tags) == sorted(['T1', 'DTI60-1000'])
         assert subject.nii_tags == []
 
-    @patch('glob.glob')
+    @patch('datman.scan.list_files')
     def test_get_tagged_nii_finds_all_matching_series(self, mock_glob):
         T1_1 = "STUDY_CAMH_9999_01_01_T1_02_SagT1-BRAVO.nii"
         T1_2 = "STUDY_CAMH_9999_01_01_T1_03_SagT1-BRAVO.nii.gz"
@@ -177,7 +185,7 @@ class TestScan(unittest.TestCase):
         expected = [DTI]
         assert actual_DTIs == expected
 
-    @patch('glob.glob')
+    @patch('datman.scan.list_files')
     def test_get_tagged_dcm_finds_all_matching_series(self, mock_glob):
         T1_1 = "STUDY_CAMH_9999_01_01_T1_02_SagT1-BRAVO.dcm"
         T1_2 = "STUDY_CAMH_9999_01_01_T1_03_SagT1-BRAVO.dcm"
@@ -195,7 +203,7 @@ class TestScan(unittest.TestCase):
         expected = [DTI]
         assert actual_DTIs == expected
 
-    @patch('glob.glob')
+    @patch('datman.scan.list_files')
     def test_get_tagged_X_returns_empty_list_when_no_tag_files(self, mock_glob):
         nifti = "STUDY_CAMH_9999_01_01_T1_03_SagT1-BRAVO.nii.gz"
         dicom = "STUDY_CAMH_9999_01_01_DTI_05_Ax-DTI-60.dcm"
@@ -206,3 +214,45 @@ class TestScan(unittest.TestCase):
 
         assert subject.get_tagged_nii('DTI') == []
         assert subject.get_tagged_dcm('T1') == []
+
+    @patch('datman.scan.list_files')
+    def test_folders_not_read_until_series_needed(self, mock_list):
+        mock_list.return_value = []
+
+        subject = datman.scan.Scan(self.good_name, self.config)
+        subject.qc_path
+
+        assert not mock_list.called
+
+    @patch('datman.scan.list_files')
+    def test_each_folder_listed_only_once(self, mock_list):
+        mock_list.return_value = [
+                "STUDY_CAMH_9999_01_01_T1_02_SagT1-BRAVO.nii",
+                "STUDY_CAMH_9999_01_01_T1_02_SagT1-BRAVO.dcm"]
+
+        subject = datman.scan.Scan(self.good_name, self.config)
+        subject.niftis
+        subject.nii_tags
+        subject.get_tagged_nii('T1')
+        subject.get_tagged_dcm('T1')
+        subject.dcm_tags
+
+        assert sorted(call[0][0] for call in mock_list.call_args_list) == \
+                sorted([subject.nii_path, subject.dcm_path])
+
+    def test_list_files_returns_empty_list_for_missing_folder(self):
+        assert datman.scan.list_files('/does/not/exist') == []
+
+class TestListFiles(unittest.TestCase):
+    def test_hidden_files_left_out(self):
+        tmp = tempfile.mkdtemp(prefix='test_scan')
+        try:
+            for name in ['STUDY_CMH_0001_01_01_T1_02_SagT1.nii.gz',
+                         '._STUDY_CMH_0001_01_01_T1_02_SagT1.nii.gz',
+                         '.DS_Store']:
+                open(os.path.join(tmp, name), 'w').close()
+
+            assert datman.scan.list_files(tmp) == [os.path.join(tmp,
+                    'STUDY_CMH_0001_01_01_T1_02_SagT1.nii.gz')]
+        finally:
+            shutil.rmtree(tmp)
@@ -2,6 +2,8 @@
 
 
 import os
+import shutil
+import tempfile
 
 
 import unittest
@@ -62,3 +64,37 @@ class TestCheckDependencyConfigured(unittest.TestCase):
 
     # def test_exception_contains_program_name(self):
     #     assert False
+
+@patch('datman.config.config')
+class TestGetBlacklistComments(unittest.TestCase):
+
+    blacklist = ('series\treason\n'
+                 'STUDY_CMH_0001_01_01_T1_02_SagT1-BRAVO\tToo much motion\n'
+                 'STUDY_CMH_0001_01_01_DTI60-1000_05_Ax-DTI-60\n')
+
+    def setUp(self):
+        self.meta = tempfile.mkdtemp(prefix='test_utils')
+        with open(os.path.join(self.meta, 'blacklist.csv'), 'w') as output:
+            output.write(self.blacklist)
+
+    def tearDown(self):
+        shutil.rmtree(self.meta)
+
+    def test_comments_found_for_all_scans(self, mock_config):
+        mock_config.return_value.get_path.return_value = self.meta
+        scans = ['STUDY_CMH_0001_01_01_T1_02_SagT1-BRAVO',
+                 'STUDY_CMH_0001_01_01_DTI60-1000_05_Ax-DTI-60',
+                 'STUDY_CMH_0001_01_01_T2_03_T2']
+
+        comments = utils.get_blacklist_comments(scans, study='STUDY')
+
+        assert comments == {scans[0]: 'Too much motion', scans[1]: None,
+                            scans[2]: None}
+        assert mock_config.call_count == 1
+
+    def test_matches_check_blacklist(self, mock_config):
+        mock_config.return_value.get_path.return_value = self.meta
+        scan = 'STUDY_CMH_0001_01_01_T1_02_SagT1-BRAVO'
+
+        assert utils.get_blacklist_comments([scan], study='STUDY')[scan] == \
+                utils.check_blacklist(scan, study='STUDY')
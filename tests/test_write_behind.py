@@ -0,0 +1,91 @@
+import threading
+import unittest
+import logging
+
+from mock import MagicMock, patch
+
+import datman.write_behind as write_behind
+
+logging.disable(logging.CRITICAL)
+
+class TestWriteBehindQueue(unittest.TestCase):
+    def test_tasks_run_in_order_with_setup_result(self):
+        target = object()
+        calls = []
+        updates = write_behind.WriteBehindQueue(lambda: target)
+
+        for number in range(50):
+            updates.put('task {}'.format(number),
+                    lambda given, n: calls.append((given, n)), number)
+        failed = updates.close()
+
+        assert failed == []
+        assert calls == [(target, n) for n in range(50)]
+
+    def test_setup_runs_in_worker_thread(self):
+        threads = []
+        updates = write_behind.WriteBehindQueue(
+                lambda: threads.append(threading.current_thread()))
+        updates.close()
+
+        assert threads and threads[0] is not threading.current_thread()
+
+    def test_failures_reported_for_each_task(self):
+        error = ValueError('bad')
+        bad = MagicMock(side_effect=error)
+        good = MagicMock()
+        updates = write_behind.WriteBehindQueue(lambda: None)
+
+        updates.put('first', bad)
+        updates.put('second', good)
+        updates.put('third', bad)
+        failed = updates.close()
+
+        assert failed == [('first', error), ('third', error)]
+        assert good.called
+
+    def test_all_tasks_fail_if_setup_fails(self):
+        error = RuntimeError('no database')
+        task = MagicMock()
+        updates = write_behind.WriteBehindQueue(MagicMock(side_effect=error))
+
+        updates.put('first', task)
+        updates.put('second', task)
+        failed = updates.close()
+
+        assert not task.called
+        assert failed == [('first', error), ('second', error)]
+
+    def test_flush_waits_for_queued_tasks(self):
+        release = threading.Event()
+        done = []
+        updates = write_behind.WriteBehindQueue(lambda: None, maxsize=2)
+
+        updates.put('wait', lambda _: release.wait())
+        updates.put('record', lambda _: done.append(True))
+        release.set()
+        updates.flush()
+
+        assert done == [True]
+        updates.close()
+
+    def test_cant_queue_after_close(self):
+        updates = write_behind.WriteBehindQueue(lambda: None)
+        updates.close()
+
+        self.assertRaises(RuntimeError, updates.put, 'late', MagicMock())
+
+    @patch('datman.write_behind.CHECK_INTERVAL', 0.05)
+    def test_put_and_flush_fail_if_worker_dies(self):
+        release = threading.Event()
+        def die(_):
+            release.wait()
+            raise SystemExit()
+        updates = write_behind.WriteBehindQueue(lambda: None, maxsize=1)
+
+        updates.put('dies', die)
+        updates.put('waiting', MagicMock())
+        release.set()
+
+        self.assertRaises(RuntimeError, updates.put, 'late', MagicMock())
+        self.assertRaises(RuntimeError, updates.flush)